@@ -0,0 +1,108 @@
+# Microbenchmark of the per-sonde cost of the Level-2 writers in src/processing/generate_Level_2.py
+#
+# run from the repository root:
+#     python benchmarks/bench_level_2_writer.py --samples 5000 --sondes 50
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src", "processing"))
+
+import generate_Level_2 as l2
+
+
+def synthetic_sonde(n_samples, seed=0):
+    """
+    Level-1-like sonde: 4 Hz samples, PTU valid at every other sample, a few NaN gaps
+    """
+    rng = np.random.default_rng(seed)
+
+    time = np.datetime64("2020-01-22T10:00:00") + np.arange(n_samples) * np.timedelta64(250, "ms")
+    alt = np.linspace(9000, 0, n_samples)
+
+    data = {
+        "alt": alt,
+        "lat": 13.3 + rng.normal(0, 1e-3, n_samples),
+        "lon": -57.7 + rng.normal(0, 1e-3, n_samples),
+        "tdry": 25 - 6.5e-3 * alt,
+        "pres": 1013 * np.exp(-alt / 8400),
+        "rh": rng.uniform(20, 90, n_samples),
+        "wspd": rng.uniform(0, 15, n_samples),
+        "wdir": rng.uniform(0, 360, n_samples),
+    }
+    data["alt"][1::2] = np.nan
+    data["lat"][rng.integers(0, n_samples, n_samples // 50)] = np.nan
+
+    sonde = xr.Dataset({var: ("time", values) for var, values in data.items()}, coords={"time": time})
+    sonde["height"] = sonde["alt"]
+    sonde["launch_time"] = time[0]
+
+    return sonde
+
+
+def per_sonde_xarray(sonde, save_path, global_attrs):
+    """
+    Former hot loop: nine masked .values copies, per-variable casts, xr.Dataset build, to_netcdf
+    """
+    ht_indices = ~np.isnan(sonde.alt) & ~np.isnan(sonde.lat) & ~np.isnan(sonde.lon)
+
+    variables = {"time": sonde.time[ht_indices].values}
+    variables["alt"] = np.float32(sonde.alt[ht_indices].values)
+    variables["rh"] = np.float32(sonde["rh"][ht_indices].values * 1.06 / 100)
+    variables["lat"] = np.float32(sonde["lat"][ht_indices].values)
+    variables["lon"] = np.float32(sonde["lon"][ht_indices].values)
+    variables["p"] = np.float32(sonde["pres"][ht_indices].values * 100)
+    variables["ta"] = np.float32(sonde["tdry"][ht_indices].values + 273.15)
+    for var1, var2 in zip(l2.varname_L1, l2.varname_L2):
+        if var2 not in variables.keys():
+            variables[var2] = np.float32(sonde[var1][ht_indices].values)
+
+    to_save_ds, encoding = l2.build_level_2_dataset(variables, "HALO-0122_s01", global_attrs)
+    to_save_ds.to_netcdf(save_path, mode="w", format="NETCDF4", encoding=encoding)
+
+
+def per_sonde_netcdf4(sonde, save_path, global_attrs):
+    variables = l2.extract_level_2_variables(sonde)
+    l2.write_level_2_netcdf4(save_path, variables, "HALO-0122_s01", global_attrs)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--sondes", type=int, default=50)
+    args = parser.parse_args()
+
+    sondes = [synthetic_sonde(args.samples, seed=i).load() for i in range(args.sondes)]
+    global_attrs = {"title": "benchmark", "platform_id": "HALO"}
+
+    print(f"{args.sondes} sondes x {args.samples} samples")
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        for name, func in [("xarray", per_sonde_xarray), ("netcdf4", per_sonde_netcdf4)]:
+
+            if name == "netcdf4" and l2.netCDF4 is None:
+                print("netcdf4 : netCDF4 not installed")
+                continue
+
+            save_path = os.path.join(tmp, f"{name}.nc")
+            func(sondes[0], save_path, global_attrs)
+            # warm-up, builds the schema once
+
+            start = time.perf_counter()
+            for sonde in sondes:
+                func(sonde, save_path, global_attrs)
+            per_sonde = (time.perf_counter() - start) / len(sondes) * 1e3
+
+            print(f"{name:<8}: {per_sonde:8.2f} ms per sonde")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Campaign-scale benchmark of the processing stages on synthetic sondes
+#
+# For every requested sonde count, a synthetic campaign is generated with
+# benchmarks/synthetic_campaign.py, and QC, Level-2, Level-3 and the quicklooks
+# (src/processing/quicklooks.py) are run over all its flight directories with
+# instrumentation switched on. Reported per stage: wall time, throughput (sondes/s),
+# peak RSS and bytes read/written. The peak RSS is sampled while the stage runs,
+# over this process and its worker processes, so it is not carried over from
+# earlier stages or smaller sonde counts.
+#
+# run from the repository root (the stages read run_config.cfg):
+#     python benchmarks/bench_pipeline.py --sondes 100 1000 --workers 4 --json bench.json
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src", "processing"))
+
+import instrumentation
+import pipeline
+
+import synthetic_campaign
+
+bench_stages = ["QC", "Level_2", "Level_3", "Quicklooks"]
+
+
+def run_stages(platform_dirs, workers):
+
+    """
+    Run the benchmarked stages over all flight directories; the measurements of
+    a stage are summed over the flights
+    """
+
+    stages = [s for s in pipeline.stages if s.name in bench_stages]
+
+    for data_dir in platform_dirs:
+        for stage in stages:
+            with instrumentation.stage(stage.name):
+                stage.run(data_dir, workers)
+
+
+def bench(n_sondes, workers, sondes_per_flight, templates, root):
+
+    start = time.perf_counter()
+
+    platform_dirs = synthetic_campaign.generate_campaign(
+        os.path.join(root, f"campaign_{n_sondes}"),
+        n_sondes,
+        sondes_per_flight=sondes_per_flight,
+        templates=templates,
+    )
+
+    generation = time.perf_counter() - start
+
+    instrumentation.reset()
+    run_stages(platform_dirs, workers)
+
+    report = instrumentation.recorder.report()
+
+    for name, entry in report["stages"].items():
+        entry["sondes_per_s"] = n_sondes / entry["wall_s"] if entry["wall_s"] > 0 else None
+
+    report.update(
+        {
+            "sondes": n_sondes,
+            "flights": len(platform_dirs),
+            "workers": workers,
+            "generation_s": generation,
+        }
+    )
+
+    return report
+
+
+def print_report(report):
+
+    print(
+        f"\n{report['sondes']} sondes, {report['flights']} flights, {report['workers']} workers "
+        f"(generated in {report['generation_s']:.1f} s)"
+    )
+    print(f"{'stage':<10} {'wall s':>9} {'sondes/s':>9} {'peak MB':>9} {'read MB':>9} {'write MB':>9}")
+
+    for name, entry in report["stages"].items():
+        read = entry["read_bytes"] + entry.get("worker_read_bytes", 0)
+        written = entry["write_bytes"] + entry.get("worker_write_bytes", 0)
+        print(
+            f"{name:<10} {entry['wall_s']:9.2f} {entry['sondes_per_s'] or 0:9.1f} "
+            f"{entry['peak_rss_mb']:9.0f} {read / 1e6:9.1f} {written / 1e6:9.1f}"
+        )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on a synthetic campaign")
+    parser.add_argument("--sondes", type=int, nargs="+", default=[100], help="sonde counts, e.g. 100 1000 10000")
+    parser.add_argument("--sondes-per-flight", type=int, default=80)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="where the campaigns are generated (kept); temporary if not given")
+    parser.add_argument("--json", default=None, help="write all reports to this file")
+    args = parser.parse_args()
+
+    instrumentation.enable()
+
+    templates = synthetic_campaign.load_templates()
+
+    reports = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        root = args.dir if args.dir is not None else tmp
+
+        for n_sondes in args.sondes:
+            report = bench(n_sondes, args.workers, args.sondes_per_flight, templates, root)
+            print_report(report)
+            reports.append(report)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
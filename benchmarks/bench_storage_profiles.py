@@ -0,0 +1,144 @@
+# Benchmark of the storage profiles of src/processing/storage.py on the sample data
+#
+# All sample Level-1 sondes are concatenated into one dataset (or a given file, e.g.
+# a Level-3 product, is loaded), which is written and read back with the compression
+# of every profile. Reported per profile: write and read throughput of the
+# uncompressed data (MB/s), file size and compression ratio.
+#
+# run from the repository root:
+#     python benchmarks/bench_storage_profiles.py --repeat 3 --zarr
+#     python benchmarks/bench_storage_profiles.py --file extra/Sample_Data/20200122/HALO/Level_3/<file>.nc
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src", "processing"))
+
+import storage
+
+sample_dir = "extra/Sample_Data/20200122/HALO/Level_1/"
+
+
+def sample_dataset(directory=sample_dir):
+    """
+    Float variables of all sample Level-1 sondes along one `obs` dimension, as float32
+    like the Level-2 files
+    """
+    datasets = []
+
+    for path in sorted(glob.glob(directory + "*.nc")):
+        with xr.open_dataset(path) as ds:
+            variables = [var for var in ds.data_vars if ds[var].dims == ("time",) and ds[var].dtype.kind == "f"]
+            datasets.append(ds[variables].reset_coords(drop=True).drop_vars("time").load())
+
+    dataset = xr.concat(datasets, dim="time", data_vars="minimal", coords="minimal", compat="override")
+
+    return dataset.rename({"time": "obs"}).astype("float32")
+
+
+def load_file(path):
+    with xr.open_dataset(path) as ds:
+        return ds.load()
+
+
+def size_of(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def bench_profile(dataset, profile, save_path, zarr=False, repeat=3):
+
+    """
+    Best of `repeat` write and read (open and load all variables) times of the
+    dataset with the compression of `profile`
+    """
+
+    comp = storage.encoding(profile, zarr=zarr)
+    encoding = {var: dict(comp) for var in dataset.data_vars if dataset[var].dtype.kind == "f"}
+
+    write_s, read_s = [], []
+
+    for _ in range(repeat):
+
+        if os.path.isdir(save_path):
+            shutil.rmtree(save_path)
+
+        start = time.perf_counter()
+        if zarr:
+            dataset.to_zarr(save_path, mode="w", encoding=encoding)
+        else:
+            dataset.to_netcdf(save_path, mode="w", format="NETCDF4", encoding=encoding)
+        write_s.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with (xr.open_zarr(save_path) if zarr else xr.open_dataset(save_path)) as ds:
+            ds.load()
+        read_s.append(time.perf_counter() - start)
+
+    size = size_of(save_path)
+    raw = dataset.nbytes
+
+    return {
+        "profile": profile,
+        "format": "zarr" if zarr else "netcdf",
+        "raw_mb": raw / 1e6,
+        "file_mb": size / 1e6,
+        "ratio": raw / size,
+        "write_mb_s": raw / 1e6 / min(write_s),
+        "read_mb_s": raw / 1e6 / min(read_s),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the storage profiles on the sample data")
+    parser.add_argument("--file", default=None, help="NetCDF file to benchmark instead of the sample Level-1 sondes")
+    parser.add_argument("--profiles", nargs="+", default=list(storage.profiles), choices=list(storage.profiles))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--zarr", action="store_true", help="also benchmark the Zarr compressors")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    dataset = load_file(args.file) if args.file is not None else sample_dataset()
+
+    print(f"{len(dataset.data_vars)} variables, {dataset.nbytes / 1e6:.1f} MB uncompressed")
+    print(f"{'profile':<9} {'format':<7} {'file MB':>8} {'ratio':>6} {'write MB/s':>11} {'read MB/s':>10}")
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        for zarr in [False, True] if args.zarr else [False]:
+            for profile in args.profiles:
+
+                result = bench_profile(
+                    dataset,
+                    profile,
+                    os.path.join(tmp, f"{profile}.zarr" if zarr else f"{profile}.nc"),
+                    zarr=zarr,
+                    repeat=args.repeat,
+                )
+                results.append(result)
+
+                print(
+                    f"{profile:<9} {result['format']:<7} {result['file_mb']:8.2f} {result['ratio']:6.2f} "
+                    f"{result['write_mb_s']:11.1f} {result['read_mb_s']:10.1f}"
+                )
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
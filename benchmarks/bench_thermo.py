@@ -0,0 +1,81 @@
+# Benchmark of functions/thermo_kernel.py against functions/thermo.py on Level-3-sized arrays
+#
+# run from the repository root:
+#     python benchmarks/bench_thermo.py --sondes 3000 --levels 1001
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from functions import thermo as th
+from functions import thermo_kernel as tk
+
+
+def level_3_like(n_sondes, n_levels, dtype="float64", seed=0):
+    """
+    Synthetic (sonde_id, alt) fields with a tropical-like profile plus noise
+    """
+    rng = np.random.default_rng(seed)
+    alt = np.arange(n_levels) * 10.0
+
+    T = 300.0 - 6.5e-3 * alt + rng.normal(0, 0.5, (n_sondes, n_levels))
+    p = 101500.0 * np.exp(-alt / 8400.0) + rng.normal(0, 50, (n_sondes, n_levels))
+    q = 0.017 * np.exp(-alt / 2500.0) * rng.uniform(0.8, 1.0, (n_sondes, n_levels))
+    z = np.broadcast_to(alt, (n_sondes, n_levels))
+
+    return [np.ascontiguousarray(i, dtype=dtype) for i in (T, p, q, z)]
+
+
+def time_it(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sondes", type=int, default=3000)
+    parser.add_argument("--levels", type=int, default=1001)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.sondes} sondes x {args.levels} levels, best of {args.repeat}")
+    print(f"numba available: {tk.numba_available}\n")
+    print(f"{'function':<12}{'dtype':<10}{'thermo [ms]':>14}{'kernel [ms]':>14}{'speed-up':>10}")
+
+    for dtype in ["float64", "float32"]:
+
+        T, p, q, z = level_3_like(args.sondes, args.levels, dtype=dtype)
+        out = np.empty_like(T)
+
+        cases = [
+            ("es", lambda: th.eslf(T), lambda: tk.es(T, out=out)),
+            ("q_sat", lambda: th.q_sat(T, p), lambda: tk.q_sat(T, p, out=out)),
+            ("latent", lambda: th.latent_enthalpy(T), lambda: tk.latent_heat(T, out=out)),
+            ("dse", lambda: th.calc_dse(T, q, z), lambda: tk.dse(T, q, z, out=out)),
+            ("mse", lambda: th.calc_mse(T, q, z), lambda: tk.mse(T, q, z, out=out)),
+        ]
+
+        for name, legacy, kernel in cases:
+            kernel()
+            # first call compiles the numba ufuncs
+            t_legacy = time_it(legacy, args.repeat) * 1e3
+            t_kernel = time_it(kernel, args.repeat) * 1e3
+            print(
+                f"{name:<12}{dtype:<10}{t_legacy:>14.1f}{t_kernel:>14.1f}{t_legacy / t_kernel:>9.1f}x"
+            )
+
+    T, p, q, z = level_3_like(100, args.levels)
+    print("\nmax relative difference to thermo.py (float64):")
+    print(f"  es   {np.max(np.abs(tk.es(T) / (th.eslf(T) * 100) - 1)):.2e}"
+          "  (thermo.eslf drops the last Goff-Gratch term)")
+    print(f"  mse  {np.max(np.abs(tk.mse(T, q, z) / th.calc_mse(T, q, z) - 1)):.2e}")
+    print(f"  dse  {np.max(np.abs(tk.dse(T, q, z) / th.calc_dse(T, q, z) - 1)):.2e}")
+
+
+if __name__ == "__main__":
+    main()
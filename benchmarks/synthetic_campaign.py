@@ -0,0 +1,277 @@
+# Synthetic campaign generator: ASPEN-style Level-1 files and A-files for any number of sondes
+#
+# Every synthetic sonde is a copy of one of the sample sondes (extra/Sample_Data/20200122/HALO)
+# with a new launch time and sonde serial, and perturbed temperature, humidity, winds and
+# positions, so that the files have exactly the layout, attributes and fill values
+# that ASPEN writes and the QC/Level-2 code reads.
+#
+# run from the repository root:
+#     python benchmarks/synthetic_campaign.py --sondes 1000 --out /tmp/synthetic_campaign
+
+import argparse
+import datetime
+import glob
+import os
+import re
+
+import numpy as np
+import xarray as xr
+
+template_dir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "extra", "Sample_Data", "20200122", "HALO"
+)
+
+fill_value = -999.0
+
+_timestamp = re.compile(
+    r"(?P<datetime>\d{4}-\d{2}-\d{2},? \d{2}:\d{2}:\d{2})"
+    r"|(?P<stamp>\d{8}_\d{6})"
+    r"|(?P<lv>\b3\d{9}(?=\.\d))"  # A-file "LV sec": seconds since 1904
+    r"|(?P<date>\b\d{8}\b)"
+    r"|(?P<clock>\b\d{2}:\d{2}:\d{2}\b)"
+)
+
+
+def shift_timestamps(text, template_time, delta):
+    """
+    Shift every date/time in `text` (A-file lines, netCDF attributes and units) by
+    `delta`; stand-alone dates are only replaced if they are the template's date
+    """
+
+    template_date = template_time.strftime("%Y%m%d")
+
+    def replace(match):
+
+        kind = match.lastgroup
+        value = match.group()
+
+        if kind == "datetime":
+            fmt = "%Y-%m-%d, %H:%M:%S" if "," in value else "%Y-%m-%d %H:%M:%S"
+            return (datetime.datetime.strptime(value, fmt) + delta).strftime(fmt)
+        if kind == "stamp":
+            return (datetime.datetime.strptime(value, "%Y%m%d_%H%M%S") + delta).strftime("%Y%m%d_%H%M%S")
+        if kind == "lv":
+            return str(int(value) + int(delta.total_seconds()))
+        if kind == "date":
+            return (template_time + delta).strftime("%Y%m%d") if value == template_date else value
+
+        clock = datetime.datetime.combine(
+            template_time.date(), datetime.datetime.strptime(value, "%H:%M:%S").time()
+        )
+        return (clock + delta).strftime("%H:%M:%S")
+
+    return _timestamp.sub(replace, text)
+
+
+class SondeTemplate:
+
+    """
+    One sample sonde: its Level-1 dataset (undecoded, with the -999 fill values),
+    its A-file text, launch time and sonde serial number
+    """
+
+    def __init__(self, sonde_path, a_path):
+
+        self.name_suffix = os.path.basename(sonde_path)[16:]
+        # e.g. "QC.nc" after "DYYYYMMDD_HHMMSS"
+        self.a_suffix = os.path.basename(a_path)[16:]
+        # e.g. ".3" after "AYYYYMMDD_HHMMSS"
+
+        self.launch_time = datetime.datetime.strptime(
+            os.path.basename(sonde_path)[1:16], "%Y%m%d_%H%M%S"
+        )
+
+        with xr.open_dataset(sonde_path, decode_times=False, mask_and_scale=False) as ds:
+            self.dataset = ds.load()
+
+        with open(a_path) as f:
+            self.a_text = f.read()
+
+        serial = re.search(r"Sonde ID/Type/Rev/Built/Sensors:\s*(\d+)", self.a_text)
+        self.serial = serial.group(1) if serial else None
+
+
+def load_templates(directory=template_dir):
+
+    """
+    Templates of all sample sondes that have an A-file
+    """
+
+    templates = []
+
+    for sonde_path in sorted(glob.glob(os.path.join(directory, "Level_1", "D*.nc"))):
+        stamp = os.path.basename(sonde_path)[1:16]
+        a_paths = sorted(glob.glob(os.path.join(directory, "Level_0", f"A{stamp}*")))
+        if len(a_paths) > 0:
+            templates.append(SondeTemplate(sonde_path, a_paths[0]))
+
+    if len(templates) == 0:
+        raise FileNotFoundError(f"No sample sondes with A-files found in {directory}")
+
+    return templates
+
+
+def _valid(values):
+    return values != fill_value
+
+
+def perturb(ds, rng):
+
+    """
+    Perturb the measurements of a Level-1 dataset in place, keeping fill values:
+    temperature offset, relative humidity scaling, wind offsets and a shifted
+    launch position; wind speed and direction are recomputed from the winds
+    """
+
+    def add(var, offset):
+        values = ds[var].values
+        valid = _valid(values)
+        values[valid] = values[valid] + np.asarray(offset, dtype=values.dtype)
+        return valid
+
+    add("tdry", rng.normal(0, 0.5))
+    add("lat", rng.normal(0, 0.5))
+    add("lon", rng.normal(0, 0.5))
+
+    rh = ds["rh"].values
+    valid = _valid(rh)
+    rh[valid] = np.clip(rh[valid] * rng.uniform(0.9, 1.1), 0, 100)
+
+    u_valid = add("u_wind", rng.normal(0, 1.0))
+    v_valid = add("v_wind", rng.normal(0, 1.0))
+
+    u, v = ds["u_wind"].values, ds["v_wind"].values
+    both = u_valid & v_valid
+
+    for var, values in [
+        ("wspd", np.hypot(u[both], v[both])),
+        ("wdir", np.mod(np.degrees(np.arctan2(-u[both], -v[both])), 360)),
+    ]:
+        if var in ds:
+            target = ds[var].values
+            target[both & _valid(target)] = values[_valid(target)[both]]
+
+    return ds
+
+
+def write_sonde(template, launch_time, serial, platform_dir, rng):
+
+    """
+    Write the Level-1 file and A-file of one synthetic sonde launched at `launch_time`
+    Output :
+        (Level-1 path, A-file path)
+    """
+
+    delta = launch_time - template.launch_time
+    stamp = launch_time.strftime("%Y%m%d_%H%M%S")
+
+    def shift(text):
+        text = shift_timestamps(text, template.launch_time, delta)
+        if template.serial is not None:
+            text = text.replace(template.serial, serial)
+        return text
+
+    ds = perturb(template.dataset.copy(deep=True), rng)
+
+    ds.attrs = {k: shift(v) if isinstance(v, str) else v for k, v in ds.attrs.items()}
+
+    for var in ds.variables:
+        ds[var].attrs = {
+            k: shift(v) if isinstance(v, str) else v for k, v in ds[var].attrs.items()
+        }
+        # among others, the "seconds since <launch time>" units of time and launch_time
+
+    sonde_path = os.path.join(platform_dir, "Level_1", f"D{stamp}{template.name_suffix}")
+    a_path = os.path.join(platform_dir, "Level_0", f"A{stamp}{template.a_suffix}")
+
+    ds.to_netcdf(sonde_path, format="NETCDF3_CLASSIC")
+    # ASPEN writes classic netCDF
+
+    with open(a_path, "w") as f:
+        f.write(shift(template.a_text))
+
+    return sonde_path, a_path
+
+
+def generate_campaign(
+    root,
+    n_sondes,
+    sondes_per_flight=80,
+    platform="HALO",
+    spacing=150,
+    seed=0,
+    templates=None,
+):
+
+    """
+    Input :
+        root : string
+               campaign directory to create; one flight directory per day,
+               {root}/{YYYYMMDD}/{platform}/ with Level_0/ and Level_1/
+        n_sondes : int
+                   total number of sondes
+        sondes_per_flight : int
+                            sondes per flight directory
+        spacing : float
+                  seconds between two launches within a flight
+        seed : int
+               seed of the random perturbations; the same seed gives the same campaign
+    Output :
+        list of platform directories (with trailing '/')
+    """
+
+    if templates is None:
+        templates = load_templates()
+
+    rng = np.random.default_rng(seed)
+
+    first_launch = min(t.launch_time for t in templates)
+    platform_dirs = []
+
+    for i in range(n_sondes):
+
+        flight, number = divmod(i, sondes_per_flight)
+
+        launch_time = (
+            first_launch
+            + datetime.timedelta(days=flight)
+            + datetime.timedelta(seconds=number * spacing)
+        )
+
+        platform_dir = os.path.join(root, launch_time.strftime("%Y%m%d"), platform, "")
+
+        if number == 0:
+            for sub in ["Level_0", "Level_1"]:
+                os.makedirs(platform_dir + sub, exist_ok=True)
+            platform_dirs.append(platform_dir)
+
+        write_sonde(
+            templates[i % len(templates)], launch_time, str(900000000 + i), platform_dir, rng
+        )
+
+    return platform_dirs
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic dropsonde campaign")
+    parser.add_argument("--sondes", type=int, default=100)
+    parser.add_argument("--sondes-per-flight", type=int, default=80)
+    parser.add_argument("--platform", default="HALO")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True, help="campaign directory to create")
+    args = parser.parse_args()
+
+    platform_dirs = generate_campaign(
+        args.out,
+        args.sondes,
+        sondes_per_flight=args.sondes_per_flight,
+        platform=args.platform,
+        seed=args.seed,
+    )
+
+    print(f"{args.sondes} sondes in {len(platform_dirs)} flight directories below {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,17 +9,16 @@ def plot_mean(ds,var,ax=None,low_alt=0,high_alt=8000,dim='circle',c='k',label=''
     return ax
 
 def iqr(ds,var,low_alt=0,high_alt=8000,dim='circle'):
-        
-    lowq = ds.sel(alt=slice(low_alt,high_alt))[var].quantile(0.25,dim=dim)
-    highq = ds.sel(alt=slice(low_alt,high_alt))[var].quantile(0.75,dim=dim)
     
-    return lowq, highq
+    # both quartiles in a single quantile reduction
+    q = ds[var].sel(alt=slice(low_alt,high_alt)).quantile([0.25,0.75],dim=dim)
+    
+    return q.isel(quantile=0), q.isel(quantile=1)
 
 def plot_iqr(ds,var,ax=None,low_alt=0,high_alt=8000,dim='circle',c='grey',label=''):
     
-    alt = ds.alt.sel(alt=slice(low_alt,high_alt))
-    
     lowq, highq = iqr(ds,var,low_alt,high_alt,dim=dim)
+    alt = lowq.alt
     
     if ax is not None :
         ax.fill_betweenx(alt,lowq,highq,alpha=0.5,color=c,label=label)
@@ -33,7 +33,7 @@ def eslf(T, formula="goff-gratch", ice_phase=False):
     if formula == "flatau":
         if np.min(x) > 100:
           x = x-273.16
-        x[x < -80.] = -80.
+        x = np.maximum(x, -80.)   # not in place, the input array is left unchanged
         c_es= np.asarray([0.6105851e+03, 0.4440316e+02, 0.1430341e+01, 0.2641412e-01,
                            0.2995057e-03,0.2031998e-05,0.6936113e-08,0.2564861e-11,-0.3704404e-13])
         es = np.polyval(c_es[::-1],x)/100.
@@ -71,8 +71,6 @@ def latent_enthalpy(Tx, ice_phase=False):
 #   >>> latent_enthalpy(273.15)
 #   2500.8e3
 #   """
-    import numpy as np
-
     x = np.asarray(Tx)
     if np.max(x) < 100:
         x = x+273.15
@@ -108,7 +106,6 @@ def calc_pp_from_mr(p,mr):
 
 def calc_mse(T,Q,Z):                  # moist static energy from temperature, mixing ratio and altitude
 
-    import numpy as np
     lv  = latent_enthalpy(T)
     cp  = cpd + (cpv-cpd)*Q
     mse = cp*T + lv*Q + gravity*np.array(Z)
@@ -116,7 +113,6 @@ def calc_mse(T,Q,Z):                  # moist static energy from temperature, mi
 
 def calc_dse(T,Q,Z):                  # dry static energy from temperature, mixing ratio and altitude
 
-    import numpy as np
     cp  = cpd + (cpv-cpd)*Q
     dse = cp*T + gravity*np.array(Z)
     return(dse)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized thermodynamics kernel for gridded (sonde x level) arrays
+
+Counterpart of thermo.py with explicit units instead of guessing them from the data:
+temperature in K, pressure in Pa, specific humidity in kg/kg, altitude in m.
+Every function writes its result into the optional `out` array (allocated if not
+given) and works in place on it; the intermediate terms of a formula are kept in at
+most two scratch arrays of the same shape, rather than one temporary per operation.
+float32 input stays float32.
+If numba is installed, the saturation vapour pressures are compiled ufuncs.
+"""
+#
+
+import math
+
+import numpy as np
+
+from .thermo import Rd, Rv, cpd, cpv, cpl, cpi, lv0, lf0, gravity
+
+eps_q = Rd / Rv
+# ratio of the gas constants, for specific humidity
+
+_log10_es_steam = math.log10(1013.246)
+_log10_es_ice_point = math.log10(6.1071)
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+numba_available = numba is not None
+
+
+def _result(T, out):
+    if out is None:
+        return np.empty(np.shape(T), dtype=np.result_type(T, np.float32))
+    return out
+
+
+###----- Saturation vapour pressure (Goff-Gratch) -----###
+
+def _es_liquid_numpy(T, out=None):
+    out = _result(T, out)
+    x2 = np.divide(373.16, T, out=out)
+    # log10(es) = log10(1013.246) - 7.90298 (x2 - 1) + 5.02808 log10(x2)
+    #             - 1.3816e-7 (10^(11.344 (1 - 1/x2)) - 1) + 8.1328e-3 (10^(-3.49149 (x2 - 1)) - 1)
+    a = np.divide(1.0, x2)
+    np.subtract(1.0, a, out=a)
+    a *= 11.344
+    np.power(10.0, a, out=a)
+    a -= 1.0
+    a *= -1.3816e-7
+    b = np.subtract(x2, 1.0)
+    b *= -3.49149
+    np.power(10.0, b, out=b)
+    b -= 1.0
+    b *= 8.1328e-3
+    a += b
+    np.log10(x2, out=b)
+    b *= 5.02808
+    a += b
+    x2 -= 1.0
+    x2 *= -7.90298
+    x2 += _log10_es_steam
+    x2 += a
+    np.power(10.0, x2, out=x2)
+    x2 *= 100.0
+    return x2
+
+
+def _es_ice_numpy(T, out=None):
+    out = _result(T, out)
+    x1 = np.divide(273.16, T, out=out)
+    # log10(es) = log10(6.1071) - 9.09718 (x1 - 1) - 3.56654 log10(x1) + 0.876793 (1 - 1/x1)
+    d = np.divide(1.0, x1)
+    np.subtract(1.0, d, out=d)
+    d *= 0.876793
+    c = np.log10(x1)
+    c *= -3.56654
+    d += c
+    x1 -= 1.0
+    x1 *= -9.09718
+    x1 += _log10_es_ice_point
+    x1 += d
+    np.power(10.0, x1, out=x1)
+    x1 *= 100.0
+    return x1
+
+
+def _es_liquid_scalar(T):
+    x2 = 373.16 / T
+    log_es = (
+        _log10_es_steam
+        - 7.90298 * (x2 - 1.0)
+        + 5.02808 * math.log10(x2)
+        - 1.3816e-7 * (10.0 ** (11.344 * (1.0 - 1.0 / x2)) - 1.0)
+        + 8.1328e-3 * (10.0 ** (-3.49149 * (x2 - 1.0)) - 1.0)
+    )
+    return 100.0 * 10.0 ** log_es
+
+
+def _es_ice_scalar(T):
+    x1 = 273.16 / T
+    log_es = (
+        _log10_es_ice_point
+        - 9.09718 * (x1 - 1.0)
+        - 3.56654 * math.log10(x1)
+        + 0.876793 * (1.0 - 1.0 / x1)
+    )
+    return 100.0 * 10.0 ** log_es
+
+
+if numba_available:
+    _signatures = ["float32(float32)", "float64(float64)"]
+    _es_liquid_ufunc = numba.vectorize(_signatures, cache=True)(_es_liquid_scalar)
+    _es_ice_ufunc = numba.vectorize(_signatures, cache=True)(_es_ice_scalar)
+else:
+    _es_liquid_ufunc = None
+    _es_ice_ufunc = None
+
+
+def es_liquid(T, out=None, use_numba=True):
+    """ Saturation vapour pressure [Pa] over liquid water (Goff-Gratch) for T in K.
+    Unlike thermo.eslf, the last term of the formula is included (it is dropped there
+    by a line break), which raises es by up to ~2% near freezing.
+    """
+    if use_numba and _es_liquid_ufunc is not None:
+        return _es_liquid_ufunc(T, out=_result(T, out))
+    return _es_liquid_numpy(T, out)
+
+
+def es_ice(T, out=None, use_numba=True):
+    """ Saturation vapour pressure [Pa] over ice (Goff-Gratch) for T in K
+    """
+    if use_numba and _es_ice_ufunc is not None:
+        return _es_ice_ufunc(T, out=_result(T, out))
+    return _es_ice_numpy(T, out)
+
+
+def es(T, ice_phase=False, out=None, use_numba=True):
+    """ Saturation vapour pressure [Pa] for T in K; with ice_phase, over ice below 273.15 K
+    """
+    out = es_liquid(T, out=out, use_numba=use_numba)
+    if ice_phase:
+        cold = np.less(T, 273.15)
+        if cold.any():
+            out[cold] = es_ice(np.asarray(T)[cold], use_numba=use_numba)
+    return out
+
+
+###----- Humidity and enthalpies -----###
+
+def q_sat(T, p, ice_phase=True, out=None, use_numba=True):
+    """ Saturation specific humidity [kg/kg] for T in K and p in Pa,
+    q = eps e / (p - (1 - eps) e) with eps = Rd/Rv
+    """
+    e = es(T, ice_phase=ice_phase, out=out, use_numba=use_numba)
+    denominator = np.multiply(e, -(1.0 - eps_q))
+    denominator += p
+    e *= eps_q
+    e /= denominator
+    return e
+
+
+def latent_heat(T, ice_phase=False, out=None):
+    """ Latent enthalpy [J/kg] of vaporisation for T in K; with ice_phase, of
+    sublimation below 273.15 K
+    """
+    out = _result(T, out)
+    np.subtract(T, 273.15, out=out)
+    if ice_phase:
+        cold = np.less(out, 0.0)
+        sub = out[cold] * (cpv - cpi) + (lv0 + lf0)
+    out *= cpv - cpl
+    out += lv0
+    if ice_phase:
+        out[cold] = sub
+    return out
+
+
+def cp(q, out=None):
+    """ Isobaric specific heat [J/kg/K] of moist air
+    """
+    out = _result(q, out)
+    np.multiply(q, cpv - cpd, out=out)
+    out += cpd
+    return out
+
+
+def dse(T, q, z, out=None):
+    """ Dry static energy [J/kg], cp T + g z
+    """
+    out = cp(q, out=out)
+    out *= T
+    out += np.multiply(z, gravity, dtype=out.dtype)
+    return out
+
+
+def mse(T, q, z, out=None):
+    """ Moist static energy [J/kg], cp T + L q + g z
+    """
+    out = dse(T, q, z, out=out)
+    Lq = latent_heat(T)
+    Lq *= q
+    out += Lq
+    return out
+
+
+def mse_sat(T, p, z, out=None, use_numba=True):
+    """ Saturated moist static energy [J/kg], the moist static energy at q = q_sat(T, p)
+    """
+    qs = q_sat(T, p, use_numba=use_numba)
+    return mse(T, qs, z, out=out)
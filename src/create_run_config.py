@@ -2,10 +2,30 @@ import configparser
 
 config = configparser.ConfigParser()
 
-config['DEFAULT'] = {'directory': '../extra/Sample_Data/20200122/',
+config['DEFAULT'] = {'directory': 'extra/Sample_Data/20200122/',
+                     # relative to the repository root, where the processing is run from
                      'aspen_suffix': '*QC.nc',
                      'run_levels': '4',
                      'flight_segmentation_available': False,
+                     'workers': '1',
+                     'jobs': '1',
+                     'instrumentation': 'off',
+                     'qc_mode': 'batch',
+                     'level_2_store': 'none',
+                     'level_2_writer': 'netcdf4',
+                     'level_3_engine': 'sonde',
+                     'height_limit': '10000',
+                     'vertical_spacing': '10',
+                     'level_3_format': 'netcdf',
+                     'level_3_chunk_sondes': '64',
+                     'catalog_max_open': '8',
+                     'storage_profile': 'default',
+                     # compression of all written files: none, fast, default or archive
+                     # (see src/processing/storage.py)
+                     'prefetch_depth': '4',
+                     'io_threads': '2',
+                     # sondes read ahead (0: off) and reading threads when the Level-2
+                     # and Level-3 stages run in a single process (see src/processing/prefetch.py)
                     }
 
 config['flight_segmentation'] = {}
@@ -13,7 +33,21 @@ config['flight_segmentation'] = {}
 fs = config['flight_segmentation']
 fs['directory'] = ''
 
-config['quicklooks'] = {'mode': 'on'}
+config['platforms'] = {}
+# `directory name = platform` for platform directories not named after their
+# platform (HALO or P3, see src/processing/platforms.py)
+
+config['circles'] = {}
+# one option per circle, `circle_id = start, end` with ISO timestamps;
+# used by Level-4 if no flight segmentation is available
+
+config['quicklooks'] = {'mode': 'on',
+                        'variables': 'ta, rh, q, u, v, p',
+                        # Level-3 or derived variables, one panel each
+                        'low_alt': '0',
+                        'high_alt': '8000',
+                        'dpi': '100',
+                       }
 
 with open('../run_config.cfg', 'w') as configfile:
     config.write(configfile)
\ No newline at end of file
@@ -9,61 +9,228 @@ import warnings
 import numpy as np
 import pandas as pd
 import xarray as xr
+from tqdm import tqdm
 
 import joanne
 from joanne.Level_2 import fn_2 as f2
 
-Platform = 'HALO'
-
-def get_all_sondes_list(data_dir='../extra/Sample_Data/20200122/HALO/'):
-
-    directory = f"{data_dir}Level_1/"
-    # directory where all sonde files are present
-
-    a_dir = f"{data_dir}Level_0/"
-    # directory where all the A files are present
-
-    qc_directory = f"{data_dir}QC/"
-    # directory to store logs and stats
+import build_cache
+import config
+import platforms
+from sonde_catalog import SondeCatalog
 
-    sonde_paths = sorted(glob.glob(directory + "*QC.nc"))
-    # paths to the individual sonde files
-
-    file_time_str = [None] * len(sonde_paths)
-    file_time = [None] * len(sonde_paths)
-    # list to store extracted sonde time from file name as string and as time
-
-    a_files = [None] * len(sonde_paths)
-    # list to store file names for the log files starting with A.
+Platform = 'HALO'
 
-    sonde_ds = [None] * len(sonde_paths)
-    # list to store individual datasets of all sondes from PQC files
+data_dir = 'extra/Sample_Data/20200122/HALO/'
 
-    for i in range(len(sonde_paths)):
-        file_time_str[i] = sonde_paths[i][-20:-5]
-        file_time[i] = np.datetime64(
-            pd.to_datetime(file_time_str[i], format="%Y%m%d_%H%M%S"), "s"
+def in_memory_store(sonde):
+    """
+    The sonde, read into memory, as an xarray in-memory store: joanne's tests that
+    take file paths open it with xr.open_dataset() like a file, so the Level-1
+    file is not read again
+    """
+    store = xr.backends.InMemoryDataStore()
+    sonde.load().dump_to_store(store)
+    return store
+
+def launch_summary(sonde):
+    """
+    Scalar variables (launch time and position) and attributes of a sonde, which
+    is what f2.add_sonde_id_to_status_ds() reads; kept instead of the whole
+    dataset so that the sonde IDs are assigned without opening the sondes again
+    """
+    return sonde[[var for var in sonde.variables if sonde[var].ndim == 0]].load()
+
+def get_status_row(sonde, ld_flag, file_time):
+
+    """
+    Input :
+        sonde : xarray dataset
+                Level-1 dataset of the sonde, read into memory if it is not yet
+        ld_flag : float
+                  launch-detect flag of the sonde (see launch_detect_flags)
+        file_time : np.datetime64
+                    sonde time extracted from the file name
+    Output :
+        status_row : xarray dataset
+                     status table with a single entry along `time`, holding the
+                     count sums, the launch-detect flag, the surface flags and launch time
+        list_of_variables : list
+                            variables of the count tests
+        srf_flag_vars : list
+                        names of the surface flag variables
+    Function to compute all per-sonde QC quantities of one sonde in one pass over
+    the dataset already in memory
+    """
+
+    sonde = sonde.load()
+
+    nc = f2.get_total_non_nan_indices(sonde)
+
+    (
+        list_of_variables,
+        s_time,
+        s_t,
+        s_rh,
+        s_p,
+        s_z,
+        s_u,
+        s_v,
+        s_alt,
+    ) = f2.get_var_count_sums([nc])
+
+    status_row = f2.init_status_ds(
+        list_of_variables,
+        s_time,
+        s_t,
+        s_rh,
+        s_p,
+        s_z,
+        s_u,
+        s_v,
+        s_alt,
+        [ld_flag],
+        [file_time],
+    )
+
+    status_row, srf_flag_vars = f2.add_srf_flags_to_statusds(status_row, [in_memory_store(sonde)])
+    status_row["launch_time"] = (["time"], pd.DatetimeIndex([sonde.launch_time.values]))
+
+    return status_row, list_of_variables, srf_flag_vars
+
+def get_ld_flags(a_dir, a_files, qc_directory, platform=Platform, logs=True):
+
+    """
+    Input :
+        a_dir : string
+                directory of the A-files (Level_0/)
+        a_files : list
+                  sonde timestamps "AYYYYMMDD_HHMMSS"
+        logs : bool
+               if True, joanne also writes its launch-detect logs to `qc_directory`
+    Output :
+        ld_FLAG : launch-detect flag of every sonde
+    The single launch-detect parser of the processing, shared by batch QC and the
+    live session (watch.py), so that both flag a sonde the same way
+    """
+
+    return f2.get_ld_flag_from_a_files(a_dir, a_files, qc_directory, platform, logs=logs)
+
+def launch_detect_flags(catalog, platform=Platform):
+
+    """
+    Input :
+        catalog : SondeCatalog
+    Output :
+        ld_FLAG : launch-detect flag of every sonde of the catalog
+    The flags are taken from joanne, which also writes its launch-detect logs to the
+    QC directory; the status table is only rebuilt when an A-file changes, so the
+    A-files are parsed once per QC run
+    """
+
+    return get_ld_flags(catalog.a_dir, catalog.a_files, catalog.qc_directory, platform, logs=True)
+
+def get_status_ds_streaming(catalog, platform=Platform):
+
+    """
+    Input :
+        catalog : SondeCatalog
+    Output :
+        status_ds, list_of_variables, srf_flag_vars
+        summaries : list
+                    launch_summary() of every sonde, for the sonde IDs
+    Function to build the status table by reading each Level-1 file once,
+    appending one row per sonde; only one sonde is held in memory at a time.
+    The launch-detect flags and logs are produced as in batch mode
+    """
+
+    ld_FLAG = launch_detect_flags(catalog, platform=platform)
+
+    rows = []
+    summaries = []
+
+    for i, sonde in enumerate(tqdm(catalog.iter_datasets(), total=len(catalog))):
+
+        sonde = sonde.load()
+
+        status_row, list_of_variables, srf_flag_vars = get_status_row(
+            sonde, ld_FLAG[i], catalog.file_time[i]
         )
-        a_files[i] = "A" + file_time_str[i]
-        sonde_ds[i] = xr.open_dataset(sonde_paths[i])
 
-    return sonde_ds, directory, a_dir, qc_directory, a_files, file_time, sonde_paths
-
-data_dir = 'extra/Sample_Data/20200122/HALO/'
-
-def run_qc(data_dir):
+        rows.append(status_row.load())
+        summaries.append(launch_summary(sonde))
+
+    status_ds = xr.concat(rows, dim="time")
+
+    return status_ds, list_of_variables, srf_flag_vars, summaries
+
+def get_the_status_flags(
+    status_ds, list_of_variables, srf_flag_vars, sonde_ds, platform=Platform
+):
+
+    """
+    Input :
+        status_ds : xarray dataset
+                    status table with count sums, launch-detect flag, surface flags and launch time
+        sonde_ds : sequence
+                   datasets of all sondes (lazy, or their launch_summary()), used to
+                   assign sonde IDs
+    Output :
+        to_save_ds : xarray dataset
+                     status table along sonde_id, ready to be saved
+    Function to aggregate the individual and surface tests into the final flags
+    """
+
+    status_ds, ind_flag_vars = f2.add_ind_flags_to_statusds(
+        status_ds, list_of_variables
+    )
+    status_ds, ind_FLAG = f2.get_the_ind_FLAG_to_statusds(status_ds, ind_flag_vars)
+    status_ds, srf_FLAG = f2.get_the_srf_FLAG_to_statusds(status_ds, srf_flag_vars)
+    status_ds = f2.get_the_FLAG(status_ds, ind_FLAG, srf_FLAG)
+    status_ds = f2.add_sonde_id_to_status_ds(platform, sonde_ds, status_ds)
+
+    to_save_ds = (
+        status_ds.swap_dims({"time": "sonde_id"}).reset_coords("time", drop=True)
+        # .sortby("launch_time")
+    )
+
+    to_save_ds = f2.rename_vars(to_save_ds)
+
+    return to_save_ds
+
+def run_qc(data_dir, manifest=None, streaming=None):
+
+    """
+    Input :
+        data_dir : string
+                   platform directory with Level_0/ and Level_1/ sub-directories
+        manifest : build_cache.BuildManifest
+                   opened from data_dir if None
+        streaming : bool
+                    if True, all per-sonde tests are done in a single pass over the
+                    sondes (see get_status_ds_streaming); read from the `qc_mode`
+                    option of run_config.cfg if None
+    Function to run the QC tests over all sondes and save the QC status file
+    """
+
+    if streaming is None:
+        streaming = config.get_option("qc_mode", fallback="batch") == "streaming"
 
 #     qc_directory = f"{data_dir}QC/"
 #     a_dir = f"{data_dir}Level_0/"
 
-    (sonde_ds,
-        directory,
-        a_dir,
-        qc_directory,
-        a_files,
-        file_time,
-        sonde_paths,
-    ) = get_all_sondes_list(data_dir)
+    catalog = SondeCatalog(data_dir)
+
+    platform = platforms.platform_from_directory(data_dir)
+
+    sonde_ds = catalog.datasets
+    # lazily opened datasets; only a bounded number of sondes is open at a time
+
+    a_dir = catalog.a_dir
+    qc_directory = catalog.qc_directory
+    a_files = catalog.a_files
+    file_time = catalog.file_time
+    sonde_paths = catalog.sonde_paths
 
     if os.path.exists(qc_directory):
         pass
@@ -74,21 +241,43 @@ def run_qc(data_dir):
             f"{qc_directory}Status_of_sondes_v{joanne.__version__}.nc"
         )
 
-    if os.path.exists(to_save_ds_filename):
+    if manifest is None:
+        manifest = build_cache.open_manifest(data_dir)
+
+    qc_key = manifest.key(
+        sonde_paths + [i for paths in catalog.a_filepaths for i in paths],
+        params={"platform": platform},
+    )
+    # the status table is built across all sondes (sonde IDs are assigned per flight),
+    # so it is rebuilt whenever any Level-1 file or A-file changes
+
+    qc_fresh = manifest.is_fresh("QC", "status", qc_key)
 
-        print(f"Status file of the current version exists.")
+    if qc_fresh:
+
+        print(f"Status file is up to date with its inputs.")
 
         to_save_ds = xr.open_dataset(to_save_ds_filename)
 
+    elif streaming:
+
+        print('Running QC tests (streaming)...')
+
+        status_ds, list_of_variables, srf_flag_vars, summaries = get_status_ds_streaming(
+            catalog, platform=platform
+        )
+
+        to_save_ds = get_the_status_flags(
+            status_ds, list_of_variables, srf_flag_vars, summaries, platform=platform
+        )
+        # sonde IDs from the launch summaries gathered in the same pass
+
     else:
 
         # Retrieving all non NaN index sums in to a list for all sondes
         list_nc = list(map(f2.get_total_non_nan_indices, sonde_ds))
 
-        launch_time = [None] * len(sonde_ds)
-
-        for i in range(len(sonde_ds)):
-            launch_time[i] = sonde_ds[i].launch_time.values
+        launch_time = catalog.launch_times
 
         print('Running QC tests...')
 
@@ -104,7 +293,7 @@ def run_qc(data_dir):
             s_alt,
         ) = f2.get_var_count_sums(list_nc)
 
-        ld_FLAG = f2.get_ld_flag_from_a_files(a_dir, a_files, qc_directory, Platform, logs=True)
+        ld_FLAG = launch_detect_flags(catalog, platform=platform)
 
         status_ds = f2.init_status_ds(
             list_of_variables,
@@ -120,28 +309,25 @@ def run_qc(data_dir):
             file_time,
         )
 
-        status_ds, ind_flag_vars = f2.add_ind_flags_to_statusds(
-            status_ds, list_of_variables
-        )
         status_ds, srf_flag_vars = f2.add_srf_flags_to_statusds(status_ds, sonde_paths)
-        status_ds, ind_FLAG = f2.get_the_ind_FLAG_to_statusds(status_ds, ind_flag_vars)
-        status_ds, srf_FLAG = f2.get_the_srf_FLAG_to_statusds(status_ds, srf_flag_vars)
-        status_ds = f2.get_the_FLAG(status_ds, ind_FLAG, srf_FLAG)
         status_ds["launch_time"] = (["time"], pd.DatetimeIndex(launch_time))
-        status_ds = f2.add_sonde_id_to_status_ds(Platform, sonde_ds, status_ds)
-
-        print('Saving QC status file...')
 
-        to_save_ds = (
-            status_ds.swap_dims({"time": "sonde_id"}).reset_coords("time", drop=True)
-            # .sortby("launch_time")
+        to_save_ds = get_the_status_flags(
+            status_ds, list_of_variables, srf_flag_vars, sonde_ds, platform=platform
         )
 
-        to_save_ds = f2.rename_vars(to_save_ds)
+    if not qc_fresh:
+
+        print('Saving QC status file...')
 
         to_save_ds.to_netcdf(
             f"{qc_directory}Status_of_sondes_v{joanne.__version__}.nc"
         )
-        
+
+        manifest.record("QC", "status", qc_key, [to_save_ds_filename])
+        manifest.save()
+
+    catalog.close()
+
 if __name__ == '__main__':
-    run_qc()
\ No newline at end of file
+    run_qc(data_dir)
\ No newline at end of file
@@ -0,0 +1,335 @@
+# Python file to parse the A-files (Level_0) once and keep their contents in a cached table
+
+import datetime
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+import joanne
+from joanne.Level_2 import dicts
+
+index_name = f"A_file_index_v{joanne.__version__}.nc"
+# cached table, kept in the QC directory of the platform
+
+numeric_fields = {
+    "launch_detect": ("Launch Obs Done? (0,1)", "1"),
+    "aircraft_lon": ("Longitude (deg)", "degrees_east"),
+    "aircraft_lat": ("Latitude (deg)", "degrees_north"),
+    "aircraft_msl_alt": ("MSL Altitude (m)", "m"),
+    "aircraft_geopotential_alt": ("Geopotential Altitude (m)", "m"),
+    "aircraft_pressure": ("Air Pressure (mb)", "hPa"),
+    "aircraft_temperature": ("Air Temperature (C)", "degC"),
+    "aircraft_true_air_speed": ("True Air Speed (m/s)", "m s-1"),
+    "aircraft_ground_speed": ("Ground Speed (m/s)", "m s-1"),
+    "aircraft_heading": ("True Heading (deg)", "degree"),
+}
+# index variable -> (field of the A-file, units); the aircraft values are the launch obs
+
+time_fields = {
+    "launch_time": ("Launch Time (y,m,d,h,m,s)", "%Y-%m-%d, %H:%M:%S"),
+    "launch_detect_time": ("LAUNCH DETECT Time", "%Y-%m-%d %H:%M:%S.%f"),
+}
+
+string_fields = {
+    "sonde_serial": "Sonde ID$",
+    "project": "Project Name/Mission ID",
+    "software_version": "Software Version",
+}
+
+missing_value = -999.0
+
+
+def parse_a_file(a_filepath):
+
+    """
+    Input :
+        a_filepath : string
+                     path to an A-file
+    Output :
+        fields : dict
+                 every "key = value" and "key: value" line of the file, first occurrence
+                 of a key kept; section headers (***) and other lines are skipped
+    """
+
+    fields = {}
+
+    with open(a_filepath, errors="replace") as f:
+        for line in f:
+
+            line = line.strip()
+
+            if len(line) == 0 or line.startswith("***"):
+                continue
+
+            if " = " in line:
+                key, value = line.split(" = ", 1)
+            elif ":" in line:
+                key, value = line.split(":", 1)
+            else:
+                continue
+
+            fields.setdefault(key.strip(), value.strip())
+
+    return fields
+
+
+def _to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return np.nan if value == missing_value else value
+
+
+def _to_time(value, fmt):
+    if value is None:
+        return np.datetime64("NaT", "ns")
+    try:
+        value = datetime.datetime.strptime(value.split(" (")[0], fmt)
+    except ValueError:
+        return np.datetime64("NaT", "ns")
+    return np.datetime64(value, "ns")
+
+
+def _json_default(value):
+    # numpy scalars in the flight attributes keep their numeric type
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def a_file_record(a_filepath, stat=None):
+
+    """
+    Entry of the index for one A-file: the parsed launch-detect flag, launch obs
+    of the aircraft, times and metadata, the flight attributes of the Level-2
+    files (dicts.get_flight_attrs) as JSON, and the size and modification
+    time the entry was parsed from
+    """
+
+    if stat is None:
+        stat = os.stat(a_filepath)
+
+    fields = parse_a_file(a_filepath)
+
+    record = {
+        "path": a_filepath,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+    for var, (field, _) in numeric_fields.items():
+        record[var] = _to_float(fields.get(field))
+
+    for var, (field, fmt) in time_fields.items():
+        record[var] = _to_time(fields.get(field), fmt)
+
+    for var, field in string_fields.items():
+        record[var] = fields.get(field, "")
+
+    record["flight_attrs"] = json.dumps(
+        dict(dicts.get_flight_attrs(a_filepath)), default=_json_default
+    )
+
+    return record
+
+
+class AFileIndex:
+
+    """
+    Table of the contents of all A-files of a platform directory
+
+    Input :
+        data_dir : string
+                   platform directory with the Level_0/ sub-directory
+
+    The table is keyed by A-file name; the first 16 characters of the name
+    ("AYYYYMMDD_HHMMSS") are the sonde timestamp shared with the Level-1 file.
+    It is cached as NetCDF in the QC directory, and refresh() only parses the
+    A-files that are new or whose size or modification time changed, so the
+    text logs are read once, however many stages use them.
+    """
+
+    def __init__(self, data_dir):
+
+        self.a_dir = f"{data_dir}Level_0/"
+        self.path = f"{data_dir}QC/{index_name}"
+
+        self.records = {}
+        self.changed = False
+
+        if os.path.exists(self.path):
+            with xr.open_dataset(self.path) as ds:
+                self.records = _records_from_dataset(ds.load())
+
+        self._by_stamp = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def refresh(self):
+
+        """
+        Parse new and modified A-files and drop the entries of removed ones,
+        from a single listing of Level_0/
+        """
+
+        listing = {}
+
+        if os.path.isdir(self.a_dir):
+            with os.scandir(self.a_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.startswith("A"):
+                        listing[entry.name] = entry.stat()
+
+        for name in list(self.records):
+            if name not in listing:
+                del self.records[name]
+                self.changed = True
+
+        for name, stat in sorted(listing.items()):
+
+            record = self.records.get(name)
+
+            if (
+                record is not None
+                and record["size"] == stat.st_size
+                and record["mtime_ns"] == stat.st_mtime_ns
+            ):
+                continue
+
+            self.records[name] = a_file_record(self.a_dir + name, stat)
+            self.changed = True
+
+        self._by_stamp = None
+
+        return self
+
+    def save(self):
+
+        """
+        Write the table atomically, if anything changed since it was read
+        """
+
+        if not self.changed:
+            return self.path
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        tmp_path = self.path + ".tmp"
+        self.to_dataset().to_netcdf(tmp_path)
+        os.replace(tmp_path, self.path)
+
+        self.changed = False
+
+        return self.path
+
+    ###----- Lookups by sonde timestamp -----###
+
+    @property
+    def by_stamp(self):
+        """
+        "AYYYYMMDD_HHMMSS" -> sorted A-file names of that sonde
+        """
+        if self._by_stamp is None:
+            self._by_stamp = {}
+            for name in sorted(self.records):
+                self._by_stamp.setdefault(name[:16], []).append(name)
+        return self._by_stamp
+
+    def get(self, a_file):
+        """
+        Entry of the (first) A-file of a sonde, a_file being "AYYYYMMDD_HHMMSS";
+        raises KeyError if the sonde has no A-file
+        """
+        names = self.by_stamp.get(a_file[:16])
+
+        if not names:
+            raise KeyError(f"No A-file for {a_file} in {self.a_dir}")
+
+        return self.records[names[0]]
+
+    def a_filepaths(self, a_file):
+        return [self.a_dir + name for name in self.by_stamp.get(a_file[:16], [])]
+
+    def flight_attrs(self, a_file):
+        """
+        Flight attributes of the Level-2 file, as given by dicts.get_flight_attrs()
+        """
+        return json.loads(self.get(a_file)["flight_attrs"])
+
+    ###----- Table as dataset -----###
+
+    def to_dataset(self):
+
+        names = sorted(self.records)
+
+        def column(var):
+            return [self.records[name][var] for name in names]
+
+        data_vars = {
+            "path": (["a_file"], np.array(column("path"), dtype=str)),
+            "size": (["a_file"], np.array(column("size"), dtype="int64")),
+            "mtime_ns": (["a_file"], np.array(column("mtime_ns"), dtype="int64")),
+            "flight_attrs": (["a_file"], np.array(column("flight_attrs"), dtype=str)),
+        }
+
+        for var, (field, units) in numeric_fields.items():
+            data_vars[var] = (
+                ["a_file"],
+                np.array(column(var), dtype="float64"),
+                {"description": f"A-file field '{field}'", "units": units},
+            )
+
+        for var, (field, _) in time_fields.items():
+            data_vars[var] = (
+                ["a_file"],
+                np.array(column(var), dtype="datetime64[ns]"),
+                {"description": f"A-file field '{field}'"},
+            )
+
+        for var, field in string_fields.items():
+            data_vars[var] = (
+                ["a_file"],
+                np.array(column(var), dtype=str),
+                {"description": f"A-file field '{field}'"},
+            )
+
+        return xr.Dataset(data_vars, coords={"a_file": np.array(names, dtype=str)})
+
+
+def _records_from_dataset(ds):
+
+    columns = {var: ds[var].values for var in ds.data_vars}
+    names = [str(i) for i in ds.a_file.values]
+
+    records = {}
+
+    for n, name in enumerate(names):
+        record = {var: values[n] for var, values in columns.items()}
+        for var in ["path", "flight_attrs"] + list(string_fields):
+            record[var] = str(record[var])
+        for var in ["size", "mtime_ns"]:
+            record[var] = int(record[var])
+        records[name] = record
+
+    return records
+
+
+def open_a_file_index(data_dir):
+
+    """
+    Input :
+        data_dir : string
+                   platform directory with the Level_0/ sub-directory
+    Output :
+        index : AFileIndex
+                up to date with Level_0/; saved if any A-file had to be parsed
+    """
+
+    index = AFileIndex(data_dir).refresh()
+    index.save()
+
+    return index
@@ -0,0 +1,143 @@
+# Python file to keep track of which processing outputs are up to date with their inputs
+
+import hashlib
+import json
+import os
+
+import joanne
+
+manifest_name = "build_manifest.json"
+# manifest file kept in the platform directory
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """
+    SHA-256 of the content of a file, read in chunks
+    """
+    sha = hashlib.sha256()
+
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class BuildManifest:
+
+    """
+    Dependency-tracking cache manifest for the processing stages
+
+    Input :
+        manifest_path : string
+                        path to the JSON manifest; created on save() if it does not exist
+
+    Every stage records, per item (a sonde, a Level-2 file or the whole stage), a key
+    built from the content hashes of its input files, its processing parameters and
+    the JOANNE version, together with the output files it wrote. An item has to be
+    reprocessed only if its key changed or one of its outputs is missing.
+
+    File hashes are cached by (size, modification time) so that unchanged
+    inputs are not read again on every run.
+    """
+
+    def __init__(self, manifest_path):
+
+        self.manifest_path = manifest_path
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        else:
+            manifest = {}
+
+        self.hashes = manifest.get("hashes", {})
+        self.stages = manifest.get("stages", {})
+
+    def hash(self, file_path):
+        """
+        Content hash of a file, reusing the cached value if size and mtime are unchanged
+        """
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+
+        cached = self.hashes.get(file_path)
+
+        if cached is not None and cached["signature"] == signature:
+            return cached["sha256"]
+
+        sha = file_hash(file_path)
+        self.hashes[file_path] = {"signature": signature, "sha256": sha}
+
+        return sha
+
+    def key(self, input_files=(), params=None):
+        """
+        Input :
+            input_files : list
+                          paths whose content the item depends on
+            params : dict
+                     JSON-serialisable processing parameters
+        Output :
+            key : string
+                  hash of the input contents, the parameters and the JOANNE version
+        """
+        sha = hashlib.sha256()
+
+        for file_path in input_files:
+            sha.update(self.hash(file_path).encode())
+
+        sha.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        sha.update(str(joanne.__version__).encode())
+
+        return sha.hexdigest()
+
+    def is_fresh(self, stage, item, key):
+        """
+        True if `item` of `stage` was built with `key` and all its outputs still exist
+        """
+        entry = self.stages.get(stage, {}).get(item)
+
+        if entry is None or entry["key"] != key:
+            return False
+
+        return all(os.path.exists(i) for i in entry["outputs"])
+
+    def outputs(self, stage, item):
+        """
+        Outputs recorded for `item` of `stage` by a previous run
+        """
+        return self.stages.get(stage, {}).get(item, {}).get("outputs", [])
+
+    def remove_stale_outputs(self, stage, item):
+        """
+        Delete the outputs recorded for `item` before it is rebuilt, so that a
+        renamed output (e.g. after a new sonde_id) does not linger next to the new one
+        """
+        for file_path in self.outputs(stage, item):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def record(self, stage, item, key, outputs=()):
+        self.stages.setdefault(stage, {})[item] = {
+            "key": key,
+            "outputs": [i for i in outputs if i is not None],
+        }
+
+    def save(self):
+        """
+        Write the manifest atomically
+        """
+        tmp_path = self.manifest_path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump({"hashes": self.hashes, "stages": self.stages}, f, indent=1)
+
+        os.replace(tmp_path, self.manifest_path)
+
+
+def open_manifest(data_dir):
+    """
+    Build manifest of a platform directory
+    """
+    return BuildManifest(os.path.join(data_dir, manifest_name))
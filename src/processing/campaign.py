@@ -0,0 +1,211 @@
+# Python file to process all flights and platforms of a campaign and merge their Level-3 products
+
+import argparse
+import os
+
+import numpy as np
+import xarray as xr
+
+import joanne
+
+import build_cache
+import config
+import derived_variables
+import generate_Level_3
+import generate_Level_4
+import instrumentation
+import pipeline
+import platforms
+import sonde_index
+import storage
+
+def find_campaign_directories(campaign_dir):
+
+    """
+    Input :
+        campaign_dir : string
+                       directory with one sub-directory per flight, each with one
+                       sub-directory per platform (e.g. 20200122/HALO/)
+    Output :
+        dict : flight -> list of platform directories of that flight
+    """
+
+    flights = {}
+
+    for data_dir in pipeline.find_platform_directories(campaign_dir):
+        flight = os.path.basename(os.path.dirname(os.path.normpath(data_dir)))
+        flights.setdefault(flight, []).append(data_dir)
+
+    return flights
+
+def level_3_file_name(label=None):
+    return (
+        "EUREC4A_JOANNE_Dropsonde-RD41_"
+        + "Level_3_"
+        + (f"{label}_" if label else "")
+        + "v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+
+def merge_level_3(level_3_paths, save_path, manifest, item, chunk_sondes=64):
+
+    """
+    Input :
+        level_3_paths : dict
+                        platform directory -> Level-3 file or Zarr store
+        save_path : string
+                    path of the merged Level-3 file
+        manifest : build_cache.BuildManifest
+                   manifest of the directory holding the merged file
+        item : string
+               name of the merged product in the manifest
+    Output :
+        save_path, or None if there is nothing to merge
+    Function to concatenate Level-3 products along sonde_id, sorted by launch time.
+    The inputs are opened lazily (chunked with dask if available), so the merge does
+    not hold all platforms in memory. Nothing is done if no input changed
+    """
+
+    sources = {d: p for d, p in level_3_paths.items() if p is not None and os.path.exists(p)}
+
+    if len(sources) == 0:
+        return None
+
+    profile = storage.get_profile_name()
+
+    merge_key = manifest.key(
+        params={
+            "storage_profile": profile,
+            "sources": {
+                d: build_cache.open_manifest(d).stages.get("Level_3", {}).get("dataset", {}).get("key")
+                for d in sorted(sources)
+            }
+        }
+    )
+
+    if manifest.is_fresh("Level_3_merged", item, merge_key):
+        print(f"{save_path} is up to date.")
+        sonde_index.update_sonde_index(save_path, manifest, item, merge_key)
+        return save_path
+
+    datasets = [
+        derived_variables.open_level_3(sources[d], chunk_sondes=chunk_sondes) for d in sorted(sources)
+    ]
+
+    merged = xr.concat(datasets, dim="sonde_id", data_vars="minimal", coords="minimal", compat="override")
+    merged = merged.isel(sonde_id=np.argsort(merged.launch_time.values, kind="stable"))
+
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+    encoding = generate_Level_3.level_3_encoding(merged, chunk_sondes=chunk_sondes, profile=profile)
+    encoding = {var: enc for var, enc in encoding.items() if var in merged.variables}
+
+    merged.to_netcdf(
+        save_path, mode="w", format="NETCDF4", encoding=encoding, unlimited_dims=["sonde_id"]
+    )
+
+    for ds in datasets:
+        ds.close()
+
+    manifest.record("Level_3_merged", item, merge_key, [save_path])
+    manifest.save()
+
+    sonde_index.update_sonde_index(save_path, manifest, item, merge_key)
+    # campaign-wide sonde selection by launch time and position
+
+    return save_path
+
+def run_campaign(
+    campaign_dir, jobs=None, workers=None, run_levels=None, force=False, report=None
+):
+
+    """
+    Input :
+        campaign_dir : string
+                       campaign directory (see find_campaign_directories)
+        jobs : int
+               platform directories processed concurrently; `jobs` option of run_config.cfg if None
+        workers : int
+                  worker processes per platform; `workers` option of run_config.cfg if None
+        run_levels : int
+                     highest level processed per platform; `run_levels` option if None
+        report : string
+                 "off", "on" or "profile", see pipeline.run_pipeline(); `instrumentation` option if None
+    Output :
+        errors : dict
+                 traceback of every platform directory that failed
+    Function to run the pipeline for every flight and platform of the campaign over a
+    pool of `jobs` processes, then write one merged Level-3 file per flight (all its
+    platforms) and one for the whole campaign
+    """
+
+    if jobs is None:
+        jobs = int(config.get_option("jobs", fallback=1))
+
+    if workers is None:
+        workers = config.get_workers()
+
+    if run_levels is None:
+        run_levels = int(config.get_option("run_levels", fallback=4))
+
+    if report is None:
+        report = config.get_option("instrumentation", fallback="off")
+
+    if report in ["on", "profile"]:
+        instrumentation.enable(profile=report == "profile")
+
+    campaign_dir = os.path.join(campaign_dir, "")
+
+    flights = find_campaign_directories(campaign_dir)
+
+    platform_dirs = [d for dirs in flights.values() for d in dirs]
+
+    print(
+        f"{len(flights)} flights, {len(platform_dirs)} platform directories: "
+        + ", ".join(sorted({platforms.platform_from_directory(d) for d in platform_dirs}))
+    )
+
+    errors = pipeline.run_platforms(
+        platform_dirs, run_levels=run_levels, workers=workers, jobs=jobs, force=force
+    )
+
+    if run_levels < 3:
+        return errors
+
+    level_3_paths = {
+        d: generate_Level_4.level_3_path(d, build_cache.open_manifest(d))
+        for d in platform_dirs
+        if d not in errors
+    }
+
+    for flight, dirs in flights.items():
+
+        flight_dir = os.path.dirname(os.path.normpath(dirs[0])) + "/"
+
+        merge_level_3(
+            {d: level_3_paths.get(d) for d in dirs},
+            f"{flight_dir}Level_3/" + level_3_file_name(flight),
+            build_cache.open_manifest(flight_dir),
+            flight,
+        )
+
+    merge_level_3(
+        level_3_paths,
+        f"{campaign_dir}Level_3/" + level_3_file_name(),
+        build_cache.open_manifest(campaign_dir),
+        "campaign",
+    )
+
+    return errors
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Process all flights and platforms of a campaign")
+    parser.add_argument("campaign_dir")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="ignore the stage checkpoints")
+    args = parser.parse_args()
+
+    run_campaign(args.campaign_dir, jobs=args.jobs, workers=args.workers, force=args.force)
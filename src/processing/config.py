@@ -0,0 +1,76 @@
+# Python file to read processing options from run_config.cfg (see src/create_run_config.py)
+
+import configparser
+import contextlib
+import os
+
+config_file = 'run_config.cfg'
+# path relative to the repository root, where the processing scripts are run from
+
+config_env = "JOANNE_RUN_CONFIG"
+# config selected with using(); an environment variable, so that worker processes
+# started by the stages read the same config whatever their start method
+
+def active_config_file():
+    """
+    Path of the config selected with using(), else the default run_config.cfg
+    """
+    return os.environ.get(config_env, config_file)
+
+@contextlib.contextmanager
+def using(path):
+    """
+    Context manager to read all options from the config at `path` (e.g. the
+    --config of pipeline.py) instead of the default run_config.cfg
+    """
+    previous = os.environ.get(config_env)
+    os.environ[config_env] = path
+    try:
+        yield path
+    finally:
+        if previous is None:
+            del os.environ[config_env]
+        else:
+            os.environ[config_env] = previous
+
+def read_config(config_file=None):
+    """
+    Input :
+        config_file : string
+                      path to the config file; active_config_file() if None
+    Output :
+        config : configparser.ConfigParser
+                 parsed config; empty if the default run_config.cfg does not exist.
+                 A FileNotFoundError is raised if a config given explicitly (or
+                 selected with using()) does not exist, rather than running
+                 with the defaults of every option
+    """
+    if config_file is None:
+        config_file = active_config_file()
+
+    config = configparser.ConfigParser()
+
+    if os.path.exists(config_file):
+        config.read(config_file)
+    elif config_file != globals()["config_file"]:
+        raise FileNotFoundError(f"Config file not found: {config_file}")
+
+    return config
+
+def get_workers(config=None, default=1):
+    """
+    Number of worker processes from the `workers` option of the DEFAULT section
+    """
+    if config is None:
+        config = read_config()
+
+    return config["DEFAULT"].getint("workers", fallback=default)
+
+def get_option(option, fallback=None, config=None):
+    """
+    Value of an option of the DEFAULT section, or `fallback` if it is not set
+    """
+    if config is None:
+        config = read_config()
+
+    return config["DEFAULT"].get(option, fallback=fallback)
@@ -0,0 +1,222 @@
+# Python file to derive static energies and stability fields from the Level-3 dataset
+
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+
+import joanne
+
+import build_cache
+import config
+import storage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+# repository root, for the functions package
+
+from functions import thermo_kernel as tk
+
+try:
+    import dask
+except ImportError:
+    dask = None
+
+derived_attrs = {
+    "q_sat": {"long_name": "saturation specific humidity", "units": "kg kg-1"},
+    "dse": {"long_name": "dry static energy", "units": "J kg-1"},
+    "mse": {"long_name": "moist static energy", "units": "J kg-1"},
+    "mse_sat": {"long_name": "saturated moist static energy", "units": "J kg-1"},
+    "theta_v": {"long_name": "virtual potential temperature", "units": "K"},
+    "N2": {
+        "long_name": "squared Brunt-Vaisala frequency",
+        "description": "static stability, g / theta_v * d(theta_v)/dz",
+        "units": "s-2",
+    },
+}
+
+def _static_energies(ta, p, q, alt):
+
+    # one (sonde_id, alt) block; alt is broadcast along the sondes
+
+    z = np.broadcast_to(alt, ta.shape)
+
+    q_sat = tk.q_sat(ta, p)
+    dse = tk.dse(ta, q, z)
+    mse = tk.mse(ta, q, z)
+    mse_sat = tk.mse(ta, q_sat, z)
+
+    return q_sat, dse, mse, mse_sat
+
+def _stability(ta, p, q, alt):
+
+    # one (sonde_id, alt) block with the full altitude column
+
+    theta_v = np.power(100000.0 / p, tk.Rd / tk.cpd)
+    theta_v *= ta
+    theta_v *= 1 + 0.61 * q
+
+    N2 = np.gradient(theta_v, alt, axis=-1)
+    N2 *= tk.gravity
+    N2 /= theta_v
+
+    return theta_v, N2
+
+def compute_derived(lv3_dataset):
+
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      Level-3 dataset with (sonde_id, alt) dimensions; may be chunked
+                      along sonde_id with dask, in which case the result is lazy
+    Output :
+        dataset : xarray dataset
+                  q_sat, dse, mse, mse_sat, theta_v and N2 with (sonde_id, alt) dimensions
+
+    All sondes of a chunk are computed at once with functions/thermo_kernel.py;
+    the altitude dimension must not be split across chunks (needed for N2)
+    """
+
+    ta, p, q = lv3_dataset.ta, lv3_dataset.p, lv3_dataset.q
+    alt = lv3_dataset.alt.astype("float64")
+
+    kwargs = dict(
+        input_core_dims=[["alt"], ["alt"], ["alt"], ["alt"]],
+        dask="parallelized",
+    )
+
+    q_sat, dse, mse, mse_sat = xr.apply_ufunc(
+        _static_energies,
+        ta,
+        p,
+        q,
+        alt,
+        output_core_dims=[["alt"]] * 4,
+        output_dtypes=[ta.dtype] * 4,
+        **kwargs,
+    )
+
+    theta_v, N2 = xr.apply_ufunc(
+        _stability,
+        ta,
+        p,
+        q,
+        alt,
+        output_core_dims=[["alt"]] * 2,
+        output_dtypes=[ta.dtype] * 2,
+        **kwargs,
+    )
+
+    dataset = xr.Dataset(
+        {
+            "q_sat": q_sat,
+            "dse": dse,
+            "mse": mse,
+            "mse_sat": mse_sat,
+            "theta_v": theta_v,
+            "N2": N2,
+        }
+    ).transpose("sonde_id", "alt")
+
+    for var in derived_attrs:
+        dataset[var].attrs = derived_attrs[var]
+
+    return dataset
+
+def derived_path(data_directory):
+    return (
+        f"{data_directory}Level_3/EUREC4A_JOANNE_Dropsonde-RD41_"
+        + "Level_3_derived_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+
+def open_level_3(lv3_path, chunk_sondes=None):
+
+    """
+    Open the Level-3 file or Zarr store, chunked along sonde_id if dask is available
+    """
+
+    chunks = {"sonde_id": chunk_sondes, "alt": -1} if dask is not None and chunk_sondes else None
+
+    if lv3_path.endswith(".zarr"):
+        return xr.open_zarr(lv3_path, chunks=chunks)
+
+    return xr.open_dataset(lv3_path, chunks=chunks)
+
+def open_derived(data_directory):
+
+    """
+    Derived variables cached by generate_derived(), or None if they do not exist
+    """
+
+    if os.path.exists(derived_path(data_directory)):
+        return xr.open_dataset(derived_path(data_directory))
+
+    return None
+
+######## Generating derived variables ######
+
+def generate_derived(data_directory, chunk_sondes=None):
+
+    """
+    Input :
+        data_directory : string
+                         platform directory with the Level_3/ sub-directory
+        chunk_sondes : int
+                       number of sondes per chunk; read from the `level_3_chunk_sondes`
+                       option of run_config.cfg if None
+    Output :
+        file path of the derived-variable file next to the Level-3 file, or None
+        if there is no Level-3 file
+    Nothing is done if the file is up to date with the Level-3 file
+    """
+
+    if chunk_sondes is None:
+        chunk_sondes = int(config.get_option("level_3_chunk_sondes", fallback=64))
+
+    manifest = build_cache.open_manifest(data_directory)
+
+    lv3_outputs = manifest.outputs("Level_3", "dataset")
+
+    if len(lv3_outputs) == 0 or not os.path.exists(lv3_outputs[0]):
+        print("No Level-3 file found. Not deriving variables.")
+        return None
+
+    lv3_path = lv3_outputs[0]
+
+    profile = storage.get_profile_name()
+
+    derived_key = manifest.key(
+        params={"level_3": manifest.stages["Level_3"]["dataset"]["key"], "storage_profile": profile}
+    )
+    # the Level-3 key already stands for the content of the Level-3 file or store
+
+    save_path = derived_path(data_directory)
+
+    if manifest.is_fresh("Level_3_derived", "dataset", derived_key):
+        print("Derived variables are up to date with the Level-3 file.")
+        return save_path
+
+    lv3_dataset = open_level_3(lv3_path, chunk_sondes=chunk_sondes)
+
+    to_save_ds = compute_derived(lv3_dataset)
+
+    comp = dict(storage.netcdf_compression(profile), _FillValue=np.finfo("float32").max)
+
+    encoding = {var: dict(comp, dtype="float32") for var in to_save_ds.data_vars}
+
+    print('Saving derived variables...')
+
+    to_save_ds.to_netcdf(save_path, mode="w", format="NETCDF4", encoding=encoding)
+    # with dask, the chunks are computed and written one after another
+
+    lv3_dataset.close()
+
+    manifest.record("Level_3_derived", "dataset", derived_key, [save_path])
+    manifest.save()
+
+    return save_path
+
+if __name__ == '__main__':
+    generate_derived('extra/Sample_Data/20200122/HALO/')
@@ -0,0 +1,314 @@
+# Python file to compute the horizontal drift of the sondes from their Level-2 trajectories
+
+import os
+
+import numpy as np
+import xarray as xr
+
+import joanne
+from joanne.Level_3 import fn_3 as f3
+
+import build_cache
+import config
+import level_2_store
+import storage
+from generate_Level_3 import _bin_means, sonde_id_from_file_name
+from level_2_store import Level2Store
+from sonde_index import haversine
+
+data_directory = 'extra/Sample_Data/20200122/HALO/'
+
+drift_attrs = {
+    "drift_x": {"long_name": "eastward displacement from the launch point", "units": "km"},
+    "drift_y": {"long_name": "northward displacement from the launch point", "units": "km"},
+    "drift_distance": {"long_name": "great-circle distance from the launch point", "units": "km"},
+    "drift_bearing": {
+        "long_name": "bearing of the sonde as seen from the launch point",
+        "description": "clockwise from north",
+        "units": "degree",
+    },
+}
+
+def drift_paths(data_directory):
+    """
+    Paths of the drift along the Level-2 trajectories and of the gridded drift
+    """
+    return (
+        f"{data_directory}Drift/EUREC4A_JOANNE_Dropsonde-RD41_Drift_Level_2_v{joanne.__version__}.nc",
+        f"{data_directory}Drift/EUREC4A_JOANNE_Dropsonde-RD41_Drift_Level_3_v{joanne.__version__}.nc",
+    )
+
+#### Ragged trajectories #####
+
+def read_trajectories(sources):
+
+    """
+    Input :
+        sources : string or list
+                  path of a Level-2 store, or paths of per-sonde Level-2 files
+    Output :
+        sonde_id, row_size, lat, lon, alt, time : np.ndarray
+                                                  trajectories of all sondes concatenated
+                                                  (contiguous ragged arrays, `row_size`
+                                                  observations per sonde)
+    Only lat, lon, alt and time are read
+    """
+
+    variables = ["lat", "lon", "alt", "time"]
+
+    if isinstance(sources, str):
+        store = Level2Store(sources)
+        try:
+            data = [store.ds[var].values for var in variables]
+            return (np.array(store.sonde_ids), store.row_size, *data)
+        finally:
+            store.close()
+
+    sonde_id, row_size = [], []
+    data = {var: [] for var in variables}
+
+    for file_path in sources:
+        with xr.open_dataset(file_path) as ds:
+            for var in variables:
+                data[var].append(ds[var].values)
+            row_size.append(ds.sizes["time"])
+            sonde_id.append(sonde_id_from_file_name(file_path))
+
+    return (
+        np.array(sonde_id),
+        np.array(row_size, dtype="int64"),
+        *[np.concatenate(data[var]) if len(data[var]) > 0 else np.array([]) for var in variables],
+    )
+
+def compute_drift(sonde_id, row_size, lat, lon, alt, time):
+
+    """
+    Input :
+        sonde_id, row_size, lat, lon, alt, time : np.ndarray
+                                                  ragged trajectories, see read_trajectories()
+    Output :
+        dataset : xarray dataset
+                  drift_x, drift_y, drift_distance and drift_bearing along `obs` (ragged,
+                  with rowSize), launch_lat and launch_lon along sonde_id
+
+    The launch point of a sonde is its earliest observation with a valid position.
+    The launch points are found with one sort over all observations, then
+    the haversine distance and the initial bearing are computed for all
+    observations of all sondes in a single vectorized pass.
+    """
+
+    row_size = np.asarray(row_size, dtype="int64")
+    n_sondes = len(row_size)
+
+    lat = np.asarray(lat, dtype="float64")
+    lon = np.asarray(lon, dtype="float64")
+    sonde_index = np.repeat(np.arange(n_sondes), row_size)
+    offsets = np.concatenate([[0], np.cumsum(row_size)[:-1]]).astype("int64")
+
+    time = np.asarray(time).astype("datetime64[ns]")
+    valid = ~np.isnan(lat) & ~np.isnan(lon) & ~np.isnat(time)
+
+    time_ns = np.where(valid, time.astype("int64"), np.iinfo("int64").max)
+
+    order = np.lexsort((time_ns, sonde_index))
+    # grouped by sonde (as stored), earliest valid observation first
+
+    launch = np.zeros(n_sondes, dtype="int64")
+    launch[row_size > 0] = order[offsets[row_size > 0]]
+
+    has_launch = (row_size > 0) & valid[launch] if len(valid) > 0 else np.zeros(n_sondes, dtype=bool)
+
+    launch_lat = np.where(has_launch, lat[launch] if len(lat) > 0 else np.nan, np.nan)
+    launch_lon = np.where(has_launch, lon[launch] if len(lon) > 0 else np.nan, np.nan)
+
+    lat0 = np.radians(launch_lat[sonde_index])
+    lat1 = np.radians(lat)
+    dlon = np.radians(lon - launch_lon[sonde_index])
+
+    with np.errstate(invalid="ignore"):
+
+        distance = haversine(launch_lat[sonde_index], launch_lon[sonde_index], lat, lon)
+
+        bearing = np.degrees(
+            np.arctan2(
+                np.sin(dlon) * np.cos(lat1),
+                np.cos(lat0) * np.sin(lat1) - np.sin(lat0) * np.cos(lat1) * np.cos(dlon),
+            )
+        ) % 360
+
+    drift_x = distance * np.sin(np.radians(bearing))
+    drift_y = distance * np.cos(np.radians(bearing))
+
+    dataset = xr.Dataset(
+        {
+            "drift_x": (["obs"], drift_x),
+            "drift_y": (["obs"], drift_y),
+            "drift_distance": (["obs"], distance),
+            "drift_bearing": (["obs"], bearing),
+            "alt": (["obs"], np.asarray(alt, dtype="float64"), {"units": "m"}),
+            "launch_lat": (["sonde_id"], launch_lat, {"units": "degree_north"}),
+            "launch_lon": (["sonde_id"], launch_lon, {"units": "degree_east"}),
+            "rowSize": (
+                ["sonde_id"],
+                row_size.astype("int32"),
+                {"long_name": "number of observations for this sonde", "sample_dimension": "obs"},
+            ),
+        },
+        coords={"sonde_id": np.asarray(sonde_id).astype(str)},
+        attrs={"featureType": "trajectory"},
+    )
+
+    for var in drift_attrs:
+        dataset[var].attrs = drift_attrs[var]
+
+    return dataset
+
+def grid_drift(drift_ds, height_limit=10000, vertical_spacing=10):
+
+    """
+    Input :
+        drift_ds : xarray dataset
+                   as returned by compute_drift()
+        height_limit, vertical_spacing : int
+                                         altitude grid of Level-3, m
+    Output :
+        dataset : xarray dataset
+                  drift_x, drift_y, drift_distance and drift_bearing with (sonde_id, alt)
+                  dimensions, bin-averaged on the Level-3 grid. The bearing is taken
+                  from the averaged displacement, not averaged itself
+    """
+
+    grid = np.arange(0, height_limit + vertical_spacing, vertical_spacing)
+    bins = np.append(grid - vertical_spacing / 2, grid[-1] + vertical_spacing / 2)
+
+    n_sondes, n_bins = drift_ds.sizes["sonde_id"], len(grid)
+
+    sonde_index = np.repeat(np.arange(n_sondes), drift_ds.rowSize.values)
+
+    bin_index = np.searchsorted(bins, drift_ds.alt.values, side="left") - 1
+    in_grid = (bin_index >= 0) & (bin_index < n_bins)
+    flat_bin = np.where(in_grid, sonde_index * n_bins + bin_index, -1)
+
+    gridded = {}
+
+    for var in ["drift_x", "drift_y", "drift_distance"]:
+        means, _ = _bin_means(drift_ds[var].values, flat_bin, n_sondes * n_bins)
+        gridded[var] = means.reshape(n_sondes, n_bins)
+
+    with np.errstate(invalid="ignore"):
+        gridded["drift_bearing"] = np.degrees(np.arctan2(gridded["drift_x"], gridded["drift_y"])) % 360
+
+    dataset = xr.Dataset(
+        {var: (["sonde_id", "alt"], values) for var, values in gridded.items()},
+        coords={"sonde_id": drift_ds.sonde_id.values, "alt": grid},
+    )
+
+    for var in drift_attrs:
+        dataset[var].attrs = drift_attrs[var]
+
+    dataset["alt"].attrs = {"long_name": "geopotential height", "units": "m"}
+    dataset["launch_lat"] = drift_ds.launch_lat
+    dataset["launch_lon"] = drift_ds.launch_lon
+
+    return dataset
+
+def open_drift(data_directory):
+    """
+    Gridded drift cached by generate_drift(), or None if it does not exist
+    """
+    gridded_path = drift_paths(data_directory)[1]
+
+    if os.path.exists(gridded_path):
+        return xr.open_dataset(gridded_path)
+
+    return None
+
+######## Generating drift ######
+
+def generate_drift(data_directory=data_directory, gridded=True, store_format=None):
+
+    """
+    Input :
+        data_directory : string
+                         platform directory with Level_2/ (or a Level-2 store)
+        gridded : bool
+                  if True, the drift is also bin-averaged on the Level-3 altitude grid
+                  (`height_limit` and `vertical_spacing` options of run_config.cfg)
+        store_format : string
+                       "netcdf" or "zarr" to read the trajectories from the Level-2 store of
+                       that format if it exists; `level_2_store` option if None
+    Output :
+        list of the drift files written (or up to date), empty if there are no Level-2 sondes
+    Nothing is done if the drift files are up to date with the Level-2 sondes
+    """
+
+    if store_format is None:
+        store_format = config.get_option("level_2_store", fallback="none")
+
+    height_limit = int(config.get_option("height_limit", fallback=10000))
+    vertical_spacing = int(config.get_option("vertical_spacing", fallback=10))
+
+    manifest = build_cache.open_manifest(data_directory)
+
+    store = None
+
+    if store_format in level_2_store.store_formats:
+        store = level_2_store.store_path(data_directory, store_format)
+        if not os.path.exists(store):
+            store = None
+
+    profile = storage.get_profile_name()
+
+    params = {
+        "storage_profile": profile,
+        "gridded": gridded,
+        "height_limit": height_limit,
+        "vertical_spacing": vertical_spacing,
+    }
+
+    if store is not None:
+        sources = store
+        drift_key = manifest.key(
+            params=dict(params, level_2_store=manifest.stages.get("Level_2_store", {}).get(store_format, {}).get("key"))
+        )
+    else:
+        sources = f3.retrieve_all_files(data_directory + "Level_2/", file_ext="*.nc")
+        drift_key = manifest.key(sources, params=params)
+
+    if len(sources) == 0:
+        print("No Level-2 files found. Not computing drift.")
+        return []
+
+    save_paths = list(drift_paths(data_directory)) if gridded else [drift_paths(data_directory)[0]]
+
+    if manifest.is_fresh("Drift", "dataset", drift_key):
+        print("Drift is up to date with the Level-2 files.")
+        return save_paths
+
+    print("Computing drift...")
+
+    drift_ds = compute_drift(*read_trajectories(sources))
+
+    os.makedirs(os.path.dirname(save_paths[0]), exist_ok=True)
+
+    comp = dict(storage.netcdf_compression(profile), _FillValue=np.finfo("float32").max, dtype="float32")
+
+    drift_ds.to_netcdf(
+        save_paths[0],
+        encoding={var: comp for var in drift_ds.data_vars if drift_ds[var].dtype == "float64"},
+    )
+
+    if gridded:
+        gridded_ds = grid_drift(drift_ds, height_limit=height_limit, vertical_spacing=vertical_spacing)
+        gridded_ds.to_netcdf(
+            save_paths[1],
+            encoding={var: comp for var in gridded_ds.data_vars if gridded_ds[var].dtype == "float64"},
+        )
+
+    manifest.record("Drift", "dataset", drift_key, save_paths)
+    manifest.save()
+
+    return save_paths
+
+if __name__ == '__main__':
+    generate_drift(data_directory)
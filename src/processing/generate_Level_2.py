@@ -1,236 +1,724 @@
 # %%
-import datetime
-import glob
+import argparse
+import collections
+import contextlib
 import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
-import seaborn as sb
 import xarray as xr
 from tqdm import tqdm
-from packaging import version
 
 import joanne
 from joanne.Level_2 import fn_2 as f2
 from joanne.Level_2 import dicts
 
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+import build_cache
+import config
+import instrumentation
+import level_2_store
+import platforms
+import prefetch
+import storage
+from sonde_catalog import SondeCatalog
+from status_index import QCStatusIndex, get_status_filename
+
 Platform = 'HALO'
 data_dir='extra/Sample_Data/20200122/HALO/'
 save_dir = 'extra/Sample_Data/20200122/HALO/Level_2/'
 
-if os.path.exists(save_dir):
-    pass
-else:
-    os.makedirs(save_dir)
+varname_L1 = ["height", "time", "wspd", "wdir", "tdry", "pres", "rh", "lat", "lon"]
+varname_L2 = ["alt", "time", "wspd", "wdir", "ta", "p", "rh", "lat", "lon"]
 
-def get_all_sondes_list(data_dir='../extra/Sample_Data/20200122/HALO/'):
+status_index = None
+# QC status lookup table; loaded once per process by init_status()
 
-    directory = f"{data_dir}Level_1/"
-    # directory where all sonde files are present
+# for Platform in ["HALO", "P3"]:
 
-    a_dir = f"{data_dir}Level_0/"
-    # directory where all the A files are present
+def init_status(status_filename):
+    """
+    Load the QC status file into a QCStatusIndex for the current process;
+    also used as the initializer of the worker processes
+    """
+    global status_index
+    status_index = QCStatusIndex.from_file(status_filename)
+
+def extract_level_2_variables(sonde, platform=Platform):
+
+    """
+    Input :
+        sonde : xarray dataset
+                ASPEN-processed Level-1 sonde
+        platform : string
+                   selects the unit conversions in platforms.platform_conversions
+    Output :
+        variables : dict
+                    Level-2 variable name -> values at the valid time steps
+    The valid mask is computed once and all float variables are taken with a
+    single fancy index into one float32 block; units are converted in place
+    """
 
-    qc_directory = f"{data_dir}QC/"
-    # directory to store logs and stats
+    alt = sonde.alt.values
 
-    sonde_paths = sorted(glob.glob(directory + "*QC.nc"))
-    # paths to the individual sonde files
+    # ht_indices = ~np.isnan(sonde.alt)
+    ht_indices = np.flatnonzero(
+        ~np.isnan(alt)
+        & ~np.isnan(sonde.lat.values)
+        & ~np.isnan(sonde.lon.values)
+    )
+    # retrieving non-NaN indices of geopotential height (sonde.alt)
+    # only time values at these indices will be used in Level-2 trajectory data;
+    # this means that only alternate u,v values are included in the Level-2 data
+    # PTU has 2 Hz measurement frequency, while GPS has a 4 Hz measurement frequency
 
-    file_time_str = [None] * len(sonde_paths)
-    file_time = [None] * len(sonde_paths)
-    # list to store extracted sonde time from file name as string and as time
+    float_vars = [(var1, var2) for var1, var2 in zip(varname_L1, varname_L2) if var2 != "time"]
 
-    a_files = [None] * len(sonde_paths)
-    # list to store file names for the log files starting with A.
+    source = np.stack(
+        [alt if var1 == "height" else sonde[var1].values for var1, _ in float_vars]
+    )
+    block = source[:, ht_indices].astype("float32", copy=False)
+    # one copy of all variables at the valid time steps
 
-    sonde_ds = [None] * len(sonde_paths)
-    # list to store individual datasets of all sondes from PQC files
+    variables = {var2: block[n] for n, (_, var2) in enumerate(float_vars)}
 
-    for i in range(len(sonde_paths)):
-        file_time_str[i] = sonde_paths[i][-20:-5]
-        file_time[i] = np.datetime64(
-            pd.to_datetime(file_time_str[i], format="%Y%m%d_%H%M%S"), "s"
-        )
-        a_files[i] = "A" + file_time_str[i]
-        sonde_ds[i] = xr.open_dataset(sonde_paths[i])
+    variables["time"] = sonde.time.values[ht_indices]  # .astype("float").values / 1e9
 
-    return sonde_ds, directory, a_dir, qc_directory, a_files, file_time, sonde_paths
+    ###--------- Unit Conversions --------###
 
-varname_L1 = ["height", "time", "wspd", "wdir", "tdry", "pres", "rh", "lat", "lon"]
-varname_L2 = ["alt", "time", "wspd", "wdir", "ta", "p", "rh", "lat", "lon"]
+    for var, (factor, offset) in platforms.get_conversions(platform).items():
+        if factor != 1:
+            variables[var] *= factor
+        if offset != 0:
+            variables[var] += offset
 
-# for Platform in ["HALO", "P3"]:
+    return variables
 
-(
-    sonde_ds,
-    directory,
-    a_dir,
-    qc_directory,
-    a_files,
-    file_time,
-    sonde_paths,
-) = get_all_sondes_list(data_dir)
+def level_2_file_name(sonde_id):
+    return (
+        "EUREC4A_JOANNE"
+        # + str(Platform)
+        + "_Dropsonde-RD41_"
+        + str(sonde_id)
+        + "_Level_2"
+        + "_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
 
-# look for status file with same major and minor version-bit
-# (patch number and modifiers can be different)
+sonde_id_attrs = {
+    "descripion": "unique sonde ID",
+    "long_name": "sonde identifier",
+    "cf_role": "trajectory_id",
+}
 
-status_filename = glob.glob(
-    f"{qc_directory}Status_of_sondes_v{joanne.__version__[:3]}*.nc"
-)
+def build_level_2_dataset(variables, sonde_id, global_attrs, profile=None):
 
-vers = [None] * len(status_filename)
+    """
+    Level-2 xarray dataset of a sonde, and its encoding for to_netcdf() with the
+    compression of the storage profile (see storage.py)
+    """
 
-for n, i in enumerate(status_filename):
-    vers[n] = version.parse(i)
+    obs = np.arange(1, len(variables["time"]) + 1, 1)
+    # creating the observations dimension of the NC file
 
-status_ds = xr.open_dataset(str(max(vers)))
+    to_save_ds = xr.Dataset(coords={"time": obs})
 
-a_filepaths = []
+    for var in dicts.nc_meta.keys():
+        # v = var
+        f2.create_variable(to_save_ds, var, variables[var])
 
-for i in a_files:
-    a_filepaths.append(sorted(glob.glob(a_dir + i + "*")))
+    ### ---------- adding the sonde_id var to the dataset --------- #####
+    to_save_ds["sonde_id"] = xr.Variable([], sonde_id, attrs=sonde_id_attrs)
 
-file_time_str = [None] * len(sonde_paths)
+    comp = dict(
+        storage.netcdf_compression(profile),
+        _FillValue=np.finfo("float32").max,
+    )
 
-for i in range(len(sonde_paths)):
-    # file_time_str[i] = sonde_paths[i][-22:-7]
-    lt_pd = pd.to_datetime(min(sonde_ds[i].time.values))
+    encoding = {var: comp for var in to_save_ds.data_vars if var != "sonde_id"}
+    encoding["time"] = {"units": "seconds since 2020-01-01", "dtype": "float"}
 
-    file_time_str[
-        i
-    ] = f"{(lt_pd.year)}{(lt_pd.month):02}{(lt_pd.day):02}_{(lt_pd.hour):02}{(lt_pd.minute):02}{(lt_pd.second):02}"
+    for key in global_attrs.keys():
+        to_save_ds.attrs[key] = global_attrs[key]
 
-for i in tqdm(range(len(sonde_ds))):
+    return to_save_ds, encoding
 
-    if (
-        status_ds.swap_dims({"sonde_id": "launch_time"})
-        .sel(
-            launch_time=sonde_ds[i].launch_time.values,
-            # method="nearest",
-            # tolerance="1s",
-        )
-        .qc_flag
-        == "GOOD"
-    ):
+_level_2_schema = {}
+
+def level_2_schema(profile=None):
+
+    """
+    Variable definitions of the Level-2 file for the netCDF4 writer, built once per process
+    and storage profile: list of (name, dtype, attributes, createVariable keyword arguments)
+    """
 
-        # ht_indices = ~np.isnan(sonde_ds[i].alt)
-        ht_indices = (
-            ~np.isnan(sonde_ds[i].alt)
-            & ~np.isnan(sonde_ds[i].lat)
-            & ~np.isnan(sonde_ds[i].lon)
+    profile = storage.get_profile_name(profile)
+
+    if profile not in _level_2_schema:
+
+        comp = dict(
+            storage.netcdf_compression(profile),
+            fill_value=np.finfo("float32").max,
         )
-        # retrieving non-NaN indices of geopotential height (sonde_ds[i].alt)
-        # only time values at these indices will be used in Level-2 trajectory data;
-        # this means that only alternate u,v values are included in the Level-2 data
-        # PTU has 2 Hz measurement frequency, while GPS has a 4 Hz measurement frequency
 
-        ###----- Dimensions -----###
+        schema = []
 
-        obs = np.arange(1, ht_indices.sum() + 1, 1)
-        # creating the observations dimension of the NC file
+        for var in dicts.nc_meta.keys():
 
-        ###----- Variables -----###
+            attrs = {
+                key: value for key, value in dicts.nc_meta[var].items() if key != "_FillValue"
+            }
+            # the fill value is set on creation
 
-        height = np.float32(sonde_ds[i].alt[ht_indices].values)
-        # Variable array: geopotential height
+            if var == "time":
+                attrs["units"] = "seconds since 2020-01-01"
+                attrs["calendar"] = "proleptic_gregorian"
+                schema.append((var, "f8", attrs, {}))
+            else:
+                schema.append((var, "f4", attrs, comp))
 
-        time = sonde_ds[i].time[ht_indices].values  # .astype("float").values / 1e9
-        # Variable array: time
+        _level_2_schema[profile] = schema
 
-        variables = {}
+    return _level_2_schema[profile]
 
-        variables["time"] = time
-        variables["alt"] = height
+def write_level_2_netcdf4(save_path, variables, sonde_id, global_attrs, profile=None):
 
-        ###--------- Unit Conversions --------###
+    """
+    Write the Level-2 file of a sonde with netCDF4 directly, using the
+    precomputed level_2_schema() instead of building an xarray dataset
+    """
 
-        if Platform == "HALO":
-            variables["rh"] = np.float32(
-                sonde_ds[i]["rh"][ht_indices].values * 1.06 / 100
-            )
-        elif Platform == "P3":
-            variables["rh"] = np.float32(sonde_ds[i]["rh"][ht_indices].values / 100)
-        variables["lat"] = np.float32(sonde_ds[i]["lat"][ht_indices].values)
-        variables["lon"] = np.float32(sonde_ds[i]["lon"][ht_indices].values)
-        variables["p"] = np.float32(sonde_ds[i]["pres"][ht_indices].values * 100)
-        variables["ta"] = np.float32(
-            sonde_ds[i]["tdry"][ht_indices].values + 273.15
-        )
+    time = (variables["time"] - np.datetime64("2020-01-01")) / np.timedelta64(1, "s")
 
-        for var1, var2 in zip(varname_L1, varname_L2):
-            if var2 not in variables.keys():
-                variables[var2] = np.float32(sonde_ds[i][var1][ht_indices].values)
+    with prefetch.hdf5_lock, netCDF4.Dataset(save_path, "w", format="NETCDF4") as nc:
 
-        ###--------- Creating and populating dataset --------###
+        nc.createDimension("time", len(time))
 
-        to_save_ds = xr.Dataset(coords={"time": obs})
+        for var, dtype, attrs, kwargs in level_2_schema(profile):
+            nc_var = nc.createVariable(var, dtype, ("time",), **kwargs)
+            nc_var.setncatts(attrs)
+            nc_var[:] = time if var == "time" else np.ma.masked_invalid(variables[var])
+            # NaN written as the _FillValue, as by the xarray writer
 
-        for var in dicts.nc_meta.keys():
-            # v = var
-            f2.create_variable(to_save_ds, var, variables[var])
-
-        ### ---------- adding the sonde_id var to the dataset --------- #####
-        sonde_id = (
-            status_ds.swap_dims({"sonde_id": "launch_time"})
-            .sel(launch_time=sonde_ds[i].launch_time.values)
-            .sonde_id.values
+        nc_var = nc.createVariable("sonde_id", str, ())
+        nc_var.setncatts(sonde_id_attrs)
+        nc_var[...] = str(sonde_id)
+
+        nc.setncatts(
+            {key: (str(value) if isinstance(value, (bool, type(None))) else value)
+             for key, value in global_attrs.items()}
         )
-        attrs = {
-            "descripion": "unique sonde ID",
-            "long_name": "sonde identifier",
-            "cf_role": "trajectory_id",
+
+    return save_path
+
+def level_2_sonde(variables, sonde_id, global_attrs, profile=None):
+
+    """
+    In-memory Level-2 dataset of a sonde in the layout it has when read back from
+    its file, so that the Level-2 store can be written without reading the file
+    """
+
+    dataset = xr.Dataset(
+        {
+            var: (
+                "time",
+                variables[var],
+                {key: value for key, value in attrs.items() if var != "time" or key not in ["units", "calendar"]},
+            )
+            for var, _, attrs, _ in level_2_schema(profile)
         }
-        sonde_id_var = xr.Variable([], sonde_id, attrs=attrs)
-        to_save_ds["sonde_id"] = sonde_id_var
-
-        # file name
-        file_name = (
-            "EUREC4A_JOANNE"
-            # + str(Platform)
-            + "_Dropsonde-RD41_"
-            + str(sonde_id)
-            + "_Level_2"
-            + "_v"
-            + str(joanne.__version__)
-            + ".nc"
-        )
+    )
+    # the units of time are decoded when a file is read
 
-        comp = dict(
-            zlib=True,
-            complevel=4,
-            fletcher32=True,
-            _FillValue=np.finfo("float32").max,
-        )
+    dataset["sonde_id"] = xr.Variable([], str(sonde_id), attrs=sonde_id_attrs)
 
-        encoding = {var: comp for var in to_save_ds.data_vars if var != "sonde_id"}
-        encoding["time"] = {"units": "seconds since 2020-01-01", "dtype": "float"}
+    dataset.attrs = {
+        key: (str(value) if isinstance(value, (bool, type(None))) else value)
+        for key, value in global_attrs.items()
+    }
 
-        nc_global_attrs = dicts.get_global_attrs(
-            Platform, file_time[i], sonde_ds[i]
+    return dataset
+
+def process_sonde(
+    sonde_path,
+    file_time,
+    a_filepaths,
+    save_dir=save_dir,
+    overwrite=False,
+    writer=None,
+    platform=Platform,
+    flight_attrs=None,
+    profile=None,
+    sonde=None,
+    background_writer=None,
+    kept=None,
+):
+
+    """
+    Input :
+        sonde_path : string
+                     path to the ASPEN-processed Level-1 file of the sonde
+        file_time : np.datetime64
+                    sonde time extracted from the file name
+        a_filepaths : list
+                      paths to the A-files of the sonde
+        save_dir : string
+                   directory where the Level-2 file is saved
+        overwrite : bool
+                    if False, an existing Level-2 file of the current version is kept
+        writer : string
+                 "netcdf4" (direct, low-overhead) or "xarray"; read from the
+                 `level_2_writer` option of run_config.cfg if None (run_level_2()
+                 reads it once and passes it on)
+        platform : string
+                   platform of the sonde, for unit conversions and global attributes
+        flight_attrs : dict
+                       flight attributes from the A-file index (see a_file_index.py);
+                       parsed from the first A-file if None
+        profile : string
+                  storage profile (see storage.py); read from the `storage_profile`
+                  option of run_config.cfg if None
+        sonde : xarray dataset
+                the Level-1 file already read (see read_level_1); opened from
+                `sonde_path` if None
+        background_writer : prefetch.BackgroundWriter
+                            if given, the Level-2 file is written in the background
+        kept : dict
+               if given, the Level-2 dataset of the sonde is also kept in it by file
+               path, for the Level-2 store (see level_2_sonde)
+    Output :
+        file path of the Level-2 file (a future of it if written in the background),
+        or None if the sonde is not flagged GOOD
+    Function to convert a single Level-1 sonde to a Level-2 file. The QC status
+    must have been opened in the calling process with init_status()
+    """
+
+    if writer is None:
+        writer = config.get_option("level_2_writer", fallback="netcdf4")
+
+    if writer == "netcdf4" and netCDF4 is None:
+        writer = "xarray"
+
+    profile = storage.get_profile_name(profile)
+
+    with contextlib.nullcontext(sonde) if sonde is not None else xr.open_dataset(sonde_path) as sonde:
+
+        status = status_index.lookup(
+            sonde.launch_time.values,
+            # method="nearest",
+            # tolerance="1s",
         )
 
-        for key in nc_global_attrs.keys():
-            to_save_ds.attrs[key] = nc_global_attrs[key]
+        if status.qc_flag != "GOOD":
+            return None
 
-        flight_attrs = dicts.get_flight_attrs(a_filepaths[i][0])
+        sonde_id = status.sonde_id
 
-        for key in flight_attrs:
-            to_save_ds.attrs[key] = flight_attrs[key]
+        file_name = level_2_file_name(sonde_id)
 
-        ###--------- Saving dataset to NetCDF file --------###
-        
-        if os.path.exists(save_dir + file_name):
+        if os.path.exists(save_dir + file_name) and not overwrite:
 
             print(f"Level-2 file of the current version exists.")
 
-#             to_save_ds = xr.open_dataset(to_save_ds_filename)
-            
-        else :
+            return save_dir + file_name
+
+        with instrumentation.step("Level_2/extract_variables"):
+            variables = extract_level_2_variables(sonde, platform=platform)
+
+        with instrumentation.step("Level_2/global_attrs"):
+            global_attrs = dict(dicts.get_global_attrs(platform, file_time, sonde))
+
+            if flight_attrs is None:
+                flight_attrs = dicts.get_flight_attrs(a_filepaths[0])
+
+            global_attrs.update(flight_attrs)
+
+        if kept is not None:
+            kept[save_dir + file_name] = level_2_sonde(variables, sonde_id, global_attrs, profile)
+
+        ###--------- Saving dataset to NetCDF file --------###
+
+        if background_writer is not None:
+            return background_writer.submit(
+                write_level_2, save_dir + file_name, variables, sonde_id, global_attrs, writer, profile
+            )
+
+        write_level_2(save_dir + file_name, variables, sonde_id, global_attrs, writer, profile)
+
+    return save_dir + file_name
+
+def write_level_2(save_path, variables, sonde_id, global_attrs, writer="netcdf4", profile=None):
+    """
+    Write the Level-2 file of a sonde with the "netcdf4" or "xarray" writer
+    """
+    with instrumentation.step("Level_2/to_netcdf"):
+
+        if writer == "netcdf4":
+
+            write_level_2_netcdf4(save_path, variables, sonde_id, global_attrs, profile)
+
+        else:
+
+            to_save_ds, encoding = build_level_2_dataset(variables, sonde_id, global_attrs, profile)
 
             to_save_ds.to_netcdf(
-                save_dir + file_name,
+                save_path,
                 mode="w",
                 format="NETCDF4",
                 encoding=encoding,
-            )
\ No newline at end of file
+            )
+
+    return save_path
+
+def read_level_1(sonde_path):
+    """
+    Level-1 file of a sonde read into memory, for the prefetching reader (see prefetch.py)
+    """
+    with xr.open_dataset(sonde_path) as sonde:
+        return sonde.load()
+
+def _process_sonde_task(task):
+    """
+    Wrapper around process_sonde() that returns the error instead of raising it,
+    so that one bad sonde does not abort the whole pool; the measurements of
+    the instrumentation are returned along with it
+    """
+    start = time.perf_counter()
+    try:
+        result, error = process_sonde(*task), None
+    except Exception:
+        result, error = None, traceback.format_exc()
+    instrumentation.record_latency("Level_2", time.perf_counter() - start)
+    return result, error, instrumentation.drain()
+
+def _finish_write(result, error):
+    if hasattr(result, "result"):
+        try:
+            result = result.result()
+        except Exception:
+            result, error = None, traceback.format_exc()
+    return result, error, None
+    # measurements stay in the recorder of this process; nothing to merge
+
+def process_sondes_prefetched(tasks, depth=4, threads=2, kept=None):
+
+    """
+    Input :
+        tasks : list
+                arguments of process_sonde() per sonde
+        depth : int
+                number of Level-1 files read ahead, and of Level-2 files waiting to be written
+        threads : int
+                  threads reading Level-1 files
+        kept : dict
+               if given, the Level-2 datasets are kept in it (see process_sonde)
+    Output :
+        generator of (file path, error, None) in the order of `tasks`, like the
+        results of _process_sonde_task()
+
+    Single-process counterpart of mapping _process_sonde_task() over `tasks`: the
+    next `depth` Level-1 files are read and decoded in background threads and the
+    Level-2 files are written by a background writer while the current sonde is
+    converted. A result is only handed out once its file is written, so that
+    _record_results() never records an unfinished file in the manifest
+    """
+
+    reader = prefetch.PrefetchReader(read_level_1, [task[0] for task in tasks], depth=depth, threads=threads)
+
+    pending = collections.deque()
+
+    with prefetch.BackgroundWriter(depth) as background_writer:
+
+        for task, (_, sonde, error) in zip(tasks, tqdm(reader)):
+
+            start = time.perf_counter()
+
+            result = None
+
+            if error is None:
+                try:
+                    result = process_sonde(*task, sonde=sonde, background_writer=background_writer, kept=kept)
+                except Exception:
+                    error = traceback.format_exc()
+
+            instrumentation.record_latency("Level_2", time.perf_counter() - start)
+
+            pending.append((result, error))
+
+            while pending and (
+                len(pending) > depth
+                or not hasattr(pending[0][0], "done")
+                or pending[0][0].done()
+            ):
+                yield _finish_write(*pending.popleft())
+            # finished writes are handed out as they come, at most `depth` are waited for
+
+    while pending:
+        yield _finish_write(*pending.popleft())
+
+def _record_results(manifest, stage, items, keys, results, save_every=50):
+    """
+    Record every successful result in the manifest as it comes in, saving the
+    manifest every `save_every` sondes, so that an interrupted run resumes
+    without redoing the sondes that were already written; generator of
+    (file path, error) per result
+    """
+    for n, (item, key, (file_path, error, timings)) in enumerate(zip(items, keys, results)):
+
+        instrumentation.merge(timings)
+
+        if error is None:
+            manifest.record(stage, item, key, [file_path])
+
+        if (n + 1) % save_every == 0:
+            manifest.save()
+
+        yield file_path, error
+
+def _append_to_store(store, manifest, sonde_paths, pending, results, kept=None):
+    """
+    Pass on the (file path, error) `results` of the `pending` sondes while
+    appending every Level-2 sonde to `store` in the order of `sonde_paths`: a
+    sonde processed now as soon as its result comes in (from `kept` if it was
+    processed in this process, from its file otherwise), an up-to-date sonde
+    from its file. Only the sondes of one store batch are held in memory
+    """
+    results = iter(results)
+    pending = set(pending)
+
+    for i, sonde_path in enumerate(sonde_paths):
+
+        if i in pending:
+            file_path, error = next(results)
+            yield file_path, error
+        else:
+            file_path = (manifest.outputs("Level_2", sonde_path) or [None])[0]
+
+        if file_path is None:
+            continue
+
+        dataset = kept.pop(file_path, None) if kept is not None else None
+
+        if dataset is None:
+            with xr.open_dataset(file_path) as dataset:
+                store.append(dataset, file_path, manifest.hash(file_path))
+        else:
+            store.append(dataset, file_path, manifest.hash(file_path))
+
+def run_level_2(
+    data_dir=data_dir, save_dir=save_dir, workers=1, store_format=None, writer=None, profile=None
+):
+
+    """
+    Input :
+        data_dir : string
+                   platform directory with Level_0/, Level_1/ and QC/ sub-directories
+        save_dir : string
+                   directory where Level-2 files are saved
+        workers : int
+                  number of worker processes; 1 processes all sondes in this process
+        store_format : string
+                       if "netcdf" or "zarr", all Level-2 sondes are also collected in a single
+                       ragged-array store (see level_2_store.py); read from the
+                       `level_2_store` option of run_config.cfg if None
+        writer : string
+                 "netcdf4" or "xarray" (see process_sonde); read from the
+                 `level_2_writer` option of run_config.cfg if None
+        profile : string
+                  storage profile of the Level-2 files and store (see storage.py);
+                  read from the `storage_profile` option of run_config.cfg if None
+    Output :
+        list with the Level-2 file path (or None) of every sonde, in sonde order
+    Function to generate Level-2 files for all GOOD sondes. With workers > 1,
+    sondes are distributed over a process pool where each worker opens, converts
+    and writes its own sondes. Errors are collected per sonde and written to
+    a single report in the QC directory.
+    Sondes whose Level-1 file, A-files and QC status row are unchanged since the
+    last run (see build_cache) are not processed again.
+    """
+
+    if os.path.exists(save_dir):
+        pass
+    else:
+        os.makedirs(save_dir)
+
+    catalog = SondeCatalog(data_dir)
+
+    if writer is None:
+        writer = config.get_option("level_2_writer", fallback="netcdf4")
+
+    profile = storage.get_profile_name(profile)
+
+    platform = platforms.platform_from_directory(data_dir)
+
+    status_filename = get_status_filename(catalog.qc_directory)
+
+    manifest = build_cache.open_manifest(data_dir)
+
+    init_status(status_filename)
+
+    status_rows = [status_index.get(i) for i in catalog.launch_times]
+
+    keys = [
+        manifest.key(
+            [catalog.sonde_paths[i]] + catalog.a_filepaths[i],
+            params={
+                "platform": platform,
+                "status": None
+                if status_rows[i] is None
+                else [status_rows[i].sonde_id, status_rows[i].qc_flag],
+                "save_dir": save_dir,
+                "storage_profile": profile,
+            },
+        )
+        for i in range(len(catalog))
+    ]
+
+    pending = [
+        i
+        for i in range(len(catalog))
+        if not manifest.is_fresh("Level_2", catalog.sonde_paths[i], keys[i])
+    ]
+
+    print(f"{len(catalog) - len(pending)} of {len(catalog)} sondes are up to date.")
+
+    for i in pending:
+        manifest.remove_stale_outputs("Level_2", catalog.sonde_paths[i])
+
+    if store_format is None:
+        store_format = config.get_option("level_2_store", fallback="none")
+
+    store = None
+
+    if store_format in level_2_store.store_formats and (
+        pending
+        or not manifest.is_fresh(
+            "Level_2_store", store_format, _store_key(manifest, catalog, store_format, profile)
+        )
+    ):
+        store = level_2_store.Level2StoreWriter(
+            level_2_store.store_path(data_dir, store_format), store_format=store_format, profile=profile
+        )
+
+        print("Writing Level-2 store...")
+
+    kept = {} if store is not None and workers == 1 else None
+    # Level-2 datasets of the sondes processed in this process, handed to the store
+    # as they come in; worker processes only return file paths, and the store
+    # reads those files back
+
+    a_index = catalog.a_file_index
+
+    tasks = [
+        (
+            catalog.sonde_paths[i],
+            catalog.file_time[i],
+            catalog.a_filepaths[i],
+            save_dir,
+            True,
+            writer,
+            platform,
+            a_index.flight_attrs(catalog.a_files[i]) if catalog.a_filepaths[i] else None,
+            profile,
+        )
+        for i in pending
+    ]
+    # A-files paired with the sondes from a single listing of Level_0/, their flight
+    # attributes taken from the cached A-file index instead of parsing them per sonde
+
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_status, initargs=(status_filename,)
+        ) as executor:
+            results = _record_results(
+                manifest,
+                "Level_2",
+                [catalog.sonde_paths[i] for i in pending],
+                [keys[i] for i in pending],
+                tqdm(executor.map(_process_sonde_task, tasks), total=len(tasks)),
+            )
+            # map() returns the results in sonde order regardless of completion order
+
+            if store is not None:
+                results = _append_to_store(store, manifest, catalog.sonde_paths, pending, results)
+
+            results = list(results)
+    else:
+        depth, io_threads = prefetch.get_prefetch_options()
+        results = _record_results(
+            manifest,
+            "Level_2",
+            [catalog.sonde_paths[i] for i in pending],
+            [keys[i] for i in pending],
+            process_sondes_prefetched(tasks, depth=depth, threads=io_threads, kept=kept),
+        )
+        # Level-1 files read ahead and Level-2 files written in background threads
+
+        if store is not None:
+            results = _append_to_store(store, manifest, catalog.sonde_paths, pending, results, kept=kept)
+
+        results = list(results)
+
+    manifest.save()
+
+    errors = [
+        (task[0], error) for task, (_, error) in zip(tasks, results) if error is not None
+    ]
+
+    if len(errors) > 0:
+
+        report_filename = (
+            f"{catalog.qc_directory}Level_2_errors_v{joanne.__version__}.txt"
+        )
+
+        with open(report_filename, "w") as report:
+            for sonde_path, error in errors:
+                report.write(f"{sonde_path}\n{error}\n")
+
+        print(
+            f"Level-2 failed for {len(errors)} of {len(tasks)} sondes. See {report_filename}"
+        )
+
+    level_2_files = [
+        (manifest.outputs("Level_2", path) or [None])[0] for path in catalog.sonde_paths
+    ]
+
+    if store is not None:
+
+        manifest.record(
+            "Level_2_store",
+            store_format,
+            _store_key(manifest, catalog, store_format, profile),
+            [store.close()],
+        )
+        manifest.save()
+
+    return level_2_files
+
+def _store_key(manifest, catalog, store_format, profile):
+    """
+    Key of the Level-2 store, from the Level-2 files of the sondes currently in the manifest
+    """
+    store_files = [
+        (manifest.outputs("Level_2", path) or [None])[0] for path in catalog.sonde_paths
+    ]
+    return manifest.key(
+        [i for i in store_files if i is not None],
+        params={"format": store_format, "storage_profile": profile},
+    )
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generate Level-2 files from ASPEN-processed sondes")
+    parser.add_argument("--data-dir", default=data_dir)
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+
+    run_level_2(args.data_dir, save_dir=f"{args.data_dir}Level_2/", workers=args.workers)
@@ -2,9 +2,13 @@
 
 # %%
 import datetime
+import json
 import os
 import subprocess
+import threading
+import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm 
 
 import numpy as np
@@ -15,6 +19,16 @@ from joanne.Level_3 import fn_3 as f3
 from joanne.Level_3 import dicts as dicts
 import joanne
 
+import build_cache
+import config
+import instrumentation
+import level_2_store
+import prefetch
+import sonde_index
+import storage
+from level_2_store import Level2Store
+from status_index import QCStatusIndex
+
 warnings.filterwarnings(
     "ignore", module="metpy.calc.thermo", message="invalid value encountered"
 )
@@ -84,18 +98,21 @@ def interpolate_for_level_3(
     else:
         dataset = file_path_OR_dataset
 
-    interpolated_dataset = f3.interp_along_height(
-        dataset, height_limit=height_limit, vertical_spacing=vertical_spacing
-    )
+    with instrumentation.step("Level_3/interp_along_height"):
+        interpolated_dataset = f3.interp_along_height(
+            dataset, height_limit=height_limit, vertical_spacing=vertical_spacing
+        )
 
-    interpolated_dataset = f3.get_N_and_m_values(
-        interpolated_dataset, dataset, bin_length=vertical_spacing
-    )
+    with instrumentation.step("Level_3/get_N_and_m_values"):
+        interpolated_dataset = f3.get_N_and_m_values(
+            interpolated_dataset, dataset, bin_length=vertical_spacing
+        )
 
     if pressure_log_interp is True:
-        interpolated_dataset = f3.add_log_interp_pressure_to_dataset(
-            dataset, interpolated_dataset
-        )
+        with instrumentation.step("Level_3/add_log_interp_pressure"):
+            interpolated_dataset = f3.add_log_interp_pressure_to_dataset(
+                dataset, interpolated_dataset
+            )
 
     interpolated_dataset = substitute_T_and_RH_for_interpolated_dataset(
         interpolated_dataset
@@ -123,11 +140,440 @@ def interpolate_for_level_3(
 
     return interpolated_dataset
 
+#### Batched interpolation of all sondes at once #####
+
+def _bin_means(values, flat_bin, n_cells):
+
+    """
+    Input :
+        values : np.ndarray
+                 ragged values of all sondes, concatenated (float)
+        flat_bin : np.ndarray
+                   cell index (sonde * n_bins + bin) of every value, -1 outside the grid
+        n_cells : int
+                  number of sondes times number of bins
+    Output :
+        means, counts : np.ndarray
+                        bin-averaged values (NaN for empty bins) and number of values per bin
+    """
+    valid = (flat_bin >= 0) & ~np.isnan(values)
+
+    counts = np.bincount(flat_bin[valid], minlength=n_cells)
+    sums = np.bincount(flat_bin[valid], weights=values[valid], minlength=n_cells)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+
+    return means, counts
+
+def _fill_gaps(values, grid, max_gap):
+
+    """
+    Input :
+        values : np.ndarray
+                 2-D array (sondes, altitude) with NaN where a bin is empty
+        grid : np.ndarray
+               altitude of the bins
+        max_gap : float
+                  largest gap (in m, between valid neighbours) that is filled
+    Output :
+        values : np.ndarray
+                 array with gaps no larger than max_gap linearly interpolated,
+                 the vectorized equivalent of interpolate_na(max_gap=..., use_coordinate=True)
+    """
+    n_alt = values.shape[-1]
+    idx = np.arange(n_alt)
+    valid = ~np.isnan(values)
+
+    prev = np.maximum.accumulate(np.where(valid, idx, -1), axis=-1)
+    nxt = np.minimum.accumulate(np.where(valid, idx, n_alt)[..., ::-1], axis=-1)[..., ::-1]
+    # index of the nearest valid bin below and above every bin
+
+    prev_c = np.clip(prev, 0, n_alt - 1)
+    nxt_c = np.clip(nxt, 0, n_alt - 1)
+
+    gap = grid[nxt_c] - grid[prev_c]
+    fill = ~valid & (prev >= 0) & (nxt < n_alt) & (gap <= max_gap)
+
+    lower = np.take_along_axis(values, prev_c, axis=-1)
+    upper = np.take_along_axis(values, nxt_c, axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = (grid[idx] - grid[prev_c]) / gap
+
+    return np.where(fill, lower + weight * (upper - lower), values)
+
+def _log_interp_pressure(alt, p, sonde_index, n_sondes, grid):
+
+    """
+    Input :
+        alt, p, sonde_index : np.ndarray
+                              ragged altitude, pressure and sonde index of all sondes
+        grid : np.ndarray
+               altitude grid
+    Output :
+        p_grid : np.ndarray
+                 2-D (sondes, altitude) pressure interpolated linearly in log(p),
+                 NaN outside the altitude range of each sonde
+    All sondes are interpolated by one np.interp call by shifting the altitudes of
+    sonde k by k * offset, so that the concatenated profiles stay monotonic
+    """
+    valid = ~np.isnan(alt) & ~np.isnan(p) & (p > 0)
+    alt, p, sonde_index = alt[valid], p[valid], sonde_index[valid]
+
+    offset = (np.nanmax(np.abs(alt)) + grid[-1] + 1) * 2 if len(alt) > 0 else 1.0
+
+    order = np.lexsort((alt, sonde_index))
+    x = alt[order] + sonde_index[order] * offset
+    y = np.log(p[order])
+
+    query = grid[np.newaxis, :] + np.arange(n_sondes)[:, np.newaxis] * offset
+
+    lower = np.full(n_sondes, np.inf)
+    upper = np.full(n_sondes, -np.inf)
+    np.minimum.at(lower, sonde_index, alt)
+    np.maximum.at(upper, sonde_index, alt)
+    inside = (grid[np.newaxis, :] >= lower[:, np.newaxis]) & (
+        grid[np.newaxis, :] <= upper[:, np.newaxis]
+    )
+
+    if len(x) == 0:
+        return np.full(query.shape, np.nan)
+
+    return np.where(inside, np.exp(np.interp(query, x, y)), np.nan)
+
+def batch_interpolate_for_level_3(
+    list_of_files,
+    height_limit=10000,
+    vertical_spacing=10,
+    pressure_log_interp=True,
+    max_gap=50,
+):
+
+    """
+    Input :
+        list_of_files : list
+                        paths to Level-2 files (or datasets already prepared with
+                        f3.ready_to_interpolate)
+        max_gap : float
+                  largest gap in m filled by linear interpolation after bin-averaging
+    Output :
+        dataset : xarray dataset
+                  interpolated dataset with (sonde_id, alt) dimensions; a ValueError
+                  is raised if no sonde has data to grid
+    Batched counterpart of interpolate_for_level_3() followed by f3.concatenate_soundings():
+    the profiles of all sondes are concatenated into ragged arrays and the
+    bin-averaging, gap filling, N/m counts and log-pressure interpolation are done
+    for all sondes in one vectorized pass over the f3.interpolation_bins grid
+    """
+
+    datasets = [
+        f3.ready_to_interpolate(i) if type(i) is str else i for i in list_of_files
+    ]
+    datasets = [ds for ds in datasets if "ta" in ds.variables]
+
+    if len(datasets) == 0:
+        raise ValueError(
+            f"None of the {len(list_of_files)} Level-2 sondes has data to grid "
+            "(no sonde flagged GOOD, or none with temperature)"
+        )
+
+    grid = np.arange(0, height_limit + vertical_spacing, vertical_spacing)
+    bins = np.append(grid - vertical_spacing / 2, grid[-1] + vertical_spacing / 2)
+    n_sondes, n_bins = len(datasets), len(grid)
+    n_cells = n_sondes * n_bins
+
+    profile_dim = datasets[0].alt.dims[0]
+
+    var_names = [
+        var
+        for var in list(datasets[0].variables)
+        if var != "alt"
+        and datasets[0][var].dims == (profile_dim,)
+        and datasets[0][var].dtype.kind in "fiM"
+    ]
+    # all numeric and time variables along the profile
+
+    sizes = [ds.sizes[profile_dim] for ds in datasets]
+    sonde_index = np.repeat(np.arange(n_sondes), sizes)
+
+    alt = np.concatenate([ds.alt.values for ds in datasets]).astype("float64")
+
+    bin_index = np.searchsorted(bins, alt, side="left") - 1
+    # bins are (lower, upper], as in f3.interp_along_height
+    in_grid = (bin_index >= 0) & (bin_index < n_bins)
+    flat_bin = np.where(in_grid, sonde_index * n_bins + bin_index, -1)
+
+    data_vars = {}
+    counts = {}
+
+    for var in var_names:
+
+        values = np.concatenate([ds[var].values for ds in datasets])
+        is_time = values.dtype.kind == "M"
+
+        if is_time:
+            nat = np.isnat(values)
+            values = values.astype("datetime64[ns]").astype("int64").astype("float64")
+            values[nat] = np.nan
+        else:
+            values = values.astype("float64")
+
+        means, counts[var] = _bin_means(values, flat_bin, n_cells)
+        means = _fill_gaps(means.reshape(n_sondes, n_bins), grid, max_gap)
+
+        if is_time:
+            nat = np.isnan(means)
+            means = np.where(nat, 0, means).astype("int64").astype("datetime64[ns]")
+            means[nat] = np.datetime64("NaT")
+            var = "interpolated_time" if var == "time" else var
+
+        data_vars[var] = (["sonde_id", "alt"], means)
+
+    ###----- N and m values -----###
+
+    for suffix, var in [("ptu", "p"), ("gps", "u")]:
+        N = counts[var].reshape(n_sondes, n_bins)
+        m = np.where(N > 0, 2, np.where(~np.isnan(data_vars[var][1]), 1, 0))
+        # 2 : bin-averaged, 1 : interpolated, 0 : no data
+        data_vars[f"N_{suffix}"] = (["sonde_id", "alt"], N)
+        data_vars[f"m_{suffix}"] = (["sonde_id", "alt"], m)
+
+    if pressure_log_interp is True:
+        p = np.concatenate([ds.p.values for ds in datasets]).astype("float64")
+        data_vars["p"] = (
+            ["sonde_id", "alt"],
+            _log_interp_pressure(alt, p, sonde_index, n_sondes, grid),
+        )
+
+    ###----- Per-sonde details -----###
+
+    sonde_details = [f3.add_platform_details_as_var(ds) for ds in datasets]
+
+    for var in [
+        "platform_id",
+        "flight_altitude",
+        "flight_lat",
+        "flight_lon",
+        "launch_time",
+        "low_height_flag",
+    ]:
+        data_vars[var] = (
+            ["sonde_id"],
+            np.array([ds[var].values for ds in sonde_details]),
+        )
+
+    sonde_id = np.array([ds["sonde_id"].values for ds in sonde_details])
+
+    interpolated_dataset = xr.Dataset(
+        data_vars, coords={"sonde_id": sonde_id, "alt": grid}
+    )
+
+    interpolated_dataset = substitute_T_and_RH_for_interpolated_dataset(
+        interpolated_dataset
+    )
+
+    interpolated_dataset = substitute_wdir_for_interpolated_dataset(
+        interpolated_dataset
+    )
+
+    return interpolated_dataset
+
+def ready_to_interpolate_dataset(dataset):
+    """
+    Input :
+        dataset : xarray dataset
+                  Level-2 sonde already in memory (e.g. read from a Level-2 store)
+    Output :
+        dataset : xarray dataset
+                  dataset with q, theta and wind components added
+    In-memory counterpart of f3.ready_to_interpolate(), which only accepts file paths
+    """
+    dataset = f3.adding_q_and_theta_to_dataset(dataset)
+    dataset = f3.add_wind_components_to_dataset(dataset)
+
+    return dataset
+
+_open_stores = {}
+# Level-2 stores opened by the current process, by path
+_open_stores_lock = threading.Lock()
+
+def load_level_2(source):
+    """
+    Input :
+        source : string or tuple
+                 path to a per-sonde Level-2 file, or (store path, position) of a
+                 sonde in a Level-2 store
+    Output :
+        dataset : xarray dataset
+                  Level-2 sonde ready to be interpolated
+    """
+    if type(source) is str:
+        return f3.ready_to_interpolate(source)
+
+    path, position = source
+
+    with _open_stores_lock:
+        if path not in _open_stores:
+            _open_stores[path] = Level2Store(path)
+    # the prefetching reader loads sondes from several threads
+
+    return ready_to_interpolate_dataset(_open_stores[path].get(position))
+
+def read_level_2(source):
+    """
+    load_level_2() with the data read into memory, so that the prefetching reader
+    (see prefetch.py) does all the file I/O and decompression in its threads
+    """
+    return load_level_2(source).load()
+
+def sonde_id_from_file_name(file_path):
+    """
+    Sonde ID from a Level-2 file name (EUREC4A_JOANNE_Dropsonde-RD41_<sonde_id>_Level_2_v<version>.nc)
+    """
+    file_name = os.path.basename(file_path)
+    return file_name[file_name.find("RD41_") + 5 : file_name.find("_Level_2")]
+
+def interim_file_name(file_path):
+    """
+    Name of the Level-3 interim file for a Level-2 file path
+    """
+    return (
+        "EUREC4A_JOANNE_Dropsonde-RD41_"
+        + str(file_path[file_path.find("RD41_") + 3 : file_path.find("RD41_") + 19])
+        + "Level_3_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+
+def write_interim(interpolated_dataset, save_path, profile=None):
+    """
+    Write an interpolated sonde to its interim file, with the interim compression
+    of the storage profile
+    """
+    comp = storage.netcdf_compression(profile, interim=True)
+
+    with instrumentation.step("Level_3/to_netcdf"):
+        interpolated_dataset.to_netcdf(
+            save_path,
+            encoding={
+                var: comp
+                for var in interpolated_dataset.data_vars
+                if interpolated_dataset[var].dtype.kind == "f"
+            } if comp else None,
+        )
+
+    return save_path
+
+def interpolate_and_save(
+    source,
+    save_path,
+    height_limit=10000,
+    vertical_spacing=10,
+    pressure_log_interp=True,
+    overwrite=False,
+    profile=None,
+):
+    """
+    Input :
+        source : string or tuple
+                 Level-2 file path or (store path, position), see load_level_2()
+        save_path : string
+                    path of the interim file to be written
+        overwrite : bool
+                    if False, an existing interim file is kept
+        profile : string
+                  storage profile, for the compression of interim files (see storage.py)
+    Output :
+        save_path : string
+    Function to interpolate one Level-2 sonde and write its interim file, unless the
+    interim file already exists. Runs in the worker processes of lv3_structure_from_lv2()
+    """
+    if overwrite or not os.path.exists(save_path):
+
+        with instrumentation.step("Level_3/load_level_2"):
+            dataset = load_level_2(source)
+
+        interpolated_dataset = interpolate_for_level_3(
+            dataset,
+            height_limit=height_limit,
+            vertical_spacing=vertical_spacing,
+            pressure_log_interp=pressure_log_interp,
+        )
+
+        write_interim(interpolated_dataset, save_path, profile)
+
+    return save_path
+
+def _interpolate_and_save_task(task):
+    start = time.perf_counter()
+    save_path = interpolate_and_save(*task)
+    instrumentation.record_latency("Level_3", time.perf_counter() - start)
+    return save_path, instrumentation.drain()
+
+def interpolate_and_save_prefetched(tasks, depth=4, threads=2):
+
+    """
+    Input :
+        tasks : list
+                arguments of interpolate_and_save() per sonde
+        depth : int
+                number of sondes read ahead, and of interim files waiting to be written
+        threads : int
+                  threads reading Level-2 sondes
+    Output :
+        list of (interim file path, None) in the order of `tasks`, like the
+        results of _interpolate_and_save_task()
+
+    Single-process counterpart of mapping interpolate_and_save() over `tasks`:
+    the next `depth` Level-2 sondes are read and decoded in background threads
+    and the interim files are written by a background writer, so that the
+    interpolation of the current sonde overlaps with the I/O of its neighbours.
+    Raises the first read or write error, like the sequential loop
+    """
+
+    reader = prefetch.PrefetchReader(read_level_2, [task[0] for task in tasks], depth=depth, threads=threads)
+
+    futures = []
+
+    with prefetch.BackgroundWriter(depth) as writer:
+
+        for task, (source, dataset, error) in zip(tasks, tqdm(reader)):
+
+            if error is not None:
+                raise RuntimeError(f"Reading {source} failed:\n{error}")
+
+            _, save_path, height_limit, vertical_spacing, pressure_log_interp, _, profile = task
+
+            start = time.perf_counter()
+
+            interpolated_dataset = interpolate_for_level_3(
+                dataset,
+                height_limit=height_limit,
+                vertical_spacing=vertical_spacing,
+                pressure_log_interp=pressure_log_interp,
+            )
+
+            futures.append(writer.submit(write_interim, interpolated_dataset, save_path, profile))
+
+            instrumentation.record_latency("Level_3", time.perf_counter() - start)
+
+    return [(future.result(), None) for future in futures]
+    # measurements stay in the recorder of this process; nothing to merge
+
 def lv3_structure_from_lv2(
     directory,
     height_limit=10000,
     vertical_spacing=10,
     pressure_log_interp=True,
+    workers=1,
+    engine="sonde",
+    manifest=None,
+    status_index=None,
+    level_2_store=None,
+    return_interim_paths=False,
+    profile=None,
+    return_sonde_keys=False,
 ):
     """
     Input :
@@ -136,6 +582,30 @@ def lv3_structure_from_lv2(
                                      a list of file paths for all NC files in the directory is created,
                                      otherwise a list of file paths needed to be gridded can also be 
                                      provided directly
+        workers : int
+                  number of worker processes interpolating and writing interim files;
+                  1 runs everything in the current process
+        engine : string
+                 "sonde" interpolates each sonde separately and caches interim files,
+                 "batch" interpolates all sondes at once with batch_interpolate_for_level_3()
+        manifest : build_cache.BuildManifest
+                   manifest used to reuse interim files whose Level-2 file and
+                   parameters are unchanged; opened from `directory` if None
+        status_index : status_index.QCStatusIndex
+                       if provided, only Level-2 files of sondes flagged GOOD are gridded
+        level_2_store : string
+                        path to a Level-2 store (see level_2_store.py); if provided, sondes
+                        are read as slices of the store instead of per-sonde files
+        return_interim_paths : bool
+                               if True and engine is "sonde", the paths of the interim files are
+                               returned instead of their concatenation, so that they can be
+                               streamed into the output (see iter_level_3_batches)
+        profile : string
+                  storage profile of the interim files (see storage.py);
+                  `storage_profile` option if None
+        return_sonde_keys : bool
+                            if True, a dict of the build key of every gridded sonde by
+                            sonde_id is returned as well, see write_level_3_zarr()
     Output :
         dataset : xarray dataset
                   dataset with Level-3 structure
@@ -143,9 +613,69 @@ def lv3_structure_from_lv2(
     Function to create Level-3 gridded dataset from Level-2 files
     """
     
-    list_of_files = f3.retrieve_all_files(directory+'Level_2/', file_ext="*.nc")
+    if manifest is None:
+        manifest = build_cache.open_manifest(directory)
 
-    interp_list = [None] * len(list_of_files)
+    profile = storage.get_profile_name(profile)
+
+    params = {
+        "height_limit": height_limit,
+        "vertical_spacing": vertical_spacing,
+        "pressure_log_interp": pressure_log_interp,
+    }
+
+    if level_2_store is not None:
+
+        store = Level2Store(level_2_store)
+
+        sources = [(level_2_store, i) for i in range(len(store))]
+        items = [f"{level_2_store}:{sonde_id}" for sonde_id in store.sonde_ids]
+        names = store.source_files
+        sonde_ids = store.sonde_ids
+        keys = [
+            manifest.key(
+                params=dict(
+                    params,
+                    source=store.source_hashes[i] if store.source_hashes else sonde_ids[i],
+                )
+            )
+            for i in range(len(store))
+        ]
+
+        store.close()
+
+    else:
+
+        list_of_files = f3.retrieve_all_files(directory+'Level_2/', file_ext="*.nc")
+
+        sources = list_of_files
+        items = list_of_files
+        names = list_of_files
+        sonde_ids = [sonde_id_from_file_name(file_path) for file_path in list_of_files]
+        keys = [manifest.key([file_path], params=params) for file_path in list_of_files]
+
+    if status_index is not None:
+        selected = [
+            i
+            for i, sonde_id in enumerate(sonde_ids)
+            if getattr(status_index.by_sonde_id.get(sonde_id), "qc_flag", None) == "GOOD"
+        ]
+    else:
+        selected = list(range(len(sources)))
+
+    sonde_keys = {str(sonde_ids[i]): keys[i] for i in selected}
+
+    if engine == "batch":
+        depth, io_threads = prefetch.get_prefetch_options()
+        dataset = batch_interpolate_for_level_3(
+            list(prefetch.prefetch(read_level_2, [sources[i] for i in selected], depth, io_threads)),
+            height_limit=height_limit,
+            vertical_spacing=vertical_spacing,
+            pressure_log_interp=pressure_log_interp,
+        )
+        return (dataset, sonde_keys) if return_sonde_keys else dataset
+    elif engine != "sonde":
+        raise ValueError(f"Unknown Level-3 engine: {engine}")
 
     save_directory = f"{directory}Level_3/Interim_files/"
     
@@ -154,30 +684,50 @@ def lv3_structure_from_lv2(
     else:
         os.makedirs(save_directory)
 
-    for id_, file_path in enumerate(tqdm(list_of_files)):
+    interim_paths = [save_directory + interim_file_name(names[i]) for i in selected]
+
+    pending = [
+        n
+        for n, i in enumerate(selected)
+        if not manifest.is_fresh("Level_3_interim", items[i], keys[i])
+    ]
 
-        file_name = (
-            "EUREC4A_JOANNE_Dropsonde-RD41_"
-            + str(file_path[file_path.find("RD41_") + 3 : file_path.find("RD41_") + 19])
-            + "Level_3_v"
-            + str(joanne.__version__)
-            + ".nc"
+    print(f"{len(selected) - len(pending)} of {len(selected)} interim files are up to date.")
+
+    tasks = [
+        (
+            sources[selected[n]],
+            interim_paths[n],
+            height_limit,
+            vertical_spacing,
+            pressure_log_interp,
+            True,
+            profile,
         )
+        for n in pending
+    ]
 
-        if os.path.exists(save_directory + file_name):
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            written = list(
+                tqdm(executor.map(_interpolate_and_save_task, tasks), total=len(tasks))
+            )
+            # map() returns the interim files in the order of the sources
+    else:
+        depth, io_threads = prefetch.get_prefetch_options()
+        written = interpolate_and_save_prefetched(tasks, depth=depth, threads=io_threads)
 
-            interp_list[id_] = xr.open_dataset(save_directory + file_name)
+    for n, (save_path, timings) in zip(pending, written):
+        instrumentation.merge(timings)
+        i = selected[n]
+        manifest.record("Level_3_interim", items[i], keys[i], [save_path])
 
-        else:
+    manifest.save()
 
-            interp_list[id_] = interpolate_for_level_3(
-                file_path,
-                height_limit=height_limit,
-                vertical_spacing=vertical_spacing,
-                pressure_log_interp=pressure_log_interp,
-            )
+    if return_interim_paths:
+        return (interim_paths, sonde_keys) if return_sonde_keys else interim_paths
 
-            interp_list[id_].to_netcdf(save_directory + file_name)
+    interp_list = [xr.open_dataset(i) for i in interim_paths]
 
     concat_list = []
     for i in interp_list:
@@ -187,7 +737,211 @@ def lv3_structure_from_lv2(
 
     dataset = f3.concatenate_soundings(concat_list)
 
-    return dataset
+    return (dataset, sonde_keys) if return_sonde_keys else dataset
+
+#### Writing the Level-3 product #####
+
+def structure_level_3(lv3_dataset, vertical_spacing=10):
+
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      concatenated interpolated sondes, (sonde_id, alt)
+    Output :
+        to_save_ds : xarray dataset
+                     dataset with Level-3 variables, attributes and alt_bnds
+    """
+
+    # # %%
+    nc_data = {}
+
+    for var in dicts.list_of_vars:
+        if lv3_dataset[var].values.dtype == "float64":
+            nc_data[var] = np.float32(lv3_dataset[var].values)
+        else:
+            nc_data[var] = lv3_dataset[var].values
+    # %%
+
+    obs = np.arange(
+        0, len(lv3_dataset.alt) * vertical_spacing, vertical_spacing, dtype="short"
+    )
+    sonde_id = lv3_dataset.sonde_id.values
+
+    to_save_ds = xr.Dataset(coords={"alt": obs, "sonde_id": sonde_id})
+
+    for dim in dicts.dim_attrs:
+        to_save_ds[dim] = to_save_ds[dim].assign_attrs(dicts.dim_attrs[dim])
+
+    for var in dicts.list_of_vars:
+        f3.create_variable(
+            to_save_ds, var, data=nc_data, dims=dicts.nc_dims, attrs=dicts.nc_attrs
+        )
+
+    to_save_ds["alt_bnds"] = (
+        ["alt", "nv"],
+        np.array([obs - vertical_spacing / 2, obs + vertical_spacing / 2]).T.astype("int32"),
+    )
+    to_save_ds["alt_bnds"] = to_save_ds["alt_bnds"].assign_attrs(
+        {
+            # "long_name": "cell altitude_bounds",
+            "description": "cell interval bounds for altitude",
+            "_FillValue": False,
+            "comment": "(lower bound, upper bound]",
+            "units": "m",
+        }
+    )
+
+    for key in dicts.nc_global_attrs.keys():
+        to_save_ds.attrs[key] = dicts.nc_global_attrs[key]
+
+    return to_save_ds
+
+def level_3_encoding(to_save_ds, chunk_sondes=None, zarr=False, profile=None):
+
+    """
+    Input :
+        to_save_ds : xarray dataset
+                     output of structure_level_3()
+        chunk_sondes : int
+                       if given, (sonde_id, alt) variables are chunked with this many
+                       sondes per chunk and the full altitude column
+        zarr : bool
+               if True, the Zarr compressor of the profile is used instead of the
+               NetCDF compression options
+        profile : string
+                  storage profile (see storage.py); `storage_profile` option if None
+    Output :
+        encoding : dict
+    """
+
+    comp = dict(storage.encoding(profile, zarr=zarr), _FillValue=np.finfo("float32").max)
+
+    encoding = {
+        var: dict(comp)
+        for var in to_save_ds.data_vars
+        if var not in ["platform_id", "sonde_id", "alt_bnds"]
+    }
+    encoding["launch_time"] = {"units": "seconds since 2020-01-01", "dtype": "int32"}
+    encoding["interpolated_time"] = {
+        "units": "seconds since 2020-01-01",
+        "dtype": "int32",
+        "_FillValue": np.iinfo("int32").max,
+    }
+
+    if chunk_sondes is not None:
+        for var in encoding:
+            dims = to_save_ds[var].dims
+            if "sonde_id" in dims:
+                chunks = tuple(
+                    min(chunk_sondes, to_save_ds.sizes[dim]) if dim == "sonde_id" else to_save_ds.sizes[dim]
+                    for dim in dims
+                )
+                encoding[var]["chunks" if zarr else "chunksizes"] = chunks
+
+    return encoding
+
+def iter_level_3_batches(interim_paths, batch_size=64):
+
+    """
+    Input :
+        interim_paths : list
+                        paths to the Level-3 interim files
+        batch_size : int
+                     number of interim files opened at a time
+    Output :
+        generator of concatenated interpolated datasets, batch_size sondes each,
+        so that only one batch is held in memory while writing
+    """
+
+    for start in range(0, len(interim_paths), batch_size):
+
+        interp_list = [xr.open_dataset(i) for i in interim_paths[start : start + batch_size]]
+
+        concat_list = [i for i in interp_list if "ta" in i.variables]
+
+        if len(concat_list) > 0:
+            yield f3.concatenate_soundings(concat_list).load()
+
+        for i in interp_list:
+            i.close()
+
+def write_level_3_zarr(
+    batches, save_path, height_limit=10000, vertical_spacing=10, chunk_sondes=64, profile=None, sonde_keys=None
+):
+
+    """
+    Input :
+        batches : iterable
+                  interpolated datasets with (sonde_id, alt) dimensions
+        save_path : string
+                    path of the Zarr store
+        height_limit, vertical_spacing : int
+                                         altitude grid of the sondes in `batches`, m
+        sonde_keys : dict
+                     build key of every sonde to be in the store, by sonde_id (see
+                     lv3_structure_from_lv2); kept in the `sonde_keys` attribute of the store
+        profile : string
+                  storage profile (see storage.py); `storage_profile` option if None.
+                  Kept in the `storage_profile` attribute of the store
+    Output :
+        save_path : string
+    Function to write the Level-3 product to a Zarr store chunked along sonde_id.
+    If the store exists with the same altitude grid and every sonde in it is still
+    to be written with an unchanged key, only the new sondes are appended, without
+    rewriting existing chunks. Otherwise (a sonde was removed, e.g. flagged BAD, or
+    reprocessed, the storage profile changed, or no keys are given) the store is
+    created anew, as appended chunks keep the compressor the store was created with
+    """
+
+    profile = storage.get_profile_name(profile)
+
+    grid = np.arange(0, height_limit + vertical_spacing, vertical_spacing)
+
+    existing = {}
+    append = False
+
+    if sonde_keys is not None and os.path.exists(save_path):
+        with xr.open_zarr(save_path) as store:
+            stored_keys = json.loads(store.attrs.get("sonde_keys", "null"))
+            if (
+                stored_keys is not None
+                and store.attrs.get("storage_profile") == profile
+                and store.sizes.get("alt") == len(grid)
+                and np.array_equal(store.alt.values, grid)
+                and set(str(i) for i in store.sonde_id.values) == set(stored_keys)
+                and all(sonde_keys.get(i) == key for i, key in stored_keys.items())
+            ):
+                existing = stored_keys
+                append = True
+
+    for lv3_dataset in batches:
+
+        new = [str(i) not in existing for i in lv3_dataset.sonde_id.values]
+
+        if not any(new):
+            continue
+
+        to_save_ds = structure_level_3(
+            lv3_dataset.isel(sonde_id=np.flatnonzero(new)),
+            vertical_spacing=vertical_spacing,
+        )
+
+        existing.update({str(i): (sonde_keys or {}).get(str(i)) for i in to_save_ds.sonde_id.values})
+        to_save_ds.attrs["sonde_keys"] = json.dumps(existing)
+        to_save_ds.attrs["storage_profile"] = profile
+        # updated with every write, so that an interrupted write leaves consistent keys
+
+        if append:
+            to_save_ds.drop_vars("alt_bnds").to_zarr(save_path, append_dim="sonde_id")
+        else:
+            to_save_ds.to_zarr(
+                save_path,
+                mode="w",
+                encoding=level_3_encoding(to_save_ds, chunk_sondes=chunk_sondes, zarr=True, profile=profile),
+            )
+            append = True
+
+    return save_path
 
 ######## Generating Level-3 ######
 
@@ -195,72 +949,201 @@ data_directory = (
     "extra/Sample_Data/20200122/HALO/"  # Level_2/"  # code_testing_data/"
 )
 
-print("Creating / checking for interim files...")
+def generate_level_3(
+    data_directory=data_directory,
+    workers=None,
+    engine=None,
+    height_limit=None,
+    vertical_spacing=None,
+    pressure_log_interp=None,
+    store_format=None,
+    output_format=None,
+    chunk_sondes=None,
+    profile=None,
+):
 
-lv3_dataset = lv3_structure_from_lv2(data_directory,pressure_log_interp=False)
+    """
+    Input :
+        data_directory : string
+                         platform directory with the Level_2/ sub-directory
+        workers : int
+                  number of worker processes; read from run_config.cfg if None
+        engine : string
+                 "sonde" or "batch" (see lv3_structure_from_lv2); read from run_config.cfg if None
+        height_limit, vertical_spacing : int
+                                         altitude grid in m; read from run_config.cfg if None
+        pressure_log_interp : bool
+                              interpolate pressure in log(p); read from the `pressure_log_interp`
+                              option of run_config.cfg if None (linear by default)
+        store_format : string
+                       "none", "netcdf" or "zarr"; if a Level-2 store of this format exists,
+                       sondes are read from it instead of the per-sonde files;
+                       read from the `level_2_store` option of run_config.cfg if None
+        output_format : string
+                        "netcdf" writes a single NetCDF file chunked along sonde_id,
+                        "zarr" writes (or appends new sondes to) a Zarr store;
+                        read from the `level_3_format` option of run_config.cfg if None
+        chunk_sondes : int
+                       number of sondes per chunk, and per batch read from the interim files;
+                       read from the `level_3_chunk_sondes` option of run_config.cfg if None
+        profile : string
+                  storage profile (see storage.py); read from the `storage_profile`
+                  option of run_config.cfg if None
+    Function to grid all Level-2 files and save the Level-3 file. Nothing is
+    done if the Level-3 file is up to date with the Level-2 files and parameters
+    """
 
-# # %%
-nc_data = {}
+    if workers is None:
+        workers = config.get_workers()
 
-for var in dicts.list_of_vars:
-    if lv3_dataset[var].values.dtype == "float64":
-        nc_data[var] = np.float32(lv3_dataset[var].values)
-    else:
-        nc_data[var] = lv3_dataset[var].values
-# %%
+    if engine is None:
+        engine = config.get_option("level_3_engine", fallback="sonde")
+
+    if height_limit is None:
+        height_limit = int(config.get_option("height_limit", fallback=10000))
 
-obs = np.arange(0, len(lv3_dataset.alt) * 10, 10, dtype="short")
-sonde_id = lv3_dataset.sonde_id.values
+    if vertical_spacing is None:
+        vertical_spacing = int(config.get_option("vertical_spacing", fallback=10))
 
-to_save_ds = xr.Dataset(coords={"alt": obs, "sonde_id": sonde_id})
+    if pressure_log_interp is None:
+        pressure_log_interp = config.read_config()["DEFAULT"].getboolean("pressure_log_interp", fallback=False)
 
-for dim in dicts.dim_attrs:
-    to_save_ds[dim] = to_save_ds[dim].assign_attrs(dicts.dim_attrs[dim])
+    if output_format is None:
+        output_format = config.get_option("level_3_format", fallback="netcdf")
 
-for var in dicts.list_of_vars:
-    f3.create_variable(
-        to_save_ds, var, data=nc_data, dims=dicts.nc_dims, attrs=dicts.nc_attrs
+    if chunk_sondes is None:
+        chunk_sondes = int(config.get_option("level_3_chunk_sondes", fallback=64))
+
+    profile = storage.get_profile_name(profile)
+
+    file_name = (
+        "EUREC4A_JOANNE_Dropsonde-RD41_" + "Level_3_v" + str(joanne.__version__) + ".nc"
     )
 
-to_save_ds["alt_bnds"] = (
-    ["alt", "nv"],
-    np.array([f3.interpolation_bins[:-1], f3.interpolation_bins[1:]]).T.astype("int32"),
-)
-to_save_ds["alt_bnds"] = to_save_ds["alt_bnds"].assign_attrs(
-    {
-        # "long_name": "cell altitude_bounds",
-        "description": "cell interval bounds for altitude",
-        "_FillValue": False,
-        "comment": "(lower bound, upper bound]",
-        "units": "m",
+    save_directory = f"{data_directory}Level_3/"  # Test_data/" #Level_3/"
+
+    if os.path.exists(save_directory):
+        pass
+    else:
+        os.makedirs(save_directory)
+
+    if store_format is None:
+        store_format = config.get_option("level_2_store", fallback="none")
+
+    store = None
+
+    if store_format in level_2_store.store_formats:
+        store = level_2_store.store_path(data_directory, store_format)
+        if not os.path.exists(store):
+            store = None
+
+    manifest = build_cache.open_manifest(data_directory)
+
+    params = {
+        "height_limit": height_limit,
+        "vertical_spacing": vertical_spacing,
+        "pressure_log_interp": pressure_log_interp,
+        "engine": engine,
+        "output_format": output_format,
+        "storage_profile": profile,
     }
-)
 
-print('Saving Level-3 file...')
+    if store is None:
+        level_3_key = manifest.key(
+            f3.retrieve_all_files(data_directory + "Level_2/", file_ext="*.nc"),
+            params=params,
+        )
+    else:
+        l2_store = Level2Store(store)
+        level_3_key = manifest.key(
+            params=dict(
+                params,
+                sources=l2_store.source_hashes or l2_store.sonde_ids,
+            )
+        )
+        l2_store.close()
 
-file_name = (
-    "EUREC4A_JOANNE_Dropsonde-RD41_" + "Level_3_v" + str(joanne.__version__) + ".nc"
-)
+    if manifest.is_fresh("Level_3", "dataset", level_3_key):
+        print("Level-3 file is up to date with the Level-2 files. Not running Level-3 again.")
+        save_path = manifest.outputs("Level_3", "dataset")[0]
+        sonde_index.update_sonde_index(save_path, manifest, "Level_3", level_3_key)
+        return save_path
 
-save_directory = f"{data_directory}Level_3/"  # Test_data/" #Level_3/"
+    try:
+        status_index = QCStatusIndex.from_qc_directory(f"{data_directory}QC/")
+    except ValueError:
+        status_index = None
+        # no status file of the current version; grid all Level-2 files
+
+    print("Creating / checking for interim files...")
+
+    lv3_dataset, sonde_keys = lv3_structure_from_lv2(
+        data_directory,
+        height_limit=height_limit,
+        vertical_spacing=vertical_spacing,
+        pressure_log_interp=pressure_log_interp,
+        workers=workers,
+        engine=engine,
+        manifest=manifest,
+        status_index=status_index,
+        level_2_store=store,
+        return_interim_paths=True,
+        profile=profile,
+        return_sonde_keys=True,
+    )
+    # with the "sonde" engine, these are the paths of the interim files, which are
+    # read in batches of chunk_sondes while writing; "batch" returns the dataset
+
+    if output_format == "zarr":
+
+        print('Saving Level-3 store...')
+
+        if engine == "batch":
+            batches = (
+                lv3_dataset.isel(sonde_id=slice(i, i + chunk_sondes))
+                for i in range(0, lv3_dataset.sizes["sonde_id"], chunk_sondes)
+            )
+        else:
+            batches = iter_level_3_batches(lv3_dataset, batch_size=chunk_sondes)
+
+        save_path = write_level_3_zarr(
+            batches,
+            save_directory + file_name[:-3] + ".zarr",
+            height_limit=height_limit,
+            vertical_spacing=vertical_spacing,
+            chunk_sondes=chunk_sondes,
+            profile=profile,
+            sonde_keys=sonde_keys,
+        )
+
+    else:
+
+        if engine != "batch":
+            lv3_dataset = f3.concatenate_soundings(
+                [i for i in map(xr.open_dataset, lv3_dataset) if "ta" in i.variables]
+            )
+
+        to_save_ds = structure_level_3(lv3_dataset, vertical_spacing=vertical_spacing)
+
+        print('Saving Level-3 file...')
+
+        save_path = save_directory + file_name
+
+        to_save_ds.to_netcdf(
+            save_path,
+            mode="w",
+            format="NETCDF4",
+            encoding=level_3_encoding(to_save_ds, chunk_sondes=chunk_sondes, profile=profile),
+            unlimited_dims=["sonde_id"],
+        )
 
-comp = dict(zlib=True, complevel=4, fletcher32=True, _FillValue=np.finfo("float32").max)
+    manifest.record("Level_3", "dataset", level_3_key, [save_path])
+    manifest.save()
 
-encoding = {
-    var: comp
-    for var in to_save_ds.data_vars
-    if var not in ["platform_id", "sonde_id", "alt_bnds"]
-}
-encoding["launch_time"] = {"units": "seconds since 2020-01-01", "dtype": "int32"}
-encoding["interpolated_time"] = {
-    "units": "seconds since 2020-01-01",
-    "dtype": "int32",
-    "_FillValue": np.iinfo("int32").max,
-}
+    sonde_index.update_sonde_index(save_path, manifest, "Level_3", level_3_key)
+    # launch-time and position index for sonde selection, see sonde_index.py
 
-for key in dicts.nc_global_attrs.keys():
-    to_save_ds.attrs[key] = dicts.nc_global_attrs[key]
+    return save_path
 
-to_save_ds.to_netcdf(
-    save_directory + file_name, mode="w", format="NETCDF4", encoding=encoding
-)
\ No newline at end of file
+if __name__ == '__main__':
+    generate_level_3(data_directory)
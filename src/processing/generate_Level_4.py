@@ -1 +1,516 @@
-# Python file to estimate area-averaged values and gradients from Level-3
\ No newline at end of file
+# Python file to estimate area-averaged values and gradients from Level-3
+
+# %%
+import datetime
+import glob
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import joanne
+
+import build_cache
+import config
+import derived_variables
+import storage
+
+Rd = 287.05
+# gas constant of dry air, J kg-1 K-1 (as in functions/thermo.py)
+gravity = 9.8076
+# m s-2
+
+min_sondes = 6
+# minimum number of sondes with valid data at a level for the regression
+
+data_directory = 'extra/Sample_Data/20200122/HALO/'
+
+#### Circle segments #####
+
+def get_circle_times_from_config(config_file=None):
+
+    """
+    Input :
+        config_file : string
+                      path to run_config.cfg
+    Output :
+        circles : list
+                  (circle_id, start, end) for every option of the [circles] section,
+                  written as `circle_id = start, end` with ISO timestamps
+    """
+
+    cfg = config.read_config(config_file)
+
+    if not cfg.has_section("circles"):
+        return []
+
+    circles = []
+
+    for circle_id in cfg.options("circles"):
+        if circle_id in cfg.defaults():
+            continue
+        start, end = [i.strip() for i in cfg["circles"][circle_id].split(",")]
+        circles.append((circle_id, np.datetime64(start), np.datetime64(end)))
+
+    return circles
+
+def get_circle_times_from_segmentation(segmentation_directory):
+
+    """
+    Input :
+        segmentation_directory : string
+                                 directory with the flight segmentation YAML files
+    Output :
+        circles : list
+                  (segment_id, start, end) of every segment whose kinds include "circle"
+    """
+
+    import yaml
+    # optional dependency, only needed when flight segmentation is available
+
+    circles = []
+
+    for file_path in sorted(glob.glob(os.path.join(segmentation_directory, "*.yaml"))):
+
+        with open(file_path) as f:
+            flight = yaml.safe_load(f)
+
+        for segment in flight.get("segments", []):
+            if "circle" in segment.get("kinds", []):
+                circles.append(
+                    (
+                        segment["segment_id"],
+                        np.datetime64(pd.Timestamp(segment["start"]).tz_localize(None)),
+                        np.datetime64(pd.Timestamp(segment["end"]).tz_localize(None)),
+                    )
+                )
+
+    return circles
+
+def get_circle_times():
+
+    """
+    Circle segments from the flight segmentation if the config says it is available,
+    otherwise from the timestamps in the [circles] section of run_config.cfg
+    """
+
+    cfg = config.read_config()
+
+    if cfg["DEFAULT"].getboolean("flight_segmentation_available", fallback=False):
+        return get_circle_times_from_segmentation(
+            cfg.get("flight_segmentation", "directory", fallback="")
+        )
+
+    return get_circle_times_from_config()
+
+def group_sondes_into_circles(lv3_dataset, circles):
+
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      Level-3 dataset with (sonde_id, alt) dimensions
+        circles : list
+                  (circle_id, start, end) as returned by get_circle_times()
+    Output :
+        circle_ids : list
+        membership : np.ndarray of bool, (circle, sonde_id)
+                     True where the sonde was launched within the circle segment
+    """
+
+    launch_time = lv3_dataset.launch_time.values.astype("datetime64[ns]")
+
+    start = np.array([i[1] for i in circles], dtype="datetime64[ns]")
+    end = np.array([i[2] for i in circles], dtype="datetime64[ns]")
+
+    membership = (launch_time[np.newaxis, :] >= start[:, np.newaxis]) & (
+        launch_time[np.newaxis, :] <= end[:, np.newaxis]
+    )
+
+    return [i[0] for i in circles], membership
+
+#### Regression #####
+
+def circle_members(membership):
+
+    """
+    Input :
+        membership : np.ndarray of bool, (circle, sonde_id)
+    Output :
+        members : np.ndarray of int, (circle, max_members)
+                  positions along sonde_id of the sondes of every circle, padded
+                  with -1 up to the largest number of sondes in a circle
+    """
+
+    n_members = membership.sum(axis=1)
+    max_members = int(n_members.max()) if len(n_members) > 0 else 0
+
+    members = np.full((membership.shape[0], max_members), -1, dtype="int64")
+
+    for c, row in enumerate(membership):
+        members[c, : n_members[c]] = np.flatnonzero(row)
+
+    return members
+
+def gather_members(values, members):
+    """
+    (circle, max_members, alt) array of the (sonde_id, alt) `values` of the
+    members of every circle; NaN for the padding
+    """
+    gathered = values[np.maximum(members, 0)].astype("float64")
+    gathered[members < 0] = np.nan
+    return gathered
+
+def circle_positions(lat, lon, members):
+
+    """
+    Input :
+        lat, lon : np.ndarray, (sonde_id, alt)
+        members : np.ndarray, (circle, max_members)
+                  output of circle_members()
+    Output :
+        dx, dy : np.ndarray, (circle, max_members, alt)
+                 zonal and meridional distance in m of every member sonde from the
+                 circle centre at that level; NaN for the padding
+        circle_lat, circle_lon : np.ndarray, (circle, alt)
+                                 centre of the circle at every level
+    """
+
+    c_lat = gather_members(lat, members)
+    c_lon = gather_members(lon, members)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        # levels where no sonde of a circle has a position give all-NaN slices
+        circle_lat = np.nanmean(c_lat, axis=1)
+        circle_lon = np.nanmean(c_lon, axis=1)
+
+    dy = (c_lat - circle_lat[:, np.newaxis]) * 110.54e3
+    dx = (c_lon - circle_lon[:, np.newaxis]) * 111.32e3 * np.cos(np.deg2rad(c_lat))
+
+    return dx, dy, circle_lat, circle_lon
+
+def fit_circles(variables, dx, dy, members, min_sondes=min_sondes):
+
+    """
+    Input :
+        variables : dict
+                    name -> np.ndarray (sonde_id, alt), the fields to regress
+        dx, dy : np.ndarray, (circle, max_members, alt)
+                 output of circle_positions()
+        members : np.ndarray, (circle, max_members)
+                  output of circle_members()
+        min_sondes : int
+                     levels with fewer valid sondes in a circle are set to NaN
+    Output :
+        fits : dict
+               name -> (mean, d/dx, d/dy), each np.ndarray (circle, alt)
+        n_sondes : dict
+                   name -> number of sondes used at every (circle, alt)
+
+    Fits var = mean + d/dx * dx + d/dy * dy by least squares for all circles and
+    levels at once: only the member sondes of every circle are gathered, missing
+    sondes and padding get zero weight in the design matrix, and the 3 x 3 normal
+    equations of every (circle, alt) are solved in one batched call
+    """
+
+    fits = {}
+    n_sondes = {}
+
+    for name, values in variables.items():
+
+        values = gather_members(values, members)
+
+        valid = ~np.isnan(dx) & ~np.isnan(dy) & ~np.isnan(values)
+        w = valid.astype("float64")
+
+        # design matrix, (circle, alt, member, 3)
+        A = np.stack(
+            [w, np.where(valid, dx, 0), np.where(valid, dy, 0)], axis=-1
+        ).transpose(0, 2, 1, 3)
+        b = np.where(valid, values, 0).transpose(0, 2, 1)
+
+        AtA = np.einsum("czsi,czsj->czij", A, A)
+        Atb = np.einsum("czsi,czs->czi", A, b)
+
+        n = w.sum(axis=1)
+        solvable = (n >= min_sondes) & (np.abs(np.linalg.det(AtA)) > 0)
+
+        AtA[~solvable] = np.eye(3)
+        Atb[~solvable] = 0
+
+        coefs = np.linalg.solve(AtA, Atb[..., np.newaxis])[..., 0]
+        coefs[~solvable] = np.nan
+
+        fits[name] = (coefs[..., 0], coefs[..., 1], coefs[..., 2])
+        n_sondes[name] = n.astype("int32")
+
+    return fits, n_sondes
+
+def integrate_vertical_velocity(div, p, ta, q):
+
+    """
+    Input :
+        div : np.ndarray, (circle, alt)
+              divergence in s-1
+        p, ta, q : np.ndarray, (circle, alt)
+                   circle-mean pressure (Pa), temperature (K) and specific humidity (kg/kg)
+    Output :
+        omega : np.ndarray, (circle, alt)
+                pressure velocity in Pa s-1, integrated upward from omega = 0 at the
+                lowest level with valid divergence and pressure: omega(p) = - integral
+                of div dp. Levels below it, and all levels above a gap in div or p, are NaN
+        w : np.ndarray, (circle, alt)
+            vertical velocity in m s-1, w = - omega / (rho g)
+    """
+
+    div_mid = 0.5 * (div[:, 1:] + div[:, :-1])
+    dp = np.diff(p, axis=1)
+
+    valid = ~np.isnan(div) & ~np.isnan(p)
+    first = np.argmax(valid, axis=1)[:, np.newaxis]
+    level = np.arange(div.shape[1])[np.newaxis, :]
+
+    increment = np.where(level[:, :-1] >= first, -div_mid * dp, 0)
+    # NaN increments above the first valid level are kept, so that cumsum carries
+    # a gap up to the top instead of integrating across it as zero
+
+    omega = np.concatenate(
+        [np.zeros((div.shape[0], 1)), np.cumsum(increment, axis=1)], axis=1
+    )
+    omega[(level < first) | ~valid.any(axis=1)[:, np.newaxis]] = np.nan
+
+    rho = p / (Rd * ta * (1 + 0.61 * q))
+    w = -omega / (rho * gravity)
+
+    return omega, w
+
+#### Level-4 dataset #####
+
+def circle_products(lv3_dataset, circles, min_sondes=min_sondes, derived=None):
+
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      Level-3 dataset with (sonde_id, alt) dimensions
+        circles : list
+                  (circle_id, start, end)
+        derived : xarray dataset
+                  derived variables of the Level-3 sondes (see derived_variables.py);
+                  if given, their circle means are added
+    Output :
+        dataset : xarray dataset
+                  circle products with (circle, alt) dimensions
+    """
+
+    alt = lv3_dataset.alt.values
+
+    circle_ids, membership = group_sondes_into_circles(lv3_dataset, circles)
+
+    lat = lv3_dataset.lat.values.astype("float64")
+    lon = lv3_dataset.lon.values.astype("float64")
+
+    members = circle_members(membership)
+
+    dx, dy, circle_lat, circle_lon = circle_positions(lat, lon, members)
+
+    variables = {
+        var: lv3_dataset[var].values.astype("float64")
+        for var in ["u", "v", "p", "ta", "q"]
+    }
+
+    derived_vars = []
+
+    if derived is not None:
+        derived = derived.sel(sonde_id=lv3_dataset.sonde_id.values)
+        # aligned by sonde_id, not by position
+        derived_vars = list(derived_variables.derived_attrs)
+        for var in derived_vars:
+            variables[var] = derived[var].values.astype("float64")
+
+    fits, n_sondes = fit_circles(variables, dx, dy, members, min_sondes=min_sondes)
+
+    u, dudx, dudy = fits["u"]
+    v, dvdx, dvdy = fits["v"]
+
+    div = dudx + dvdy
+    vor = dvdx - dudy
+
+    omega, w = integrate_vertical_velocity(
+        div, fits["p"][0], fits["ta"][0], fits["q"][0]
+    )
+
+    launch_time = lv3_dataset.launch_time.values.astype("datetime64[ns]")
+    circle_time = np.array(
+        [
+            launch_time[m].astype("int64").mean().astype("int64") if m.any() else np.iinfo("int64").min
+            for m in membership
+        ]
+    ).astype("datetime64[ns]")
+
+    dims = ["circle", "alt"]
+
+    dataset = xr.Dataset(
+        {
+            "circle_lat": (dims, circle_lat, {"long_name": "latitude of circle centre", "units": "degree_north"}),
+            "circle_lon": (dims, circle_lon, {"long_name": "longitude of circle centre", "units": "degree_east"}),
+            "circle_time": (["circle"], circle_time, {"long_name": "mean launch time of sondes in circle"}),
+            "sondes_in_circle": (["circle"], membership.sum(axis=1).astype("int32"), {"long_name": "number of sondes launched in circle"}),
+            "sondes_regressed": (dims, n_sondes["u"], {"long_name": "number of sondes used in the wind regression"}),
+            "u": (dims, u, {"long_name": "circle mean of eastward wind", "units": "m s-1"}),
+            "v": (dims, v, {"long_name": "circle mean of northward wind", "units": "m s-1"}),
+            "dudx": (dims, dudx, {"long_name": "zonal gradient of eastward wind", "units": "s-1"}),
+            "dudy": (dims, dudy, {"long_name": "meridional gradient of eastward wind", "units": "s-1"}),
+            "dvdx": (dims, dvdx, {"long_name": "zonal gradient of northward wind", "units": "s-1"}),
+            "dvdy": (dims, dvdy, {"long_name": "meridional gradient of northward wind", "units": "s-1"}),
+            "D": (dims, div, {"long_name": "horizontal mass divergence", "units": "s-1"}),
+            "vor": (dims, vor, {"long_name": "relative vorticity", "units": "s-1"}),
+            "omega": (dims, omega, {"long_name": "vertical pressure velocity", "units": "Pa s-1"}),
+            "W": (dims, w, {"long_name": "vertical velocity", "units": "m s-1"}),
+            "p": (dims, fits["p"][0], {"long_name": "circle mean of air pressure", "units": "Pa"}),
+            "ta": (dims, fits["ta"][0], {"long_name": "circle mean of air temperature", "units": "K"}),
+            "q": (dims, fits["q"][0], {"long_name": "circle mean of specific humidity", "units": "kg kg-1"}),
+        },
+        coords={"circle": np.array(circle_ids).astype(str), "alt": alt},
+    )
+
+    for var in derived_vars:
+        dataset[var] = (dims, fits[var][0], dict(derived[var].attrs))
+        dataset[var].attrs["long_name"] = "circle mean of " + dataset[var].attrs["long_name"]
+
+    dataset["alt"].attrs = dict(lv3_dataset.alt.attrs)
+
+    return dataset
+
+def level_3_path(data_directory, manifest=None):
+
+    """
+    Level-3 file (or Zarr store) recorded in the build manifest by generate_level_3(),
+    or the default Level-3 file name if there is no record
+    """
+
+    if manifest is not None and manifest.outputs("Level_3", "dataset"):
+        return manifest.outputs("Level_3", "dataset")[0]
+
+    return (
+        f"{data_directory}Level_3/EUREC4A_JOANNE_Dropsonde-RD41_"
+        + "Level_3_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+
+######## Generating Level-4 ######
+
+def generate_level_4(data_directory=data_directory, circles=None, min_sondes=min_sondes):
+
+    """
+    Input :
+        data_directory : string
+                         platform directory with the Level_3/ sub-directory
+        circles : list
+                  (circle_id, start, end); read with get_circle_times() if None
+        min_sondes : int
+                     minimum number of valid sondes per level for the regression
+    Output :
+        file path of the Level-4 file, or None if no circles are defined
+    Function to compute the circle products from the Level-3 file. Nothing is
+    done if the Level-4 file is up to date with the Level-3 file and circles
+    """
+
+    if circles is None:
+        circles = get_circle_times()
+
+    if len(circles) == 0:
+        print("No circles defined in run_config.cfg or flight segmentation. Not running Level-4.")
+        return None
+
+    file_name = (
+        "EUREC4A_JOANNE_Dropsonde-RD41_" + "Level_4_v" + str(joanne.__version__) + ".nc"
+    )
+
+    save_directory = f"{data_directory}Level_4/"
+
+    if os.path.exists(save_directory):
+        pass
+    else:
+        os.makedirs(save_directory)
+
+    derived_path = derived_variables.generate_derived(data_directory)
+    # recomputed first if the derived variables are older than the Level-3 file
+
+    manifest = build_cache.open_manifest(data_directory)
+
+    lv3_path = level_3_path(data_directory, manifest)
+
+    params = {
+        "circles": [[str(i) for i in circle] for circle in circles],
+        "min_sondes": min_sondes,
+        "derived": manifest.stages.get("Level_3_derived", {}).get("dataset", {}).get("key"),
+        "storage_profile": storage.get_profile_name(),
+    }
+
+    if os.path.isdir(lv3_path):
+        level_4_key = manifest.key(
+            params=dict(params, level_3=manifest.stages.get("Level_3", {}).get("dataset", {}).get("key"))
+        )
+        # a Zarr store is a directory; its Level-3 key stands for its content
+    else:
+        level_4_key = manifest.key([lv3_path], params=params)
+
+    if manifest.is_fresh("Level_4", "dataset", level_4_key):
+        print("Level-4 file is up to date with the Level-3 file. Not running Level-4 again.")
+        return save_directory + file_name
+
+    if lv3_path.endswith(".zarr"):
+        lv3_dataset = xr.open_zarr(lv3_path).load()
+    else:
+        with xr.open_dataset(lv3_path) as ds:
+            lv3_dataset = ds.load()
+
+    derived = None
+
+    if derived_path is not None:
+        with xr.open_dataset(derived_path) as ds:
+            derived = ds.load()
+
+    to_save_ds = circle_products(
+        lv3_dataset, circles, min_sondes=min_sondes, derived=derived
+    )
+
+    to_save_ds.attrs = {
+        "title": "Dropsonde circle products, Level-4",
+        "featureType": "profile",
+        "Conventions": "CF-1.8",
+        "JOANNE_version": str(joanne.__version__),
+        "creation_time": str(datetime.datetime.utcnow()) + " UTC",
+        "source": os.path.basename(lv3_path),
+    }
+
+    comp = dict(storage.netcdf_compression(params["storage_profile"]), _FillValue=np.finfo("float32").max)
+
+    encoding = {
+        var: dict(comp, dtype="float32")
+        for var in to_save_ds.data_vars
+        if to_save_ds[var].dtype == "float64"
+    }
+    encoding["circle_time"] = {
+        "units": "seconds since 2020-01-01",
+        "dtype": "int32",
+        "_FillValue": np.iinfo("int32").max,
+    }
+    # circles without sondes have no time
+
+    print('Saving Level-4 file...')
+
+    to_save_ds.to_netcdf(
+        save_directory + file_name, mode="w", format="NETCDF4", encoding=encoding
+    )
+
+    manifest.record("Level_4", "dataset", level_4_key, [save_directory + file_name])
+    manifest.save()
+
+    return save_directory + file_name
+
+if __name__ == '__main__':
+    generate_level_4(data_directory)
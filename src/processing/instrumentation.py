@@ -0,0 +1,327 @@
+# Python file to record timing, memory and I/O of the processing stages
+
+import contextlib
+import cProfile
+import csv
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+env_flag = "JOANNE_INSTRUMENT"
+# "1" or "profile", set by enable(); inherited by worker processes, whatever their start method
+
+enabled = os.environ.get(env_flag, "0") != "0"
+profiling = os.environ.get(env_flag, "0") == "profile"
+
+def _io_counters():
+    """
+    (bytes read, bytes written) by the current process, from /proc/self/io
+    (including reads served from the page cache); (0, 0) where not available
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def _peak_rss_mb():
+    """
+    Peak resident set size in MB of this process and of its terminated children
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+    # ru_maxrss is in kB on Linux
+
+def _cpu_time():
+    """
+    CPU time in s of this process and of its terminated children (e.g. the worker
+    pool of a stage, once shut down)
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+rss_interval = 0.1
+# seconds between two samples of the resident set size of a running stage
+
+def _rss_mb():
+    """
+    Current resident set size in MB of this process and of its live child processes
+    (e.g. the worker pool of a stage), from /proc; None where not available
+    """
+    pid = os.getpid()
+    page_size = os.sysconf("SC_PAGE_SIZE")
+
+    try:
+        pids = [pid]
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                    # exited meanwhile
+                if ppid == pid:
+                    pids.append(int(entry))
+
+        pages = 0
+        for i in pids:
+            try:
+                with open(f"/proc/{i}/statm") as f:
+                    pages += int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+        return pages * page_size / 1024**2
+    except (OSError, ValueError):
+        return None
+
+class RSSSampler:
+
+    """
+    Peak resident set size of this process and its children while a stage runs,
+    sampled every `interval` seconds in a background thread. Unlike ru_maxrss,
+    which only grows over the lifetime of the process, this is the peak of the
+    stage itself; where /proc is not available, the ru_maxrss peak is reported
+    """
+
+    def __init__(self, interval=rss_interval):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = _rss_mb()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return self.peak if self.peak is not None else _peak_rss_mb()
+
+class RunRecorder:
+
+    """
+    Measurements of one run: per stage wall time, CPU time, peak RSS and bytes
+    read/written, the durations of named sub-steps and the per-sonde latencies.
+    Sub-steps and latencies measured in worker processes are sent back with the
+    task results (see drain() and merge()).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.steps = {}
+        self.latency = {}
+        self.current = []
+        self._io_mark = _io_counters()
+
+    def add_step(self, name, seconds):
+        self.steps.setdefault(name, []).append(seconds)
+
+    def add_latency(self, stage, seconds):
+        self.latency.setdefault(stage, []).append(seconds)
+
+    def drain(self):
+        """
+        Sub-steps, latencies and I/O recorded since the last drain, removed from the recorder
+        """
+        read, written = _io_counters()
+        collected = {
+            "steps": self.steps,
+            "latency": self.latency,
+            "io": [read - self._io_mark[0], written - self._io_mark[1]],
+            "pid": os.getpid(),
+        }
+        self.steps, self.latency, self._io_mark = {}, {}, (read, written)
+        return collected
+
+    def merge(self, collected):
+        """
+        Add measurements drained in a worker process; their I/O goes to the current stage
+        """
+        if not collected:
+            return
+        for name, values in collected["steps"].items():
+            self.steps.setdefault(name, []).extend(values)
+        for stage, values in collected["latency"].items():
+            self.latency.setdefault(stage, []).extend(values)
+        if self.current and collected["pid"] != os.getpid():
+            # I/O of tasks run in this process is already counted by stage()
+            entry = self.stages.setdefault(self.current[-1], {})
+            entry["worker_read_bytes"] = entry.get("worker_read_bytes", 0) + collected["io"][0]
+            entry["worker_write_bytes"] = entry.get("worker_write_bytes", 0) + collected["io"][1]
+
+    def report(self):
+
+        """
+        Summary of the run as a JSON-serialisable dict
+        """
+
+        def summary(values):
+            values = np.asarray(values)
+            return {
+                "count": int(len(values)),
+                "total_s": float(values.sum()),
+                "mean_s": float(values.mean()),
+                "p50_s": float(np.percentile(values, 50)),
+                "p90_s": float(np.percentile(values, 90)),
+                "p99_s": float(np.percentile(values, 99)),
+                "max_s": float(values.max()),
+            }
+
+        return {
+            "stages": self.stages,
+            "steps": {name: summary(v) for name, v in self.steps.items() if len(v) > 0},
+            "sonde_latency": {name: summary(v) for name, v in self.latency.items() if len(v) > 0},
+        }
+
+recorder = RunRecorder()
+
+profile_dir = None
+# where stage() writes the cProfile dumps when profiling
+
+def enable(profile=False):
+    """
+    Switch instrumentation on for this process and the worker processes it starts;
+    with `profile`, every stage is also profiled with cProfile
+    """
+    global enabled, profiling
+    enabled = True
+    profiling = profile
+    os.environ[env_flag] = "profile" if profile else "1"
+
+def reset(report_dir=None):
+    """
+    Start a new run report, e.g. for the next platform directory; cProfile dumps
+    go to `report_dir`/profiles/
+    """
+    global recorder, profile_dir
+    recorder = RunRecorder()
+    if report_dir is not None:
+        profile_dir = os.path.join(report_dir, "profiles")
+
+@contextlib.contextmanager
+def stage(name):
+
+    """
+    Record wall time, CPU time (including worker processes), peak RSS (see RSSSampler) and bytes read/written of a stage
+    """
+
+    if not enabled:
+        yield
+        return
+
+    profiler = None
+    if profiling and profile_dir is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    recorder.current.append(name)
+    entry = recorder.stages.setdefault(name, {})
+
+    sampler = RSSSampler().start()
+
+    read, written = _io_counters()
+    wall, cpu = time.perf_counter(), _cpu_time()
+
+    try:
+        yield
+    finally:
+        end_read, end_written = _io_counters()
+        entry["wall_s"] = entry.get("wall_s", 0) + time.perf_counter() - wall
+        entry["cpu_s"] = entry.get("cpu_s", 0) + _cpu_time() - cpu
+        # worker processes are counted once their pool is shut down within the stage
+        entry["read_bytes"] = entry.get("read_bytes", 0) + end_read - read
+        entry["write_bytes"] = entry.get("write_bytes", 0) + end_written - written
+        entry["peak_rss_mb"] = max(entry.get("peak_rss_mb", 0), sampler.stop())
+        # a stage run once per platform directory keeps its highest peak
+        recorder.current.pop()
+
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f"{name}.prof"))
+
+@contextlib.contextmanager
+def step(name):
+    """
+    Record the duration of a sub-step (e.g. "Level_3/interp_along_height");
+    costs a single flag check when instrumentation is off
+    """
+    if not enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_step(name, time.perf_counter() - start)
+
+def record_latency(stage, seconds):
+    if enabled:
+        recorder.add_latency(stage, seconds)
+
+def drain():
+    """
+    Measurements of this (worker) process to be returned with a task result
+    """
+    return recorder.drain() if enabled else None
+
+def merge(collected):
+    if enabled:
+        recorder.merge(collected)
+
+def write_report(report_dir, label="run"):
+
+    """
+    Write the run report as JSON (full) and CSV (one row per stage, sub-step and
+    latency distribution); returns the path of the JSON file
+    """
+
+    if not enabled:
+        return None
+
+    os.makedirs(report_dir, exist_ok=True)
+
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    report = recorder.report()
+    report["created"] = stamp
+
+    json_path = os.path.join(report_dir, f"{label}_report_{stamp}.json")
+
+    with open(json_path, "w") as f:
+        json.dump(report, f, indent=1)
+
+    columns = ["kind", "name", "wall_s", "cpu_s", "peak_rss_mb", "read_bytes", "write_bytes",
+               "worker_read_bytes", "worker_write_bytes",
+               "count", "total_s", "mean_s", "p50_s", "p90_s", "p99_s", "max_s"]
+
+    with open(os.path.join(report_dir, f"{label}_report_{stamp}.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for kind in ["stages", "steps", "sonde_latency"]:
+            for name, values in report[kind].items():
+                row = {"kind": kind, "name": name}
+                row.update(values)
+                writer.writerow(row)
+
+    return json_path
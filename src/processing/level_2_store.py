@@ -0,0 +1,420 @@
+# Python file to collect all Level-2 sondes of a platform in a single ragged-array store
+
+import json
+import os
+import shutil
+
+import numpy as np
+import xarray as xr
+from tqdm import tqdm
+
+import joanne
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+import prefetch
+import storage
+
+store_formats = ["netcdf", "zarr"]
+
+
+def store_path(data_dir, store_format="netcdf"):
+    """
+    Path of the Level-2 store of a platform directory; kept outside Level_2/ so
+    that it is not listed together with the per-sonde files
+    """
+    extension = ".zarr" if store_format == "zarr" else ".nc"
+
+    return (
+        f"{data_dir}Level_2_store/EUREC4A_JOANNE_Dropsonde-RD41_Level_2_v"
+        + str(joanne.__version__)
+        + extension
+    )
+
+
+def _json_attrs(attrs):
+    return json.dumps(
+        {key: (value.item() if isinstance(value, np.generic) else value) for key, value in attrs.items()},
+        default=str,
+    )
+
+
+time_units = "seconds since 2020-01-01"
+
+
+class Level2StoreWriter:
+
+    """
+    Writes a Level-2 store sonde by sonde
+
+    Input :
+        save_path : string
+                    path of the store to be written
+        store_format : string
+                       "netcdf" (CF contiguous ragged array) or "zarr"
+        profile : string
+                  storage profile (see storage.py); `storage_profile` option if None
+        batch_size : int
+                     number of sondes buffered before they are appended to the store
+
+    All sondes are concatenated along a single `obs` dimension following the CF
+    contiguous ragged array representation for trajectories: `rowSize` holds the
+    number of observations of every sonde, so sonde k occupies
+    obs[offset_k : offset_k + rowSize_k] with offset_k = sum(rowSize[:k]).
+    Attributes that differ between sondes (flight and launch details) are kept
+    per sonde as JSON in `sonde_attrs`.
+
+    Sondes are appended with append() in store order, e.g. as they come out of
+    Level-2 processing, so that at most `batch_size` sondes are held in memory.
+    The store is written next to `save_path` and only replaces it on close().
+    """
+
+    def __init__(self, save_path, store_format="netcdf", profile=None, batch_size=64):
+
+        if store_format not in store_formats:
+            raise ValueError(f"Unknown Level-2 store format: {store_format}")
+
+        self.save_path = save_path
+        self.store_format = store_format
+        self.profile = storage.get_profile_name(profile)
+        self.batch_size = batch_size
+
+        self.tmp_path = save_path + ".tmp"
+        self.rows = []
+        self.obs_vars = None
+        self.var_attrs = {}
+        self.common_attrs = None
+        self.with_hashes = False
+        self.n_sondes = 0
+        self.n_obs = 0
+
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        _remove(self.tmp_path)
+
+    def append(self, ds, source_file, source_hash=None):
+
+        """
+        Input :
+            ds : xarray dataset
+                 Level-2 sonde in the layout of a per-sonde Level-2 file
+            source_file : string
+                          path of its Level-2 file
+            source_hash : string
+                          content hash of the Level-2 file, stored so that later stages
+                          can tell which sondes changed without reading them
+        """
+
+        if self.obs_vars is None:
+            self.obs_vars = [var for var in ds.variables if ds[var].dims == ("time",)]
+            self.var_attrs = {var: dict(ds[var].attrs) for var in self.obs_vars}
+            self.common_attrs = dict(ds.attrs)
+            self.with_hashes = source_hash is not None
+
+        self.common_attrs = {
+            key: value
+            for key, value in self.common_attrs.items()
+            if key in ds.attrs and str(ds.attrs[key]) == str(value)
+        }
+
+        self.rows.append(
+            {
+                "data": {var: ds[var].values for var in self.obs_vars},
+                "row_size": ds.sizes["time"],
+                "sonde_id": str(ds.sonde_id.values),
+                "sonde_attrs": _json_attrs(ds.attrs),
+                "source_file": os.path.basename(source_file),
+                "source_hash": source_hash,
+            }
+        )
+
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _batch(self):
+
+        """
+        Dataset of the buffered sondes, with the variables and attributes of the store
+        """
+
+        rows = self.rows
+
+        batch = xr.Dataset(coords={"sonde_id": ("sonde_id", np.array([i["sonde_id"] for i in rows], dtype=object))})
+
+        batch["sonde_id"].attrs = {
+            "long_name": "sonde identifier",
+            "cf_role": "trajectory_id",
+        }
+
+        for var in self.obs_vars or []:
+            batch[var] = (
+                "obs",
+                np.concatenate([i["data"][var] for i in rows]) if rows else np.array([], dtype="float32"),
+                self.var_attrs[var],
+            )
+
+        batch["rowSize"] = (
+            "sonde_id",
+            np.array([i["row_size"] for i in rows], dtype="int32"),
+            {
+                "long_name": "number of observations for this sonde",
+                "sample_dimension": "obs",
+            },
+        )
+        batch["sonde_attrs"] = (
+            "sonde_id",
+            np.array([i["sonde_attrs"] for i in rows], dtype=object),
+            {"description": "per-sonde global attributes of the Level-2 file, as JSON"},
+        )
+        batch["source_file"] = ("sonde_id", np.array([i["source_file"] for i in rows], dtype=object))
+
+        if self.with_hashes:
+            batch["source_sha256"] = ("sonde_id", np.array([i["source_hash"] for i in rows], dtype=object))
+
+        return batch
+
+    def _flush(self):
+
+        if len(self.rows) == 0 and self.n_sondes > 0:
+            return
+
+        batch = self._batch()
+
+        if self.store_format == "zarr":
+            self._append_zarr(batch)
+        else:
+            self._append_netcdf(batch)
+
+        self.n_sondes += batch.sizes["sonde_id"]
+        self.n_obs += batch.sizes.get("obs", 0)
+        self.rows = []
+
+    def _append_zarr(self, batch):
+
+        if self.n_sondes == 0:
+
+            comp = storage.encoding(self.profile, zarr=True)
+
+            encoding = {
+                var: dict(comp, _FillValue=np.finfo("float32").max)
+                for var in self.obs_vars or []
+                if batch[var].dtype == "float32"
+            }
+            if "time" in batch:
+                encoding["time"] = {"units": time_units, "dtype": "float"}
+
+            batch.to_zarr(self.tmp_path, mode="w", encoding=encoding, consolidated=True)
+
+        else:
+            obs = [var for var in batch.data_vars if batch[var].dims == ("obs",)]
+            batch[obs].to_zarr(self.tmp_path, append_dim="obs", consolidated=True)
+            batch.drop_vars(obs).to_zarr(self.tmp_path, append_dim="sonde_id", consolidated=True)
+
+    def _append_netcdf(self, batch):
+
+        with prefetch.hdf5_lock, netCDF4.Dataset(self.tmp_path, "w" if self.n_sondes == 0 else "a") as nc:
+
+            if self.n_sondes == 0:
+
+                nc.createDimension("obs", None)
+                nc.createDimension("sonde_id", None)
+
+                comp = storage.netcdf_compression(self.profile)
+
+                for var in batch.variables:
+
+                    dim = batch[var].dims[0]
+                    chunks = (65536 if dim == "obs" else 1024,)
+
+                    if batch[var].dtype == object:
+                        nc_var = nc.createVariable(var, str, (dim,))
+                    elif var == "time":
+                        nc_var = nc.createVariable(var, "f8", (dim,), chunksizes=chunks)
+                        nc_var.units = time_units
+                    elif batch[var].dtype == "float32":
+                        nc_var = nc.createVariable(
+                            var, "f4", (dim,), fill_value=np.finfo("float32").max, chunksizes=chunks, **comp
+                        )
+                    else:
+                        nc_var = nc.createVariable(var, batch[var].dtype, (dim,), chunksizes=chunks)
+
+                    nc_var.setncatts(batch[var].attrs)
+
+            for var in batch.variables:
+
+                values = batch[var].values
+                start = self.n_obs if batch[var].dims == ("obs",) else self.n_sondes
+
+                if var == "time":
+                    values = (values - np.datetime64("2020-01-01")) / np.timedelta64(1, "s")
+                elif values.dtype == "float32":
+                    values = np.ma.masked_invalid(values)
+                    # NaN written as the _FillValue
+
+                if values.dtype == object:
+                    for n, value in enumerate(values):
+                        nc.variables[var][start + n] = str(value)
+                elif len(values) > 0:
+                    nc.variables[var][start : start + len(values)] = values
+
+    def close(self):
+
+        """
+        Write the remaining sondes and the global attributes, and move the store to
+        `save_path`; returns `save_path`
+        """
+
+        self._flush()
+
+        attrs = dict(self.common_attrs or {})
+        attrs["featureType"] = "trajectory"
+
+        if self.store_format == "zarr":
+            import zarr
+
+            zarr.open_group(self.tmp_path, mode="a").attrs.update(json.loads(_json_attrs(attrs)))
+            zarr.consolidate_metadata(self.tmp_path)
+        else:
+            with prefetch.hdf5_lock, netCDF4.Dataset(self.tmp_path, "a") as nc:
+                nc.setncatts(
+                    {key: (str(value) if isinstance(value, (bool, type(None))) else value) for key, value in attrs.items()}
+                )
+
+        _remove(self.save_path)
+        os.replace(self.tmp_path, self.save_path)
+
+        return self.save_path
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_level_2_store(level_2_files, save_path, store_format="netcdf", source_hashes=None, profile=None):
+
+    """
+    Input :
+        level_2_files : list
+                        paths to the per-sonde Level-2 files
+        save_path : string
+                    path of the store to be written
+        store_format : string
+                       "netcdf" (CF contiguous ragged array) or "zarr"
+        source_hashes : list
+                        content hash of every Level-2 file
+        profile : string
+                  storage profile (see storage.py); `storage_profile` option if None
+    Output :
+        save_path : string
+    Store of existing Level-2 files, written with Level2StoreWriter
+    """
+
+    writer = Level2StoreWriter(save_path, store_format=store_format, profile=profile)
+
+    for n, file_path in enumerate(tqdm(level_2_files)):
+        with xr.open_dataset(file_path) as ds:
+            writer.append(ds, file_path, None if source_hashes is None else source_hashes[n])
+
+    return writer.close()
+
+
+class Level2Store:
+
+    """
+    Reader for a Level-2 store written by Level2StoreWriter
+
+    Input :
+        path : string
+               path to the NetCDF file or Zarr directory
+
+    Only `rowSize` and the per-sonde variables are read on opening; the
+    observations of a sonde are read when the sonde is requested, as a slice of
+    the `obs` dimension starting at its offset.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        if path.endswith(".zarr"):
+            self.ds = xr.open_zarr(path, consolidated=True)
+        else:
+            self.ds = xr.open_dataset(path)
+
+        row_size = self.ds.rowSize.values.astype("int64")
+
+        self.row_size = row_size
+        self.offsets = np.concatenate([[0], np.cumsum(row_size)[:-1]]).astype("int64")
+        self.sonde_ids = [str(i) for i in self.ds.sonde_id.values]
+        self.source_files = [str(i) for i in self.ds.source_file.values]
+        self.sonde_attrs = [str(i) for i in self.ds.sonde_attrs.values]
+        self.attrs = {key: value for key, value in self.ds.attrs.items() if key != "featureType"}
+
+        if "source_sha256" in self.ds:
+            self.source_hashes = [str(i) for i in self.ds.source_sha256.values]
+        else:
+            self.source_hashes = None
+
+        self._positions = {sonde_id: i for i, sonde_id in enumerate(self.sonde_ids)}
+        self._obs_vars = [var for var in self.ds.variables if self.ds[var].dims == ("obs",)]
+
+    def __len__(self):
+        return len(self.sonde_ids)
+
+    def index(self, sonde_id):
+        return self._positions[sonde_id]
+
+    def get(self, sonde):
+
+        """
+        Input :
+            sonde : int or string
+                    position in the store or sonde ID
+        Output :
+            dataset : xarray dataset
+                      the sonde in the layout of a per-sonde Level-2 file
+                      (`time` dimension, scalar sonde_id, per-sonde attributes)
+        """
+
+        i = self.index(sonde) if isinstance(sonde, str) else int(sonde)
+
+        start = self.offsets[i]
+        stop = start + self.row_size[i]
+
+        dataset = (
+            self.ds[self._obs_vars]
+            .isel(obs=slice(start, stop))
+            .load()
+            .swap_dims({"obs": "time"})
+        )
+
+        if "obs" in dataset.coords:
+            dataset = dataset.drop_vars("obs")
+
+        dataset["sonde_id"] = xr.Variable(
+            [],
+            self.sonde_ids[i],
+            attrs={
+                "descripion": "unique sonde ID",
+                "long_name": "sonde identifier",
+                "cf_role": "trajectory_id",
+            },
+        )
+
+        attrs = dict(self.attrs)
+        attrs.update(json.loads(self.sonde_attrs[i]))
+        dataset.attrs = attrs
+
+        return dataset
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def close(self):
+        self.ds.close()
@@ -0,0 +1,357 @@
+# Python file to run the processing stages for all platform directories given in run_config.cfg
+
+import argparse
+import collections
+import datetime
+import glob
+import hashlib
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import joanne
+
+import QC
+import config
+import derived_variables
+import drift
+import generate_Level_2
+import generate_Level_3
+import generate_Level_4
+import instrumentation
+import quicklooks
+
+state_name = "pipeline_state.json"
+# per-platform checkpoint file, next to the build manifest
+
+Stage = collections.namedtuple(
+    "Stage", ["name", "level", "inputs", "outputs", "run", "sections", "enabled"], defaults=[(), None]
+)
+# inputs, outputs : glob patterns relative to the platform directory
+# sections : config sections read by the stage besides DEFAULT; their options are
+#            part of the checkpoint signature
+# enabled : function() -> bool, if the stage can be switched off in the config; a
+#           stage switched off is skipped and marked "off", so that it runs once switched on
+# level : lowest `run_levels` value for which the stage is run
+# run : function(data_dir, workers); options are read from the config selected by
+#       run_platform() with config.using()
+
+def _run_qc(data_dir, workers):
+    QC.run_qc(data_dir)
+
+def _run_level_2(data_dir, workers):
+    generate_Level_2.run_level_2(data_dir, save_dir=f"{data_dir}Level_2/", workers=workers)
+
+def _run_level_3(data_dir, workers):
+    generate_Level_3.generate_level_3(data_dir, workers=workers)
+
+def _run_derived(data_dir, workers):
+    derived_variables.generate_derived(data_dir)
+
+def _run_level_4(data_dir, workers):
+    generate_Level_4.generate_level_4(data_dir)
+
+def _run_drift(data_dir, workers):
+    drift.generate_drift(data_dir)
+
+def _run_quicklooks(data_dir, workers):
+    quicklooks.generate_quicklooks(data_dir, workers=workers)
+
+stages = [
+    Stage("QC", 1, ["Level_0/*", "Level_1/*.nc"], ["QC/Status_of_sondes_v*.nc"], _run_qc, ["platforms"]),
+    Stage(
+        "Level_2", 2, ["Level_1/*.nc", "QC/Status_of_sondes_v*.nc"], ["Level_2/*.nc"], _run_level_2, ["platforms"]
+    ),
+    Stage("Level_3", 3, ["Level_2/*.nc", "Level_2_store/*"], ["Level_3/*Level_3_v*"], _run_level_3),
+    Stage("Level_3_derived", 3, ["Level_3/*Level_3_v*"], ["Level_3/*Level_3_derived_v*.nc"], _run_derived),
+    Stage(
+        "Level_4", 4, ["Level_3/*Level_3*"], ["Level_4/*.nc"], _run_level_4, ["circles", "flight_segmentation"]
+    ),
+    Stage("Drift", 3, ["Level_2/*.nc", "Level_2_store/*"], ["Drift/*Drift_Level_2_v*.nc"], _run_drift),
+    Stage(
+        "Quicklooks",
+        3,
+        ["Level_3/*Level_3*", "Drift/*Drift_Level_3_v*.nc"],
+        ["Quicklooks/Quicklook_*.png"],
+        _run_quicklooks,
+        ["quicklooks", "circles", "flight_segmentation"],
+        quicklooks.is_enabled,
+    ),
+]
+
+def find_platform_directories(directory):
+
+    """
+    Input :
+        directory : string
+                    platform directory, flight directory with one sub-directory per platform,
+                    or campaign directory with one sub-directory per flight
+    Output :
+        list of platform directories (with trailing '/') containing a Level_1/ directory
+    """
+
+    directory = os.path.join(directory, "")
+
+    if os.path.isdir(directory + "Level_1"):
+        return [directory]
+
+    for pattern in ["*/Level_1", "*/*/Level_1"]:
+        found = sorted(os.path.dirname(i) + "/" for i in glob.glob(directory + pattern))
+        if len(found) > 0:
+            return found
+
+    return []
+
+run_options = ["directory", "run_levels", "workers", "jobs", "instrumentation", "prefetch_depth", "io_threads"]
+# DEFAULT options that select what is run and how, but do not change the outputs
+
+def stage_options(cfg, stage):
+    """
+    Options of the DEFAULT section (except run_options) and of the sections of a stage
+    """
+    options = {"DEFAULT": {key: value for key, value in cfg.defaults().items() if key not in run_options}}
+
+    for section in stage.sections:
+        if cfg.has_section(section):
+            options[section] = {
+                key: value for key, value in cfg.items(section) if cfg.defaults().get(key) != value
+            }
+            # DEFAULT options show up in every section; only those set (or overridden) in it are kept
+
+    return options
+
+def inputs_signature(data_dir, patterns, options=None):
+
+    """
+    Hash of the names, sizes and modification times of all files matching `patterns`
+    and of the config `options` of the stage; cheap to compute, and changes whenever
+    an input is added, removed or rewritten, or an option changes
+    """
+
+    sha = hashlib.sha256()
+
+    for pattern in patterns:
+        for path in sorted(glob.glob(data_dir + pattern)):
+            stat = os.stat(path)
+            sha.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    sha.update(json.dumps(options or {}, sort_keys=True).encode())
+    sha.update(str(joanne.__version__).encode())
+
+    return sha.hexdigest()
+
+class PipelineState:
+
+    """
+    Per-stage checkpoints of a platform directory
+
+    Input :
+        data_dir : string
+                   platform directory
+
+    A stage is marked "running" before it starts and "done" with the signature of
+    its inputs when it finishes, so that after a crash the finished stages are
+    skipped and the interrupted one is run again. Within a stage, the build
+    manifest (build_cache) avoids redoing sondes that were already finished.
+    """
+
+    def __init__(self, data_dir):
+
+        self.path = os.path.join(data_dir, state_name)
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        else:
+            self.stages = {}
+
+    def is_done(self, stage, signature):
+        entry = self.stages.get(stage.name, {})
+        return entry.get("status") == "done" and entry.get("inputs") == signature
+
+    def mark(self, stage, status, signature=None):
+
+        self.stages[stage.name] = {
+            "status": status,
+            "inputs": signature,
+            "time": datetime.datetime.utcnow().isoformat(timespec="seconds"),
+        }
+
+        tmp_path = self.path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f, indent=1)
+
+        os.replace(tmp_path, self.path)
+
+def run_platform(data_dir, run_levels=4, workers=1, force=False, config_file=None):
+
+    """
+    Input :
+        data_dir : string
+                   platform directory
+        run_levels : int
+                     highest processing level to run
+        workers : int
+                  worker processes within the Level-2 and Level-3 stages
+        force : bool
+                if True, the checkpoints are ignored
+        config_file : string
+                      config the stages read their options from; config.active_config_file() if None
+    Output :
+        (data_dir, error) : error is None or the traceback of the failed stage
+    Function to run all stages up to `run_levels` for one platform directory, in order,
+    skipping stages whose inputs are unchanged since they last finished. Stops at
+    the first failing stage
+    """
+
+    if config_file is None:
+        config_file = config.active_config_file()
+
+    cfg = config.read_config(config_file)
+
+    state = PipelineState(data_dir)
+
+    instrumentation.reset(f"{data_dir}reports/")
+
+    for stage in stages:
+
+        if stage.level > run_levels:
+            continue
+
+        if stage.enabled is not None:
+            with config.using(config_file):
+                enabled = stage.enabled()
+            if not enabled:
+                print(f"{data_dir}: {stage.name} switched off")
+                state.mark(stage, "off")
+                continue
+
+        options = stage_options(cfg, stage)
+        signature = inputs_signature(data_dir, stage.inputs, options)
+        outputs_exist = all(len(glob.glob(data_dir + i)) > 0 for i in stage.outputs)
+
+        if not force and outputs_exist and state.is_done(stage, signature):
+            print(f"{data_dir}: {stage.name} up to date")
+            continue
+
+        print(f"{data_dir}: starting {stage.name}...")
+
+        state.mark(stage, "running")
+
+        try:
+            with config.using(config_file), instrumentation.stage(stage.name):
+                stage.run(data_dir, workers)
+        except Exception:
+            state.mark(stage, "failed")
+            return data_dir, traceback.format_exc()
+
+        state.mark(stage, "done", inputs_signature(data_dir, stage.inputs, options))
+        # signature taken again, as a stage may write into the inputs of its successor
+
+        print(f"{data_dir}: {stage.name} finished")
+
+    report = instrumentation.write_report(f"{data_dir}reports/")
+
+    if report is not None:
+        print(f"{data_dir}: run report written to {report}")
+
+    return data_dir, None
+
+def _run_platform_task(task):
+    return run_platform(*task)
+
+def run_pipeline(
+    config_file=config.config_file, jobs=None, workers=None, force=False, report=None
+):
+
+    """
+    Input :
+        config_file : string
+                      path to run_config.cfg
+        jobs : int
+               number of platform directories processed concurrently; 1 if None
+        workers : int
+                  worker processes per platform; `workers` option of the config if None
+        force : bool
+                rerun all stages regardless of the checkpoints
+        report : string
+                 "off", "on" (JSON/CSV run report per platform directory in reports/) or
+                 "profile" (also cProfile dumps per stage); `instrumentation` option if None
+    Output :
+        dict with the traceback of every platform directory that failed
+    Function to run the pipeline for every platform directory below the
+    `directory` option(s) of the config (comma-separated) up to `run_levels`
+    """
+
+    cfg = config.read_config(config_file)
+    defaults = cfg["DEFAULT"]
+
+    directories = [i.strip() for i in defaults.get("directory", "").split(",") if i.strip()]
+    run_levels = defaults.getint("run_levels", fallback=4)
+
+    if workers is None:
+        workers = config.get_workers(cfg)
+
+    if jobs is None:
+        jobs = defaults.getint("jobs", fallback=1)
+
+    if report is None:
+        report = defaults.get("instrumentation", fallback="off")
+
+    if report in ["on", "profile"]:
+        instrumentation.enable(profile=report == "profile")
+
+    platform_dirs = [d for directory in directories for d in find_platform_directories(directory)]
+
+    if len(platform_dirs) == 0:
+        print(f"No platform directories with Level_1/ found in {directories}")
+        return {}
+
+    return run_platforms(
+        platform_dirs, run_levels=run_levels, workers=workers, jobs=jobs, force=force, config_file=config_file
+    )
+
+def run_platforms(platform_dirs, run_levels=4, workers=1, jobs=1, force=False, config_file=None):
+
+    """
+    Input :
+        platform_dirs : list
+                        platform directories to process
+        jobs : int
+               number of platform directories processed concurrently
+        config_file : string
+                      config the stages read their options from, see run_platform()
+    Output :
+        dict with the traceback of every platform directory that failed
+    """
+
+    tasks = [(d, run_levels, workers, force, config_file) for d in platform_dirs]
+
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_run_platform_task, tasks))
+    else:
+        results = [_run_platform_task(task) for task in tasks]
+
+    errors = {data_dir: error for data_dir, error in results if error is not None}
+
+    for data_dir, error in errors.items():
+        print(f"Processing failed for {data_dir}:\n{error}")
+
+    return errors
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run all processing stages configured in run_config.cfg")
+    parser.add_argument("--config", default=config.config_file)
+    parser.add_argument("--jobs", type=int, default=None, help="platform directories processed concurrently")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes per platform")
+    parser.add_argument("--force", action="store_true", help="ignore the stage checkpoints")
+    parser.add_argument("--report", choices=["off", "on", "profile"], default=None)
+    args = parser.parse_args()
+
+    run_pipeline(
+        args.config, jobs=args.jobs, workers=args.workers, force=args.force, report=args.report
+    )
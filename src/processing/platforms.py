@@ -0,0 +1,54 @@
+# Python file with the platform-specific settings of the processing
+
+import os
+
+import config
+
+default_conversions = {
+    "rh": (1 / 100, 0.0),
+    "p": (100, 0.0),
+    "ta": (1, 273.15),
+}
+# Level-2 variable -> (factor, offset) applied to the Level-1 values:
+# RH from % to fraction, pressure from hPa to Pa, temperature from degC to K
+
+platform_conversions = {
+    "HALO": {"rh": (1.06 / 100, 0.0)},
+    # RH of the HALO sondes is scaled by 1.06 to correct a dry bias
+    "P3": {},
+}
+# platform -> conversions that differ from default_conversions
+
+
+def get_conversions(platform):
+    """
+    (factor, offset) of every converted Level-2 variable for a platform
+    """
+    conversions = dict(default_conversions)
+    conversions.update(platform_conversions.get(platform, {}))
+
+    return conversions
+
+
+def platform_from_directory(data_dir, config_file=None):
+    """
+    Platform name from a platform directory (e.g. .../20200122/HALO/ -> "HALO").
+    Directories not named after a platform are looked up in the [platforms]
+    section of run_config.cfg (`directory name = platform`); raises a ValueError
+    if the platform is still unknown, as its unit conversions would be guessed
+    """
+    name = os.path.basename(os.path.normpath(data_dir))
+
+    if name in platform_conversions:
+        return name
+
+    cfg = config.read_config(config_file)
+
+    if cfg.has_section("platforms") and cfg["platforms"].get(name) in platform_conversions:
+        return cfg["platforms"][name]
+
+    raise ValueError(
+        f"Unknown platform of {data_dir}: name the directory after a platform "
+        f"({', '.join(platform_conversions)}) or add `{name} = <platform>` to the "
+        "[platforms] section of the config"
+    )
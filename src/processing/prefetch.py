@@ -0,0 +1,167 @@
+# Python file to overlap reading and writing of sonde files with the processing, in background threads
+
+import collections
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+try:
+    from xarray.backends.locks import HDF5_LOCK as hdf5_lock
+except ImportError:
+    hdf5_lock = threading.Lock()
+# HDF5 is usually not built thread-safe: netCDF4 calls made outside xarray (see
+# generate_Level_2.write_level_2_netcdf4) take the same lock as xarray's own reads
+
+def get_prefetch_options(config_file=None):
+    """
+    Read-ahead depth and number of I/O threads from the `prefetch_depth` and
+    `io_threads` options of run_config.cfg; a depth of 0 switches prefetching off
+    """
+    cfg = config.read_config(config_file)
+
+    return (
+        cfg["DEFAULT"].getint("prefetch_depth", fallback=4),
+        cfg["DEFAULT"].getint("io_threads", fallback=2),
+    )
+
+class PrefetchReader:
+
+    """
+    Iterator over loaded items, read ahead in background threads
+
+    Input :
+        loader : function
+                 reads and decodes one item, e.g. generate_Level_3.load_level_2
+        items : list
+                arguments of `loader`, in processing order
+        depth : int
+                number of items read ahead of the one being processed, which bounds
+                the loaded items held in memory
+        threads : int
+                  threads running `loader`
+
+    Yields (item, result, error) in the order of `items`; error is the traceback
+    if `loader` raised, so that one unreadable file does not stop the loop. With a
+    depth of 0, items are read in the calling thread when they are needed.
+    """
+
+    def __init__(self, loader, items, depth=4, threads=2):
+        self.loader = loader
+        self.items = list(items)
+        self.depth = depth
+        self.threads = max(1, threads)
+
+    def _load(self, item):
+        try:
+            return self.loader(item), None
+        except Exception:
+            return None, traceback.format_exc()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+
+        if self.depth <= 0:
+            for item in self.items:
+                yield (item, *self._load(item))
+            return
+
+        pending = collections.deque()
+        items = iter(self.items)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+
+            for item in items:
+                pending.append((item, executor.submit(self._load, item)))
+                if len(pending) >= self.depth:
+                    break
+
+            while pending:
+
+                item, future = pending.popleft()
+
+                for next_item in items:
+                    pending.append((next_item, executor.submit(self._load, next_item)))
+                    break
+                # the queue is refilled before the current item is handed out
+
+                yield (item, *future.result())
+
+def prefetch(loader, items, depth=4, threads=2):
+    """
+    Results of `loader` for all items, read `depth` items ahead; raises the
+    first error
+    """
+    for item, result, error in PrefetchReader(loader, items, depth=depth, threads=threads):
+        if error is not None:
+            raise RuntimeError(f"Reading {item} failed:\n{error}")
+        yield result
+
+class BackgroundWriter:
+
+    """
+    Writes submitted with submit() are run in a background thread, in order
+
+    Input :
+        depth : int
+                maximum number of writes waiting; submit() blocks when the queue
+                is full, so that outputs do not pile up in memory. With a depth
+                of 0, submit() writes in the calling thread
+
+    Use as a context manager, or call close(), to wait for all writes. Each
+    submit() returns a future whose result() is the return value of the write
+    and raises its error.
+    """
+
+    def __init__(self, depth=4):
+        self.depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=1) if depth > 0 else None
+        self._slots = threading.BoundedSemaphore(depth) if depth > 0 else None
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._slots.release()
+
+    def submit(self, func, *args, **kwargs):
+
+        if self._executor is None:
+            future = _DoneFuture()
+            try:
+                future.value = func(*args, **kwargs)
+            except Exception as error:
+                future.error = error
+            return future
+
+        self._slots.acquire()
+
+        return self._executor.submit(self._run, func, args, kwargs)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _DoneFuture:
+    """
+    Result of a write made in the calling thread, with the interface of a future
+    """
+    value = None
+    error = None
+
+    def done(self):
+        return True
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -0,0 +1,462 @@
+# Python file to access the Level-2, Level-3 and Level-4 products of several campaigns through one catalog
+
+import argparse
+import collections
+import glob
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+import config
+import pipeline
+from generate_Level_3 import sonde_id_from_file_name
+from level_2_store import Level2Store
+
+try:
+    import dask
+except ImportError:
+    dask = None
+
+index_name = "product_catalog.json"
+# metadata index, kept in the first catalogued directory unless given otherwise
+
+MAX_OPEN_PRODUCTS = 8
+# default cap on the number of products held open by the catalog
+
+platform_products = {
+    "Level_2": ["Level_2_store/*Level_2_v*", "Level_2/"],
+    "Level_3": ["Level_3/*RD41_Level_3_v*"],
+    "Level_3_derived": ["Level_3/*RD41_Level_3_derived_v*.nc"],
+    "Level_4": ["Level_4/*RD41_Level_4_v*.nc"],
+}
+# product -> glob patterns relative to a platform directory, in order of preference;
+# the first pattern that matches is catalogued (a Level-2 store before the per-sonde files)
+
+merged_products = ["Level_3/*RD41_Level_3_*v*.nc"]
+# merged Level-3 files of a flight or campaign directory (see campaign.py)
+
+def _file_format(path):
+    if os.path.isdir(path):
+        return "zarr" if path.rstrip("/").endswith(".zarr") else "files"
+    return "netcdf"
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _time_range(values):
+    values = np.asarray(values).astype("datetime64[ns]")
+    values = values[~np.isnat(values)]
+    if len(values) == 0:
+        return None
+    return [str(values.min()), str(values.max())]
+
+def read_metadata(path, file_format):
+
+    """
+    Input :
+        path : string
+               product file, Zarr store or directory of per-sonde Level-2 files
+        file_format : string
+                      "netcdf", "zarr" or "files"
+    Output :
+        dict with the dimensions, variables, sonde IDs and time coverage of the product
+
+    Only the headers and the coordinate-like variables (sonde_id, launch_time,
+    circle_time) are read; per-sonde Level-2 files are described from their names
+    """
+
+    if file_format == "files":
+        files = sorted(glob.glob(os.path.join(path, "*.nc")))
+        return {
+            "dims": {"sonde_id": len(files)},
+            "variables": [],
+            "sonde_ids": [sonde_id_from_file_name(i) for i in files],
+            "time_coverage": None,
+        }
+
+    if file_format == "zarr":
+        ds = xr.open_zarr(path)
+    else:
+        ds = xr.open_dataset(path)
+
+    with ds:
+
+        metadata = {
+            "dims": {str(k): int(v) for k, v in ds.sizes.items()},
+            "variables": [str(i) for i in ds.data_vars],
+            "sonde_ids": [str(i) for i in ds.sonde_id.values] if "sonde_id" in ds else [],
+            "time_coverage": None,
+        }
+
+        for var in ["launch_time", "circle_time"]:
+            if var in ds:
+                metadata["time_coverage"] = _time_range(ds[var].values)
+                break
+
+    return metadata
+
+class ProductCatalog:
+
+    """
+    Single access point to the products of one or more campaign directories
+
+    Input :
+        directories : list
+                      campaign, flight or platform directories
+        index_path : string
+                     JSON metadata index; `product_catalog.json` in the first directory if None
+        max_open : int
+                   maximum number of products held open; the least recently used
+                   product is closed when the cap is exceeded
+        refresh : bool
+                  if False, the catalog is built from the index alone, without listing
+                  the directories
+
+    Products are found by listing the directories. Their metadata (dimensions,
+    variables, sonde IDs, time coverage) is read once and kept in the index with
+    the size and modification time of the product, so opening the catalog
+    reads only products that are new or changed. Datasets are opened lazily,
+    chunked along sonde_id with dask if available.
+    """
+
+    def __init__(self, directories, index_path=None, max_open=None, refresh=True):
+
+        if isinstance(directories, str):
+            directories = [directories]
+
+        self.directories = [os.path.join(d, "") for d in directories]
+
+        if index_path is None:
+            index_path = os.path.join(self.directories[0], index_name)
+
+        if max_open is None:
+            max_open = int(config.get_option("catalog_max_open", fallback=MAX_OPEN_PRODUCTS))
+
+        self.index_path = index_path
+        self.max_open = max(1, int(max_open))
+        self._open = collections.OrderedDict()
+
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+        if refresh:
+            self.refresh()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(sorted(self.entries))
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    ###----- Index -----###
+
+    def _find_products(self):
+
+        """
+        name -> (path, level, campaign, flight, platform) of every product below the directories
+        """
+
+        found = {}
+
+        for directory in self.directories:
+
+            campaign = os.path.basename(os.path.normpath(directory))
+
+            platform_dirs = pipeline.find_platform_directories(directory)
+
+            for data_dir in platform_dirs:
+
+                relative = os.path.relpath(data_dir, directory)
+                parts = [] if relative == "." else relative.split(os.sep)
+                platform = os.path.basename(os.path.normpath(data_dir))
+                flight = parts[-2] if len(parts) >= 2 else None
+
+                for level, patterns in platform_products.items():
+                    for pattern in patterns:
+                        paths = sorted(glob.glob(data_dir + pattern))
+                        if len(paths) > 0:
+                            name = "/".join([campaign] + parts + [level])
+                            found[name] = (paths[-1].rstrip("/"), level, campaign, flight, platform)
+                            break
+                            # latest version if several are present
+
+            flight_dirs = {
+                os.path.dirname(os.path.normpath(d)) + "/"
+                for d in platform_dirs
+                if os.path.normpath(d) != os.path.normpath(directory)
+            }
+            # a flight directory holds the merged file of its platforms, the campaign
+            # directory that of all flights
+
+            for merged_dir in sorted(({directory} | flight_dirs) - set(platform_dirs)):
+
+                flight = None if merged_dir == directory else os.path.basename(os.path.normpath(merged_dir))
+
+                paths = [
+                    path
+                    for pattern in merged_products
+                    for path in sorted(glob.glob(merged_dir + pattern))
+                    if "derived" not in os.path.basename(path)
+                ]
+
+                if len(paths) > 0:
+                    name = "/".join([campaign] + ([flight] if flight else []) + ["Level_3_merged"])
+                    found[name] = (paths[-1], "Level_3_merged", campaign, flight, None)
+
+        return found
+
+    def refresh(self):
+
+        """
+        Update the index from a listing of the directories; only new or
+        changed products are opened to read their metadata
+        """
+
+        found = self._find_products()
+        changed = False
+
+        for name in list(self.entries):
+            if name not in found:
+                del self.entries[name]
+                changed = True
+
+        for name, (path, level, campaign, flight, platform) in found.items():
+
+            file_format = _file_format(path)
+            signature = _signature(path)
+            entry = self.entries.get(name)
+
+            if entry is not None and entry["path"] == path and entry["signature"] == signature:
+                continue
+
+            entry = {
+                "path": path,
+                "level": level,
+                "format": file_format,
+                "campaign": campaign,
+                "flight": flight,
+                "platform": platform,
+                "signature": signature,
+            }
+            entry.update(read_metadata(path, file_format))
+
+            self.entries[name] = entry
+            self._close(name)
+            changed = True
+
+        if changed:
+            self.save()
+
+        return self
+
+    def save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    ###----- Search -----###
+
+    def search(self, level=None, platform=None, flight=None, campaign=None, start=None, end=None):
+
+        """
+        Names of the products matching all given criteria, from the index alone;
+        `start`/`end` select products whose time coverage overlaps [start, end]
+        """
+
+        names = []
+
+        for name in sorted(self.entries):
+
+            entry = self.entries[name]
+
+            if level is not None and entry["level"] != level:
+                continue
+            if platform is not None and entry["platform"] != platform:
+                continue
+            if flight is not None and entry["flight"] != flight:
+                continue
+            if campaign is not None and entry["campaign"] != campaign:
+                continue
+
+            if start is not None or end is not None:
+                coverage = entry["time_coverage"]
+                if coverage is None:
+                    continue
+                if end is not None and np.datetime64(coverage[0]) > np.datetime64(end):
+                    continue
+                if start is not None and np.datetime64(coverage[1]) < np.datetime64(start):
+                    continue
+
+            names.append(name)
+
+        return names
+
+    def find_sonde(self, sonde_id, level="Level_3"):
+        """
+        Names of the products of `level` that contain the sonde
+        """
+        return [name for name in self.search(level=level) if sonde_id in self.entries[name]["sonde_ids"]]
+
+    ###----- Opening -----###
+
+    def open(self, name, chunk_sondes=None):
+
+        """
+        Input :
+            name : string
+                   product name, see search()
+            chunk_sondes : int
+                           sondes per dask chunk; `level_3_chunk_sondes` option if None
+        Output :
+            dataset : xarray dataset
+                      lazily opened; Level-2 stores are opened as ragged arrays along `obs`.
+                      The catalog keeps the dataset open (do not close it yourself)
+                      until it is evicted or close() is called
+        """
+
+        entry = self.entries[name]
+
+        if entry["format"] == "files":
+            raise ValueError(f"{name} is a directory of per-sonde files; use read_sondes()")
+
+        if chunk_sondes is None:
+            chunk_sondes = int(config.get_option("level_3_chunk_sondes", fallback=64))
+
+        key = (name, chunk_sondes)
+
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+
+        chunks = None
+
+        if dask is not None:
+            dims = entry["dims"]
+            if "sonde_id" in dims and "obs" not in dims:
+                chunks = {"sonde_id": chunk_sondes}
+            else:
+                chunks = {}
+                # dask arrays with the chunks of the file
+
+        if entry["format"] == "zarr":
+            ds = xr.open_zarr(entry["path"], chunks=chunks)
+        else:
+            ds = xr.open_dataset(entry["path"], chunks=chunks)
+
+        self._open[key] = ds
+
+        while len(self._open) > self.max_open:
+            _, oldest = self._open.popitem(last=False)
+            oldest.close()
+
+        return ds
+
+    def read_sondes(self, name, sonde_ids):
+
+        """
+        Input :
+            name : string
+                   Level-2 product
+            sonde_ids : list
+        Output :
+            list of per-sonde Level-2 datasets, loaded; only these sondes are read
+        """
+
+        entry = self.entries[name]
+
+        if entry["format"] == "files":
+            files = {
+                sonde_id_from_file_name(i): i
+                for i in glob.glob(os.path.join(entry["path"], "*.nc"))
+            }
+            sondes = []
+            for sonde_id in sonde_ids:
+                with xr.open_dataset(files[sonde_id]) as ds:
+                    sondes.append(ds.load())
+            return sondes
+
+        store = Level2Store(entry["path"])
+        try:
+            return [store.get(str(sonde_id)) for sonde_id in sonde_ids]
+        finally:
+            store.close()
+
+    def _close(self, name):
+        for key in [k for k in self._open if k[0] == name]:
+            self._open.pop(key).close()
+
+    def close(self):
+        """
+        Close all products that are currently held open
+        """
+        while self._open:
+            _, ds = self._open.popitem(last=False)
+            ds.close()
+
+    ###----- Intake -----###
+
+    def write_intake_catalog(self, save_path, chunk_sondes=None):
+
+        """
+        Write an intake catalog (YAML, intake-xarray drivers) with one source per
+        NetCDF or Zarr product, described with the metadata of the index
+        """
+
+        import yaml
+        # optional dependency, only needed for the intake catalog
+
+        if chunk_sondes is None:
+            chunk_sondes = int(config.get_option("level_3_chunk_sondes", fallback=64))
+
+        sources = {}
+
+        for name in sorted(self.entries):
+
+            entry = self.entries[name]
+
+            if entry["format"] == "files":
+                continue
+
+            chunks = {"sonde_id": chunk_sondes} if "sonde_id" in entry["dims"] and "obs" not in entry["dims"] else {}
+
+            sources[name.replace("/", "_")] = {
+                "description": f"{entry['level']} {entry['campaign']} {entry['flight'] or ''} {entry['platform'] or ''}".strip(),
+                "driver": "zarr" if entry["format"] == "zarr" else "netcdf",
+                "args": {"urlpath": os.path.abspath(entry["path"]), "chunks": chunks},
+                "metadata": {
+                    key: entry[key]
+                    for key in ["level", "campaign", "flight", "platform", "dims", "time_coverage"]
+                },
+            }
+
+        with open(save_path, "w") as f:
+            yaml.safe_dump({"metadata": {"version": 1}, "sources": sources}, f, sort_keys=False)
+
+        return save_path
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Catalog the products of one or more campaigns")
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--index", default=None, help="path of the metadata index")
+    parser.add_argument("--intake", default=None, help="also write an intake catalog to this YAML file")
+    args = parser.parse_args()
+
+    catalog = ProductCatalog(args.directories, index_path=args.index)
+
+    for name in catalog:
+        entry = catalog.entries[name]
+        print(f"{name}: {len(entry['sonde_ids'])} sondes, {entry['time_coverage']}")
+
+    if args.intake is not None:
+        catalog.write_intake_catalog(args.intake)
@@ -0,0 +1,376 @@
+# Python file to compute profile statistics from Level-3 and render the quicklook sheets
+
+import glob
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+import joanne
+
+import build_cache
+import config
+import derived_variables
+import drift
+import generate_Level_4
+
+data_directory = 'extra/Sample_Data/20200122/HALO/'
+
+default_variables = ["ta", "rh", "q", "u", "v", "p"]
+
+quantiles = [0.25, 0.5, 0.75]
+
+def get_quicklook_options(config_file=None):
+
+    """
+    Options of the [quicklooks] section of run_config.cfg
+    Output :
+        dict with mode ("on"/"off"), variables (list), low_alt, high_alt (m) and dpi
+    """
+
+    cfg = config.read_config(config_file)
+
+    section = cfg["quicklooks"] if cfg.has_section("quicklooks") else cfg["DEFAULT"]
+
+    variables = section.get("variables", fallback=", ".join(default_variables))
+
+    return {
+        "mode": section.get("mode", fallback="on"),
+        "variables": [i.strip() for i in variables.split(",") if i.strip()],
+        "low_alt": section.getfloat("low_alt", fallback=0),
+        "high_alt": section.getfloat("high_alt", fallback=8000),
+        "dpi": section.getint("dpi", fallback=100),
+    }
+
+#### Profile statistics #####
+
+def profile_statistics(dataset, variables, groups, low_alt=0, high_alt=8000):
+
+    """
+    Input :
+        dataset : xarray dataset
+                  Level-3 (and derived) variables with (sonde_id, alt) dimensions
+        variables : list
+                    variables to summarise
+        groups : dict
+                 group name (e.g. "flight" or a circle ID) -> boolean mask along sonde_id
+        low_alt, high_alt : float
+                            altitude range of the profiles, m
+    Output :
+        stats : xarray dataset
+                mean and count (group, variable, alt) and the quartiles
+                (group, quantile, variable, alt) of every variable
+
+    The altitude range is selected once and all variables are stacked into a single
+    (variable, sonde_id, alt) array, so that every group takes one mean and one
+    quantile reduction for all variables together, instead of one selection and
+    separate quantile calls per variable and plot
+    """
+
+    subset = dataset[variables].sel(alt=slice(low_alt, high_alt))
+
+    values = np.stack(
+        [subset[var].transpose("sonde_id", "alt").values.astype("float64") for var in variables]
+    )
+    # (variable, sonde_id, alt)
+
+    names = list(groups)
+    n_alt = values.shape[-1]
+
+    mean = np.full((len(names), len(variables), n_alt), np.nan)
+    quartiles = np.full((len(names), len(quantiles), len(variables), n_alt), np.nan)
+    count = np.zeros((len(names), len(variables), n_alt), dtype="int32")
+
+    with np.errstate(invalid="ignore"):
+        for n, name in enumerate(names):
+
+            block = values[:, np.asarray(groups[name], dtype=bool), :]
+
+            if block.shape[1] == 0:
+                continue
+
+            valid = ~np.isnan(block)
+            count[n] = valid.sum(axis=1)
+
+            has_data = count[n] > 0
+            mean[n] = np.where(has_data, np.nansum(block, axis=1) / np.maximum(count[n], 1), np.nan)
+
+            quartiles[n] = np.nanquantile(block, quantiles, axis=1)
+            # all-NaN levels give NaN (with a RuntimeWarning) and are masked by `count`
+
+    stats = xr.Dataset(
+        {
+            "mean": (["group", "variable", "alt"], mean),
+            "quartiles": (["group", "quantile", "variable", "alt"], quartiles),
+            "count": (["group", "variable", "alt"], count),
+            "units": (["variable"], [subset[var].attrs.get("units", "") for var in variables]),
+        },
+        coords={
+            "group": names,
+            "quantile": quantiles,
+            "variable": variables,
+            "alt": subset.alt.values,
+        },
+    )
+
+    stats["alt"].attrs = dict(subset.alt.attrs)
+
+    return stats
+
+def sonde_groups(lv3_dataset, circles):
+
+    """
+    The whole flight and every circle with at least one sonde, as sonde_id masks
+    """
+
+    groups = {"flight": np.ones(lv3_dataset.sizes["sonde_id"], dtype=bool)}
+
+    if len(circles) > 0:
+        circle_ids, membership = generate_Level_4.group_sondes_into_circles(lv3_dataset, circles)
+        for circle_id, members in zip(circle_ids, membership):
+            if members.any():
+                groups[str(circle_id)] = members
+
+    return groups
+
+#### Rendering #####
+
+def render_sheet(save_path, title, alt, variables, units, mean, quartiles, dpi=100):
+
+    """
+    Input :
+        save_path : string
+                    PNG file to write
+        alt : np.ndarray
+              altitude (m)
+        mean : np.ndarray, (variable, alt)
+        quartiles : np.ndarray, (quantile, variable, alt)
+    Output :
+        save_path : string
+    One panel per variable with the mean, the median and the inter-quartile range
+    """
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+    # figures are only written to file, also in the worker processes
+
+    import matplotlib.pyplot as plt
+    # imported here, so that the pipeline does not need matplotlib unless quicklooks are rendered
+
+    f, ax = plt.subplots(
+        1, len(variables), sharey=True, figsize=(3 * len(variables), 6), squeeze=False
+    )
+
+    for i, var in enumerate(variables):
+
+        a = ax[0, i]
+        a.fill_betweenx(alt / 1000, quartiles[0, i], quartiles[2, i], alpha=0.5, color="grey", label="IQR")
+        a.plot(quartiles[1, i], alt / 1000, c="k", linestyle="--", linewidth=1, label="Median")
+        a.plot(mean[i], alt / 1000, c="k", label="Mean")
+
+        a.set_xlabel(f"{var} / {units[i]}" if units[i] else var)
+        a.spines["right"].set_visible(False)
+        a.spines["top"].set_visible(False)
+
+    ax[0, 0].set_ylabel("Altitude / km")
+    ax[0, 0].legend(frameon=False)
+
+    f.suptitle(title)
+    f.savefig(save_path, dpi=dpi, bbox_inches="tight")
+
+    plt.close(f)
+
+    return save_path
+
+def sheet_path(save_directory, group):
+    return f"{save_directory}Quicklook_{group}_v{joanne.__version__}.png"
+
+def remove_stale_sheets(save_directory, groups):
+    """
+    Delete the sheets of groups that no longer exist (e.g. after the circles
+    changed), so that Quicklooks/ only holds the sheets of the current groups
+    """
+    current = {sheet_path(save_directory, group) for group in groups}
+
+    for path in glob.glob(sheet_path(save_directory, "*")):
+        if path not in current:
+            os.remove(path)
+
+def is_enabled():
+    """
+    True if the quicklooks are switched on (`mode` option of the [quicklooks] section)
+    """
+    return get_quicklook_options()["mode"] == "on"
+
+def _render_sheet_task(task):
+    """
+    Wrapper around render_sheet() that returns the error instead of raising it
+    """
+    try:
+        return render_sheet(*task), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def render_sheets(stats, save_directory, title_prefix="", workers=1, dpi=100):
+
+    """
+    Input :
+        stats : xarray dataset
+                as returned by profile_statistics()
+        save_directory : string
+        workers : int
+                  figures exported in parallel by this many processes
+    Output :
+        list of (file path or None, error) per group, in group order
+    One sheet per group; the workers only receive the small statistics arrays
+    """
+
+    variables = [str(i) for i in stats.variable.values]
+    units = [str(i) for i in stats.units.values]
+    alt = stats.alt.values
+
+    tasks = [
+        (
+            sheet_path(save_directory, group),
+            f"{title_prefix}{group}",
+            alt,
+            variables,
+            units,
+            stats["mean"].values[n],
+            stats["quartiles"].values[n],
+            dpi,
+        )
+        for n, group in enumerate(str(i) for i in stats.group.values)
+    ]
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_render_sheet_task, tasks))
+
+    return [_render_sheet_task(task) for task in tasks]
+
+######## Generating quicklooks ######
+
+def generate_quicklooks(data_directory=data_directory, variables=None, circles=None, workers=None):
+
+    """
+    Input :
+        data_directory : string
+                         platform directory with the Level_3/ sub-directory
+        variables : list
+                    Level-3, derived or gridded drift variables (e.g. drift_distance);
+                    `variables` option of the [quicklooks] section of run_config.cfg if None
+        circles : list
+                  (circle_id, start, end); read with generate_Level_4.get_circle_times() if None
+        workers : int
+                  processes exporting the figures; `workers` option if None
+    Output :
+        list of quicklook files, or None if quicklooks are switched off or there is no Level-3
+    Function to render a profile sheet for the flight and for every circle. The
+    statistics are cached in Quicklooks/ and only recomputed when the Level-3 file,
+    the derived variables, the drift, the circles or the options change
+    """
+
+    options = get_quicklook_options()
+
+    if options["mode"] != "on":
+        print("Quicklooks are switched off in run_config.cfg.")
+        return None
+
+    if variables is None:
+        variables = options["variables"]
+
+    if circles is None:
+        circles = generate_Level_4.get_circle_times()
+
+    if workers is None:
+        workers = config.get_workers()
+
+    manifest = build_cache.open_manifest(data_directory)
+
+    if len(manifest.outputs("Level_3", "dataset")) == 0:
+        print("No Level-3 file found. Not rendering quicklooks.")
+        return None
+
+    save_directory = f"{data_directory}Quicklooks/"
+
+    os.makedirs(save_directory, exist_ok=True)
+
+    stats_path = f"{save_directory}Quicklook_statistics_v{joanne.__version__}.nc"
+
+    stats_key = manifest.key(
+        params={
+            "level_3": manifest.stages["Level_3"]["dataset"]["key"],
+            "derived": manifest.stages.get("Level_3_derived", {}).get("dataset", {}).get("key"),
+            "drift": manifest.stages.get("Drift", {}).get("dataset", {}).get("key"),
+            "variables": variables,
+            "alt_range": [options["low_alt"], options["high_alt"]],
+            "circles": [[str(i) for i in circle] for circle in circles],
+        }
+    )
+
+    if manifest.is_fresh("Quicklook_statistics", "dataset", stats_key):
+
+        with xr.open_dataset(stats_path) as ds:
+            stats = ds.load()
+
+    else:
+
+        lv3_dataset = derived_variables.open_level_3(manifest.outputs("Level_3", "dataset")[0])
+
+        missing = [var for var in variables if var not in lv3_dataset]
+
+        if len(missing) > 0:
+            derived = derived_variables.open_derived(data_directory)
+            if derived is not None:
+                lv3_dataset = lv3_dataset.merge(derived[[i for i in missing if i in derived]])
+
+        missing = [var for var in variables if var not in lv3_dataset]
+
+        if len(missing) > 0:
+            drift_dataset = drift.open_drift(data_directory)
+            if drift_dataset is not None:
+                lv3_dataset = lv3_dataset.merge(
+                    drift_dataset[[i for i in missing if i in drift_dataset]], join="left"
+                )
+
+        variables = [var for var in variables if var in lv3_dataset]
+
+        stats = profile_statistics(
+            lv3_dataset,
+            variables,
+            sonde_groups(lv3_dataset, circles),
+            low_alt=options["low_alt"],
+            high_alt=options["high_alt"],
+        )
+
+        lv3_dataset.close()
+
+        stats.to_netcdf(stats_path)
+
+    sheets = render_sheets(
+        stats,
+        save_directory,
+        title_prefix=os.path.basename(os.path.normpath(data_directory)) + " ",
+        workers=workers,
+        dpi=options["dpi"],
+    )
+
+    for path, error in sheets:
+        if error is not None:
+            print(f"Rendering a quicklook failed:\n{error}")
+
+    quicklook_files = [path for path, _ in sheets if path is not None]
+
+    remove_stale_sheets(save_directory, [str(i) for i in stats.group.values])
+
+    manifest.record("Quicklook_statistics", "dataset", stats_key, [stats_path])
+    manifest.save()
+
+    return quicklook_files
+
+if __name__ == '__main__':
+    generate_quicklooks(data_directory)
@@ -1,37 +1,74 @@
+import argparse
 import joanne
 import os
-import QC
+import campaign
+import config
+import pipeline
+import watch
 
-data_directory = 'extra/Sample_Data/20200122/HALO/'
-jo_version = joanne.__version__
+# guarded so that worker processes started with 'spawn' do not rerun the pipeline
+if __name__ == '__main__':
 
-####### QC
-print('Starting QC...')
-qc_dir = os.path.join(data_directory, "QC/")
-
-status_file = f"{qc_dir}Status_of_sondes_v{joanne.__version__}.nc"
+    parser = argparse.ArgumentParser(description="Run QC, Level-2, Level-3 and Level-4 processing")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.get_workers(),
+        help="number of worker processes for Level-2 and Level-3 (default from run_config.cfg)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of platform directories processed concurrently (default from run_config.cfg)",
+    )
+    parser.add_argument("--force", action="store_true", help="ignore the stage checkpoints")
+    parser.add_argument(
+        "--report",
+        choices=["off", "on", "profile"],
+        default=None,
+        help="write a timing/memory run report (and cProfile dumps) per platform directory "
+        "(default from the `instrumentation` option of run_config.cfg)",
+    )
+    parser.add_argument(
+        "--campaign",
+        action="store_true",
+        help="treat `directory` of run_config.cfg as a campaign directory (flight/platform/) "
+        "and also write merged per-flight and campaign Level-3 files",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="process sondes as they arrive in Level_1/ instead of a single batch run",
+    )
+    parser.add_argument("--interval", type=float, default=5, help="seconds between polls with --watch")
+    args = parser.parse_args()
 
-if os.path.exists(status_file):
-    print("QC Status file of the current version found. Not running tests again...")
-else:
-    print("QC Status files of the current version not found. Running tests...")
-    QC.run_qc(data_directory)
-print('QC finished')
+    jo_version = joanne.__version__
 
-####### Level-2
-print('Starting Level-2...')
-import generate_Level_2
-print("Level-2 finished")
+    if args.watch:
+        directory = config.get_option("directory", fallback="extra/Sample_Data/20200122/")
+        for data_directory in pipeline.find_platform_directories(directory)[:1]:
+            watch.watch(data_directory, interval=args.interval)
+        raise SystemExit
 
-####### Level-3
-l3_filelist = [x for x in os.listdir(f'{data_directory}/Level_3') if x[-8:] == f"{jo_version}.nc"]
+    # stages (QC, Level-2, Level-3, derived variables, Level-4) are run for every platform
+    # directory below `directory` of run_config.cfg, up to `run_levels`; finished stages
+    # are checkpointed, and within a stage the build manifest (build_cache) avoids
+    # reprocessing what did not change since the last run
 
-if len(l3_filelist) > 0:
-    print(
-        "Level-3 file found with the current JOANNE version. Therefore not running Level-3 script again."
-    )
-else:
-    print("Starting Level-3")
-    import generate_Level_3
+    if args.campaign:
+        errors = campaign.run_campaign(
+            config.get_option("directory", fallback="extra/Sample_Data/"),
+            jobs=args.jobs,
+            workers=args.workers,
+            force=args.force,
+            report=args.report,
+        )
+    else:
+        errors = pipeline.run_pipeline(
+            jobs=args.jobs, workers=args.workers, force=args.force, report=args.report
+        )
 
-print("Level-3 finished")
\ No newline at end of file
+    if len(errors) > 0:
+        raise SystemExit(1)
@@ -0,0 +1,189 @@
+# Python file to index ASPEN-processed sondes and open them lazily, one at a time
+
+import collections
+import collections.abc
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import config
+from a_file_index import open_a_file_index
+
+MAX_OPEN_SONDES = 32
+# default cap on the number of Level-1 datasets held open at the same time
+
+
+class LazySondeDatasets(collections.abc.Sequence):
+
+    """
+    Sequence of Level-1 sonde datasets that are opened only when indexed
+
+    Behaves like a list of opened datasets, so it can be passed to functions
+    that index or map over it, but at most `max_open` datasets are open at any
+    time. The least recently used dataset
+    is closed when the cap is exceeded.
+    """
+
+    def __init__(self, sonde_paths, max_open=MAX_OPEN_SONDES):
+        self.sonde_paths = sonde_paths
+        self.max_open = max(1, int(max_open))
+        self._open = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.sonde_paths)
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("sonde index out of range")
+
+        if index in self._open:
+            self._open.move_to_end(index)
+            return self._open[index]
+
+        ds = xr.open_dataset(self.sonde_paths[index])
+        self._open[index] = ds
+
+        while len(self._open) > self.max_open:
+            _, oldest = self._open.popitem(last=False)
+            oldest.close()
+
+        return ds
+
+    def close(self):
+        """
+        Close all datasets that are currently held open
+        """
+        while self._open:
+            _, ds = self._open.popitem(last=False)
+            ds.close()
+
+
+class SondeCatalog:
+
+    """
+    Index of all sondes of one platform directory
+
+    Input :
+        data_dir : string
+                   platform directory containing Level_0/ (A-files) and Level_1/ (ASPEN files)
+        aspen_suffix : string
+                       glob pattern of the ASPEN-processed files in Level_1/;
+                       read from the `aspen_suffix` option of run_config.cfg if None
+        max_open : int
+                   maximum number of Level-1 datasets held open by `datasets`
+
+    File paths, file times and A-file pairings are derived from file names only;
+    launch times are read from the file headers on first use. No dataset is
+    kept open by the catalog itself; use iter_datasets() to stream through all
+    sondes or `datasets` for indexed access with a bounded number of open files.
+    """
+
+    def __init__(self, data_dir, aspen_suffix=None, max_open=MAX_OPEN_SONDES):
+
+        self.data_dir = data_dir
+
+        if aspen_suffix is None:
+            aspen_suffix = config.get_option("aspen_suffix", fallback="*QC.nc")
+
+        self.directory = f"{data_dir}Level_1/"
+        # directory where all sonde files are present
+
+        self.a_dir = f"{data_dir}Level_0/"
+        # directory where all the A files are present
+
+        self.qc_directory = f"{data_dir}QC/"
+        # directory to store logs and stats
+
+        self.sonde_paths = sorted(glob.glob(self.directory + aspen_suffix))
+        # paths to the individual sonde files
+
+        self.file_time_str = [path[-20:-5] for path in self.sonde_paths]
+        # sonde time extracted from file name as string
+
+        self.file_time = [
+            np.datetime64(pd.to_datetime(i, format="%Y%m%d_%H%M%S"), "s")
+            for i in self.file_time_str
+        ]
+
+        self.a_files = ["A" + i for i in self.file_time_str]
+        # file names for the log files starting with A.
+
+        self.datasets = LazySondeDatasets(self.sonde_paths, max_open=max_open)
+
+        self._a_filepaths = None
+        self._a_file_index = None
+        self._launch_times = None
+
+    def __len__(self):
+        return len(self.sonde_paths)
+
+    @property
+    def a_filepaths(self):
+        """
+        Sorted list of A-file paths for every sonde, from a single listing of Level_0/
+        """
+        if self._a_filepaths is None:
+
+            a_index = collections.defaultdict(list)
+
+            if os.path.isdir(self.a_dir):
+                for name in sorted(os.listdir(self.a_dir)):
+                    a_index[name[:16]].append(self.a_dir + name)
+
+            self._a_filepaths = [a_index[i] for i in self.a_files]
+
+        return self._a_filepaths
+
+    @property
+    def a_file_index(self):
+        """
+        Parsed contents of the A-files (see a_file_index.py), opened on first use
+        """
+        if self._a_file_index is None:
+            self._a_file_index = open_a_file_index(self.data_dir)
+
+        return self._a_file_index
+
+    @property
+    def launch_times(self):
+        """
+        Launch time of every sonde, read from the file headers and cached
+        """
+        if self._launch_times is None:
+
+            launch_times = [None] * len(self)
+
+            for i, path in enumerate(self.sonde_paths):
+                with xr.open_dataset(path) as ds:
+                    launch_times[i] = ds.launch_time.values[()]
+
+            self._launch_times = launch_times
+
+        return self._launch_times
+
+    def open(self, index):
+        """
+        Open the dataset of a single sonde; the caller is responsible for closing it
+        """
+        return xr.open_dataset(self.sonde_paths[index])
+
+    def iter_datasets(self):
+        """
+        Generator yielding the dataset of each sonde in file order;
+        every dataset is closed as soon as the next one is requested
+        """
+        for path in self.sonde_paths:
+            with xr.open_dataset(path) as ds:
+                yield ds
+
+    def close(self):
+        self.datasets.close()
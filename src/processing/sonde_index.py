@@ -0,0 +1,324 @@
+# Python file to select sondes of a Level-3 product by launch time and launch position
+
+import argparse
+import os
+
+import numpy as np
+import xarray as xr
+
+import joanne
+
+import derived_variables
+
+grid_resolution = 0.5
+# degrees; size of the lat/lon cells of the position index
+
+earth_radius = 6371.0
+# km
+
+def index_path(lv3_path):
+    """
+    Path of the sonde index of a Level-3 file or Zarr store, in an index/ directory
+    next to it (so that it is not listed with the products)
+    """
+    name = os.path.basename(os.path.normpath(lv3_path))
+    stem = name[: -len(".zarr")] if name.endswith(".zarr") else os.path.splitext(name)[0]
+
+    return os.path.join(os.path.dirname(os.path.normpath(lv3_path)), "index", stem + ".nc")
+
+def _cells(lat, lon, resolution):
+    lon = np.asarray(lon)
+    rows = np.floor((np.asarray(lat) + 90) / resolution).astype("int64")
+    cols = np.floor((np.mod(lon + 180, 360)) / resolution).astype("int64")
+    cols = np.where(lon == 180, int(round(360 / resolution)) - 1, cols)
+    # 180 E is kept in the last column, so that a box ending at 180 E does not wrap to 180 W
+    return rows, cols
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(a))
+
+class SondeIndex:
+
+    """
+    Launch-time and launch-position index of the sondes of a Level-3 product
+
+    Input :
+        sonde_id, launch_time, lat, lon : np.ndarray
+                                          per sonde, in the order of the Level-3 product
+        resolution : float
+                     cell size of the position grid, degrees
+        source : string
+                 the Level-3 file or store the positions refer to
+
+    Launch times are kept sorted, so a time window is found with two binary
+    searches. Launch positions are bucketed into lat/lon cells kept in cell order
+    with the offset of every occupied cell, so a box or radius query only looks at
+    the sondes of the cells it overlaps. Queries return positions along sonde_id
+    of the Level-3 product; select() reads only those sondes.
+    """
+
+    def __init__(self, sonde_id, launch_time, lat, lon, resolution=grid_resolution, source=None):
+
+        self.sonde_id = np.asarray(sonde_id).astype(str)
+        self.lat = np.asarray(lat, dtype="float64")
+        self.lon = np.asarray(lon, dtype="float64")
+        self.resolution = float(resolution)
+        self.source = source
+
+        self.launch_time = np.asarray(launch_time).astype("datetime64[ns]")
+        launch_time = self.launch_time.astype("int64")
+
+        self.time_order = np.argsort(launch_time, kind="stable")
+        self.sorted_time = launch_time[self.time_order]
+
+        valid = np.flatnonzero(~np.isnan(self.lat) & ~np.isnan(self.lon))
+        rows, cols = _cells(self.lat[valid], self.lon[valid], self.resolution)
+        n_cols = int(round(360 / self.resolution))
+        cells = rows * n_cols + cols
+
+        order = np.argsort(cells, kind="stable")
+        self.cell_order = valid[order]
+        self.cell_keys, self.cell_start = np.unique(cells[order], return_index=True)
+        self.cell_end = np.append(self.cell_start[1:], len(order))
+        self._n_cols = n_cols
+
+    def __len__(self):
+        return len(self.sonde_id)
+
+    ###----- Building, saving and loading -----###
+
+    @classmethod
+    def from_level_3(cls, lv3_path, resolution=grid_resolution):
+        """
+        Index of a Level-3 file or Zarr store; only sonde_id, launch_time, flight_lat
+        and flight_lon are read
+        """
+        lv3 = derived_variables.open_level_3(lv3_path)
+        with lv3:
+            return cls(
+                lv3.sonde_id.values,
+                lv3.launch_time.values,
+                lv3.flight_lat.values,
+                lv3.flight_lon.values,
+                resolution=resolution,
+                source=lv3_path,
+            )
+
+    def to_dataset(self):
+        return xr.Dataset(
+            {
+                "launch_time": (["sonde_id"], self.launch_time),
+                "flight_lat": (["sonde_id"], self.lat),
+                "flight_lon": (["sonde_id"], self.lon),
+            },
+            coords={"sonde_id": self.sonde_id},
+            attrs={
+                "source": str(self.source),
+                "resolution": self.resolution,
+                "JOANNE_version": str(joanne.__version__),
+            },
+        )
+
+    def save(self, save_path):
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        tmp_path = save_path + ".tmp"
+        self.to_dataset().to_netcdf(tmp_path)
+        os.replace(tmp_path, save_path)
+        return save_path
+
+    @classmethod
+    def load(cls, path):
+        """
+        Index saved with save(); the sort orders and cells are rebuilt, which is
+        cheap compared to reading the Level-3 product
+        """
+        with xr.open_dataset(path) as ds:
+            return cls(
+                ds.sonde_id.values,
+                ds.launch_time.values,
+                ds.flight_lat.values,
+                ds.flight_lon.values,
+                resolution=ds.attrs.get("resolution", grid_resolution),
+                source=ds.attrs.get("source"),
+            )
+
+    ###----- Queries -----###
+
+    def in_time_window(self, start=None, end=None):
+        """
+        Positions of the sondes launched within [start, end], in launch-time order
+        """
+        lo = 0 if start is None else np.searchsorted(
+            self.sorted_time, np.datetime64(start, "ns").astype("int64"), side="left"
+        )
+        hi = len(self.sorted_time) if end is None else np.searchsorted(
+            self.sorted_time, np.datetime64(end, "ns").astype("int64"), side="right"
+        )
+        return self.time_order[lo:hi]
+
+    def in_box(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        Positions of the sondes launched within the lat/lon box (lon_min > lon_max
+        crosses the date line; a box spanning 360 degrees covers all longitudes)
+        """
+        row_min, col_min = _cells(lat_min, lon_min, self.resolution)
+        row_max, col_max = _cells(lat_max, lon_max, self.resolution)
+
+        all_lon = lon_max - lon_min >= 360
+
+        if all_lon:
+            cols = np.arange(self._n_cols)
+        elif col_min <= col_max:
+            cols = np.arange(col_min, col_max + 1)
+        else:
+            cols = np.concatenate([np.arange(col_min, self._n_cols), np.arange(0, col_max + 1)])
+
+        keys = (np.arange(row_min, row_max + 1)[:, np.newaxis] * self._n_cols + cols).ravel()
+
+        found = np.searchsorted(self.cell_keys, keys)
+        keys, found = keys[found < len(self.cell_keys)], found[found < len(self.cell_keys)]
+        found = found[self.cell_keys[found] == keys]
+        # occupied cells only, each once
+
+        if len(found) == 0:
+            return np.array([], dtype="int64")
+
+        candidates = np.concatenate(
+            [self.cell_order[self.cell_start[i] : self.cell_end[i]] for i in found]
+        )
+
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        if all_lon:
+            in_lon = np.ones(len(candidates), dtype=bool)
+        elif lon_min <= lon_max:
+            in_lon = (lon >= lon_min) & (lon <= lon_max)
+        else:
+            in_lon = (lon >= lon_min) | (lon <= lon_max)
+
+        return np.sort(candidates[(lat >= lat_min) & (lat <= lat_max) & in_lon])
+
+    def within(self, lat, lon, radius_km):
+        """
+        Positions of the sondes launched within `radius_km` of (lat, lon)
+        """
+        dlat = radius_km / 111.2
+        dlon = dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+
+        if dlon >= 180:
+            lon_min, lon_max = -180, 180
+            # the circle covers all longitudes; wrapped bounds would exclude its centre
+        else:
+            lon_min = (lon - dlon + 180) % 360 - 180
+            lon_max = (lon + dlon + 180) % 360 - 180
+
+        candidates = self.in_box(lat - dlat, lat + dlat, lon_min, lon_max)
+
+        distance = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+
+        return candidates[distance <= radius_km]
+
+    def query(self, start=None, end=None, box=None, point=None, radius_km=None):
+
+        """
+        Input :
+            start, end : np.datetime64 or string
+                         launch-time window
+            box : tuple
+                  (lat_min, lat_max, lon_min, lon_max)
+            point, radius_km : (lat, lon) and distance in km
+        Output :
+            positions : np.ndarray
+                        positions along sonde_id of the sondes matching all criteria,
+                        in launch-time order
+        """
+
+        positions = self.in_time_window(start, end)
+
+        if box is not None:
+            positions = positions[np.isin(positions, self.in_box(*box))]
+
+        if point is not None and radius_km is not None:
+            positions = positions[np.isin(positions, self.within(point[0], point[1], radius_km))]
+
+        return positions
+
+    def sonde_ids(self, positions):
+        return [str(i) for i in self.sonde_id[positions]]
+
+    def select(self, positions, lv3_path=None, chunk_sondes=None):
+
+        """
+        Input :
+            positions : np.ndarray
+                        as returned by the queries
+            lv3_path : string
+                       Level-3 file or store; the indexed source if None
+        Output :
+            dataset : xarray dataset
+                      the selected sondes, loaded; only their slices are read
+        """
+
+        lv3 = derived_variables.open_level_3(lv3_path or self.source, chunk_sondes=chunk_sondes)
+
+        with lv3:
+            return lv3.isel(sonde_id=np.sort(positions)).load()
+
+def update_sonde_index(lv3_path, manifest, item, lv3_key, resolution=grid_resolution):
+
+    """
+    Input :
+        lv3_path : string
+                   Level-3 file or Zarr store
+        manifest : build_cache.BuildManifest
+                   manifest of the directory of the Level-3 product
+        item : string
+               name of the Level-3 product in the manifest
+        lv3_key : string
+                  build key of the Level-3 product
+    Output :
+        path of the index
+    Function to (re)build the sonde index of a Level-3 product unless it is up to
+    date; called after the Level-3 products are written
+    """
+
+    save_path = index_path(lv3_path)
+
+    index_key = manifest.key(params={"level_3": lv3_key, "resolution": resolution})
+
+    if manifest.is_fresh("Sonde_index", item, index_key):
+        return save_path
+
+    SondeIndex.from_level_3(lv3_path, resolution=resolution).save(save_path)
+
+    manifest.record("Sonde_index", item, index_key, [save_path])
+    manifest.save()
+
+    return save_path
+
+def open_sonde_index(lv3_path):
+    """
+    Saved index of a Level-3 product, built from the product if it does not exist
+    """
+    if os.path.exists(index_path(lv3_path)):
+        return SondeIndex.load(index_path(lv3_path))
+
+    return SondeIndex.from_level_3(lv3_path)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Select sondes of a Level-3 product by time and position")
+    parser.add_argument("lv3_path")
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--box", type=float, nargs=4, default=None, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"))
+    args = parser.parse_args()
+
+    index = open_sonde_index(args.lv3_path)
+
+    for sonde_id in index.sonde_ids(index.query(start=args.start, end=args.end, box=args.box)):
+        print(sonde_id)
@@ -0,0 +1,147 @@
+# Python file to look up the QC status of sondes by launch time or sonde ID
+
+import collections
+import glob
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from packaging import version
+
+import joanne
+
+StatusRow = collections.namedtuple("StatusRow", ["sonde_id", "qc_flag", "flags"])
+# one row of the QC status table; `flags` holds all other per-sonde variables
+
+
+def get_status_filename(qc_directory):
+
+    # look for status file with same major and minor version-bit
+    # (patch number and modifiers can be different)
+
+    status_filename = glob.glob(
+        f"{qc_directory}Status_of_sondes_v{joanne.__version__[:3]}*.nc"
+    )
+
+    vers = [None] * len(status_filename)
+
+    for n, i in enumerate(status_filename):
+        vers[n] = version.parse(i)
+
+    return str(max(vers))
+
+
+def _to_ns(launch_time):
+    return int(np.datetime64(np.asarray(launch_time)[()], "ns").astype("int64"))
+
+
+class QCStatusIndex:
+
+    """
+    Hash index over the QC status table
+
+    Input :
+        status_ds : xarray dataset
+                    QC status dataset with a sonde_id dimension, as written by QC.run_qc()
+
+    The status file is read once and every sonde is stored as a StatusRow keyed by
+    its launch time (in ns) and by its sonde ID, so that lookups are O(1) instead of
+    a swap_dims/sel over the whole table. Sorted launch times are kept as well
+    for nearest-neighbour matching within a tolerance.
+    """
+
+    def __init__(self, status_ds):
+
+        launch_time = status_ds.launch_time.values.astype("datetime64[ns]").astype("int64")
+        sonde_id = status_ds.sonde_id.values
+        qc_flag = status_ds.qc_flag.values
+
+        flag_vars = [
+            var
+            for var in status_ds.data_vars
+            if var not in ["launch_time", "qc_flag"] and status_ds[var].dims == ("sonde_id",)
+        ]
+        flag_values = {var: status_ds[var].values for var in flag_vars}
+
+        self.rows = [
+            StatusRow(
+                str(sonde_id[i]),
+                str(qc_flag[i]),
+                {var: flag_values[var][i] for var in flag_vars},
+            )
+            for i in range(len(sonde_id))
+        ]
+
+        self.by_launch_time = dict(zip(launch_time.tolist(), self.rows))
+        self.by_sonde_id = {row.sonde_id: row for row in self.rows}
+
+        order = np.argsort(launch_time)
+        self._sorted_launch_time = launch_time[order]
+        self._sorted_rows = [self.rows[i] for i in order]
+
+    @classmethod
+    def from_file(cls, status_filename):
+        with xr.open_dataset(status_filename) as status_ds:
+            return cls(status_ds.load())
+
+    @classmethod
+    def from_qc_directory(cls, qc_directory):
+        return cls.from_file(get_status_filename(qc_directory))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lookup(self, launch_time, method=None, tolerance=None):
+
+        """
+        Input :
+            launch_time : np.datetime64 or 0-d array
+            method : None or "nearest"
+                     None requires an exact match of the launch time
+            tolerance : np.timedelta64 or string (e.g. "1s")
+                        largest accepted difference for method="nearest"
+        Output :
+            row : StatusRow
+        Raises KeyError if no sonde matches
+        """
+
+        key = _to_ns(launch_time)
+
+        row = self.by_launch_time.get(key)
+
+        if row is not None:
+            return row
+
+        if method is None:
+            raise KeyError(f"No QC status for launch time {np.datetime64(key, 'ns')}")
+        elif method != "nearest":
+            raise ValueError(f"Unknown lookup method: {method}")
+
+        times = self._sorted_launch_time
+        pos = np.searchsorted(times, key)
+        candidates = [i for i in (pos - 1, pos) if 0 <= i < len(times)]
+
+        if len(candidates) == 0:
+            raise KeyError("QC status table is empty")
+
+        nearest = min(candidates, key=lambda i: abs(int(times[i]) - key))
+
+        if tolerance is not None and abs(int(times[nearest]) - key) > pd.Timedelta(tolerance).value:
+            raise KeyError(
+                f"No QC status within {tolerance} of launch time {np.datetime64(key, 'ns')}"
+            )
+
+        return self._sorted_rows[nearest]
+
+    def get(self, launch_time, default=None, **kwargs):
+        try:
+            return self.lookup(launch_time, **kwargs)
+        except KeyError:
+            return default
+
+    def qc_flag(self, launch_time, **kwargs):
+        return self.lookup(launch_time, **kwargs).qc_flag
+
+    def sonde_id(self, launch_time, **kwargs):
+        return self.lookup(launch_time, **kwargs).sonde_id
+
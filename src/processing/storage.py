@@ -0,0 +1,116 @@
+# Python file with the storage profiles: the compression settings used by all writers
+
+import config
+
+profiles = {
+    "none": {
+        "description": "no compression and no checksums; largest files, fastest writes",
+        "netcdf": {},
+        "zarr": {"compressor": None},
+        "interim": {},
+    },
+    "fast": {
+        "description": "light compression for turnaround in the field",
+        "netcdf": {"zlib": True, "complevel": 1},
+        "zarr": {"blosc": dict(cname="lz4", clevel=1, shuffle="shuffle")},
+        "interim": {},
+    },
+    "default": {
+        "description": "zlib level 4 with checksums, as written before the profiles existed",
+        "netcdf": {"zlib": True, "complevel": 4, "fletcher32": True},
+        "zarr": {},
+        # Zarr default compressor
+        "interim": {},
+    },
+    "archive": {
+        "description": "smallest files: zstd (zlib level 9 without zstd support) with shuffle and checksums",
+        "netcdf": {"compression": "zstd", "complevel": 9, "shuffle": True, "fletcher32": True},
+        "netcdf_fallback": {"zlib": True, "complevel": 9, "shuffle": True, "fletcher32": True},
+        "zarr": {"blosc": dict(cname="zstd", clevel=7, shuffle="bitshuffle")},
+        "interim": {"zlib": True, "complevel": 1},
+        # interim files of a whole campaign add up on disk
+    },
+}
+
+default_profile = "default"
+
+def get_profile_name(profile=None, config_file=None):
+    """
+    Name of the storage profile: `profile` if given, else the `storage_profile`
+    option of run_config.cfg
+    """
+    if profile is None:
+        profile = config.get_option(
+            "storage_profile", fallback=default_profile, config=config.read_config(config_file)
+        )
+
+    if profile not in profiles:
+        raise ValueError(f"Unknown storage profile: {profile} (one of {', '.join(profiles)})")
+
+    return profile
+
+def _netcdf_has_zstd():
+    try:
+        import netCDF4
+    except ImportError:
+        return False
+
+    return bool(getattr(netCDF4, "__has_zstandard_support__", False))
+
+def netcdf_compression(profile=None, interim=False):
+
+    """
+    Input :
+        profile : string
+                  name of a storage profile; `storage_profile` option if None
+        interim : bool
+                  if True, the settings for intermediate files (Level-3 interim files)
+    Output :
+        dict of compression settings of a NetCDF variable, valid both as xarray
+        encoding and as keyword arguments of netCDF4 createVariable()
+    """
+
+    settings = profiles[get_profile_name(profile)]
+
+    if interim:
+        return dict(settings["interim"])
+
+    if settings["netcdf"].get("compression") == "zstd" and not _netcdf_has_zstd():
+        return dict(settings["netcdf_fallback"])
+
+    return dict(settings["netcdf"])
+
+def zarr_compression(profile=None):
+
+    """
+    Input :
+        profile : string
+                  name of a storage profile; `storage_profile` option if None
+    Output :
+        dict with the compressor of a Zarr variable as xarray encoding; empty for
+        the Zarr default compressor, which is also used if numcodecs is not installed
+    """
+
+    settings = profiles[get_profile_name(profile)]["zarr"]
+
+    if "blosc" not in settings:
+        return dict(settings)
+
+    try:
+        from numcodecs import Blosc
+    except ImportError:
+        return {}
+
+    blosc = dict(settings["blosc"])
+    blosc["shuffle"] = {"shuffle": Blosc.SHUFFLE, "bitshuffle": Blosc.BITSHUFFLE}[blosc["shuffle"]]
+
+    return {"compressor": Blosc(**blosc)}
+
+def encoding(profile=None, zarr=False, interim=False):
+    """
+    Compression settings of a variable for the NetCDF or Zarr writer
+    """
+    if zarr:
+        return zarr_compression(profile)
+
+    return netcdf_compression(profile, interim=interim)
@@ -0,0 +1,415 @@
+# Python file to process sondes as they arrive during a flight (live / watch mode)
+
+import argparse
+import os
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import joanne
+from joanne.Level_3 import fn_3 as f3
+
+import QC
+import config
+import generate_Level_2
+import generate_Level_3
+import platforms
+from a_file_index import AFileIndex
+from status_index import QCStatusIndex
+
+data_dir = 'extra/Sample_Data/20200122/HALO/'
+
+quicklook_vars = ["ta", "rh", "q", "u", "v", "p"]
+# variables of the running mean profile
+
+class QuicklookState:
+
+    """
+    Running campaign state for the live quicklooks
+
+    Every interpolated sonde is added to running sums per altitude level, so the
+    mean profile and the launch locations are updated in O(levels) per sonde
+    instead of re-reading all sondes of the flight. A sonde that is reprocessed
+    or no longer GOOD is taken out again with remove()
+    """
+
+    def __init__(self):
+        self.alt = None
+        self.sums = {}
+        self.counts = {}
+        self.launches = {}
+        # key (sonde path) -> (sonde_id, launch_time, flight_lat, flight_lon)
+
+    def _add(self, ds, sign):
+
+        if self.alt is None:
+            self.alt = ds.alt.values
+            for var in quicklook_vars:
+                self.sums[var] = np.zeros(len(self.alt))
+                self.counts[var] = np.zeros(len(self.alt), dtype="int64")
+
+        for var in quicklook_vars:
+            if var in ds:
+                values = np.asarray(ds[var].values, dtype="float64").reshape(-1)
+                valid = ~np.isnan(values)
+                self.sums[var][valid] += sign * values[valid]
+                self.counts[var][valid] += sign
+
+    def update(self, key, interpolated_dataset):
+
+        ds = interpolated_dataset
+
+        self._add(ds, 1)
+
+        self.launches[key] = (
+            str(ds.sonde_id.values),
+            np.datetime64(ds.launch_time.values[()], "ns"),
+            float(ds.flight_lat.values),
+            float(ds.flight_lon.values),
+        )
+
+    def remove(self, key, interpolated_dataset):
+        """
+        Take out the contribution of a sonde added with update()
+        """
+        self._add(interpolated_dataset, -1)
+        self.launches.pop(key, None)
+
+    def to_dataset(self):
+
+        """
+        Mean profiles (alt) and launch details (sonde_id) of all sondes so far
+        """
+
+        data_vars = {}
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for var in self.sums:
+                data_vars[f"mean_{var}"] = (
+                    ["alt"],
+                    np.where(self.counts[var] > 0, self.sums[var] / self.counts[var], np.nan),
+                )
+                data_vars[f"count_{var}"] = (["alt"], self.counts[var])
+
+        launches = list(self.launches.values())
+
+        sonde_id = [i[0] for i in launches]
+        data_vars["launch_time"] = (["sonde_id"], np.array([i[1] for i in launches], dtype="datetime64[ns]"))
+        data_vars["flight_lat"] = (["sonde_id"], np.array([i[2] for i in launches], dtype="float64"))
+        data_vars["flight_lon"] = (["sonde_id"], np.array([i[3] for i in launches], dtype="float64"))
+
+        coords = {"sonde_id": sonde_id}
+        if self.alt is not None:
+            coords["alt"] = self.alt
+
+        return xr.Dataset(data_vars, coords=coords)
+
+
+class LiveSession:
+
+    """
+    In-memory state of a flight while sondes arrive
+
+    Input :
+        data_dir : string
+                   platform directory with Level_0/ (A-files) and Level_1/ (ASPEN files)
+        height_limit, vertical_spacing : int
+                                         altitude grid of the Level-3 interpolation
+        pressure_log_interp : bool
+                              interpolate pressure in log(p), as the Level-3 of the batch run
+
+    For each new sonde, only that sonde is read: its QC row and launch summary
+    are appended to the status table held in memory, the flags and sonde IDs are
+    re-aggregated over the (small) table, and Level-2, the Level-3
+    interpolation and the quicklook state are updated for that sonde. A sonde
+    already processed is only redone if its sonde ID or QC flag changes; its
+    previous contribution is then taken out of the quicklook state first.
+    """
+
+    def __init__(
+        self, data_dir, height_limit=10000, vertical_spacing=10, aspen_suffix="QC.nc", pressure_log_interp=False
+    ):
+
+        self.data_dir = data_dir
+        self.directory = f"{data_dir}Level_1/"
+        self.a_dir = f"{data_dir}Level_0/"
+        self.qc_directory = f"{data_dir}QC/"
+        self.save_dir = f"{data_dir}Level_2/"
+        self.quicklook_dir = f"{data_dir}Quicklooks/"
+        self.aspen_suffix = aspen_suffix
+        self.platform = platforms.platform_from_directory(data_dir)
+
+        self.height_limit = height_limit
+        self.vertical_spacing = vertical_spacing
+        self.pressure_log_interp = pressure_log_interp
+
+        for directory in [self.qc_directory, self.save_dir, self.quicklook_dir]:
+            os.makedirs(directory, exist_ok=True)
+
+        self.sonde_paths = []
+        self.status_table = None
+        # QC rows of all sondes so far, along `time` in arrival order
+        self.summaries = []
+        # QC.launch_summary() of all sondes so far, for the sonde IDs
+        self.launch_times = []
+        self.status_ds = None
+        self.status = {}
+        # sonde path -> (sonde_id, qc_flag) the sonde was last processed with
+        self.level_2_files = {}
+        self.level_3 = {}
+        # sonde path -> interpolated dataset of the sondes currently GOOD
+        self.quicklook = QuicklookState()
+
+        self.a_index = AFileIndex(data_dir)
+        # A-files parsed once as they arrive
+
+        self._sizes = {}
+        self.failed = set()
+        # sondes whose QC failed; not retried during this session
+        self.list_of_variables = None
+        self.srf_flag_vars = None
+
+    ###----- Detecting new sondes -----###
+
+    def a_filepaths(self, sonde_path):
+        return self.a_index.a_filepaths("A" + sonde_path[-20:-5])
+
+    def new_sondes(self):
+
+        """
+        ASPEN files not processed yet whose A-file is present and whose size did
+        not change since the previous poll (i.e. ASPEN finished writing them)
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        self.a_index.refresh()
+
+        ready = []
+        seen = set(self.sonde_paths) | self.failed
+
+        with os.scandir(self.directory) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+
+                if not entry.name.endswith(self.aspen_suffix):
+                    continue
+
+                path = self.directory + entry.name
+
+                if path in seen:
+                    continue
+
+                size = entry.stat().st_size
+
+                if self._sizes.get(path) == size and len(self.a_filepaths(path)) > 0:
+                    ready.append(path)
+                else:
+                    self._sizes[path] = size
+
+        return ready
+
+    ###----- Processing a sonde -----###
+
+    def add_sonde(self, sonde_path):
+
+        """
+        Run QC, Level-2, Level-3 interpolation and the quicklook update for one new sonde
+        """
+
+        file_time = np.datetime64(pd.to_datetime(sonde_path[-20:-5], format="%Y%m%d_%H%M%S"), "s")
+
+        with xr.open_dataset(sonde_path) as sonde:
+            sonde = sonde.load()
+            status_row, self.list_of_variables, self.srf_flag_vars = QC.get_status_row(
+                sonde,
+                QC.get_ld_flags(
+                    self.a_dir, ["A" + sonde_path[-20:-5]], self.qc_directory, self.platform, logs=False
+                )[0],
+                # same launch-detect parser as batch QC; its logs are written by the batch run
+                file_time,
+            )
+            summary = QC.launch_summary(sonde)
+
+        status_row = status_row.load()
+
+        self.sonde_paths.append(sonde_path)
+        self.summaries.append(summary)
+        self.launch_times.append(status_row.launch_time.values[0])
+        self.status_table = (
+            status_row
+            if self.status_table is None
+            else xr.concat([self.status_table, status_row], dim="time")
+        )
+        self._sizes.pop(sonde_path, None)
+
+        self.update_status()
+
+        for path in self.sonde_paths:
+            current = self.status_of(path)
+            if current != self.status.get(path):
+                try:
+                    self.process(path, current)
+                except Exception:
+                    print(f"Processing failed for {path}\n{traceback.format_exc()}")
+                # the other sondes are still updated; this one is tried again with the next sonde
+
+        self.save()
+
+    def update_status(self):
+
+        self.status_ds = QC.get_the_status_flags(
+            self.status_table,
+            self.list_of_variables,
+            self.srf_flag_vars,
+            self.summaries,
+            platform=self.platform,
+        )
+        # flags and sonde IDs from the rows and launch summaries held in memory;
+        # no sonde file is opened again
+
+        self.status_index = QCStatusIndex(self.status_ds)
+
+        self._row_of = {
+            path: self.status_index.lookup(launch_time)
+            for path, launch_time in zip(self.sonde_paths, self.launch_times)
+        }
+        # status rows are in arrival order, as are the sonde paths
+
+    def status_of(self, sonde_path):
+        row = self._row_of[sonde_path]
+        return (row.sonde_id, row.qc_flag)
+
+    def process(self, sonde_path, status):
+
+        """
+        Level-2, Level-3 interpolation and quicklook update of a single sonde; the
+        previous contribution of the sonde (if any) is removed first, so that a
+        sonde that is no longer GOOD drops out and a reprocessed one is counted once.
+        The status is only recorded once the sonde is done, so that a sonde that
+        fails is tried again with the next one
+        """
+
+        previous = self.status.get(sonde_path)
+
+        if previous is not None:
+            old_file = self.level_2_files.pop(sonde_path, None)
+            if old_file is not None and os.path.exists(old_file):
+                os.remove(old_file)
+
+        old_interpolated = self.level_3.pop(sonde_path, None)
+
+        if old_interpolated is not None:
+            self.quicklook.remove(sonde_path, old_interpolated)
+
+        generate_Level_2.status_index = self.status_index
+
+        level_2_file = generate_Level_2.process_sonde(
+            sonde_path,
+            np.datetime64(pd.to_datetime(sonde_path[-20:-5], format="%Y%m%d_%H%M%S"), "s"),
+            self.a_filepaths(sonde_path),
+            save_dir=self.save_dir,
+            overwrite=True,
+            platform=self.platform,
+            flight_attrs=self.a_index.flight_attrs("A" + sonde_path[-20:-5]),
+        )
+
+        if level_2_file is None:
+            self.status[sonde_path] = status
+            print(f"{os.path.basename(sonde_path)}: {status[1]}, no Level-2")
+            return
+
+        self.level_2_files[sonde_path] = level_2_file
+
+        interpolated = generate_Level_3.interpolate_for_level_3(
+            f3.ready_to_interpolate(level_2_file),
+            height_limit=self.height_limit,
+            vertical_spacing=self.vertical_spacing,
+            pressure_log_interp=self.pressure_log_interp,
+        ).load()
+
+        self.level_3[sonde_path] = interpolated
+        self.quicklook.update(sonde_path, interpolated)
+        self.status[sonde_path] = status
+
+        print(f"{os.path.basename(sonde_path)}: {status[0]} processed")
+
+    def save(self):
+
+        """
+        Write the status table, the quicklook state and the A-file index; all are small
+        """
+
+        self.status_ds.to_netcdf(
+            f"{self.qc_directory}Status_of_sondes_v{joanne.__version__}.nc"
+        )
+        self.quicklook.to_dataset().to_netcdf(
+            f"{self.quicklook_dir}Live_quicklook_v{joanne.__version__}.nc"
+        )
+        self.a_index.save()
+
+    def level_3_dataset(self):
+        """
+        Concatenation of all interpolated sondes so far, (sonde_id, alt)
+        """
+        return f3.concatenate_soundings(list(self.level_3.values()))
+
+
+def watch(data_dir=data_dir, interval=5, max_polls=None):
+
+    """
+    Input :
+        data_dir : string
+                   platform directory being filled during the flight
+        interval : float
+                   seconds between two polls of Level_1/
+        max_polls : int
+                    stop after this many polls; runs until interrupted if None
+    Output :
+        session : LiveSession
+    Function to poll the Level_1/ directory and process each new sonde as soon as
+    ASPEN has written it and its A-file is present. A sonde that fails is
+    reported and skipped; the session keeps running
+    """
+
+    session = LiveSession(
+        data_dir,
+        height_limit=int(config.get_option("height_limit", fallback=10000)),
+        vertical_spacing=int(config.get_option("vertical_spacing", fallback=10)),
+        pressure_log_interp=config.read_config()["DEFAULT"].getboolean("pressure_log_interp", fallback=False),
+    )
+
+    print(f"Watching {session.directory} every {interval} s (Ctrl-C to stop)...")
+
+    polls = 0
+
+    try:
+        while max_polls is None or polls < max_polls:
+
+            for sonde_path in session.new_sondes():
+                try:
+                    session.add_sonde(sonde_path)
+                except Exception:
+                    print(f"Processing failed for {sonde_path}\n{traceback.format_exc()}")
+                    if sonde_path not in session.sonde_paths:
+                        session.failed.add(sonde_path)
+
+            polls += 1
+            time.sleep(interval)
+
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+    return session
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Process sondes as they arrive during a flight")
+    parser.add_argument("--data-dir", default=data_dir)
+    parser.add_argument("--interval", type=float, default=5, help="seconds between polls")
+    args = parser.parse_args()
+
+    watch(args.data_dir, interval=args.interval)